@@ -5,16 +5,27 @@ API接口模块
 提供RESTful API接口
 """
 
-from flask import Blueprint, request, jsonify, send_file
+from flask import Blueprint, Response, current_app, request, jsonify, send_file, stream_with_context
 from flask_login import login_required, current_user
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+import json
 import os
-import difflib
+import threading
 from pathlib import Path
 
-from models import db, Device, BackupTask, BackupLog, User
+from sqlalchemy import func
+
+from models import (db, Device, BackupTask, BackupLog, BackupArtifact, User, ConfigChange,
+                    ComplianceRule, ComplianceResult, DeviceCompliance)
 from device_manager import DeviceManager
 from backup_service import BackupService
+from pagination import keyset_page, approximate_total
+from change_report import generate_report
+from config_search import search_configs
+from compliance_engine import validate_rule
+import compliance
+from log_reader import (log_reader, read_tail, decode_log, is_log_file_name,
+                        list_log_files as list_log_paths, parse_time as parse_log_time)
 
 api_bp = Blueprint('api', __name__)
 
@@ -187,6 +198,7 @@ def backup_single_device():
         data = request.get_json()
         device_id = data.get('device_id')
         backup_command = data.get('backup_command')
+        backup_commands = data.get('backup_commands')
         test_connection = data.get('test_connection', False)
         
         if not device_id:
@@ -195,6 +207,12 @@ def backup_single_device():
                 'error': '设备ID不能为空'
             }), 400
         
+        if backup_commands is not None and not _is_command_list(backup_commands):
+            return jsonify({
+                'success': False,
+                'error': 'backup_commands必须是非空的命令列表'
+            }), 400
+        
         # 如果选择测试连接，先测试
         if test_connection:
             device = Device.query.get(device_id)
@@ -222,7 +240,8 @@ def backup_single_device():
             device_id=device_id,
             user_id=current_user.id,
             backup_command=backup_command,
-            task_type='manual'
+            task_type='manual',
+            backup_commands=backup_commands
         )
         
         return jsonify(result)
@@ -241,6 +260,7 @@ def backup_batch_devices():
         data = request.get_json()
         device_ids = data.get('device_ids', [])
         backup_command = data.get('backup_command')
+        backup_commands = data.get('backup_commands')
         
         if not device_ids:
             return jsonify({
@@ -248,12 +268,19 @@ def backup_batch_devices():
                 'error': '设备ID列表不能为空'
             }), 400
         
+        if backup_commands is not None and not _is_command_list(backup_commands):
+            return jsonify({
+                'success': False,
+                'error': 'backup_commands必须是非空的命令列表'
+            }), 400
+        
         # 执行批量备份
         result = backup_service.backup_multiple_devices(
             device_ids=device_ids,
             user_id=current_user.id,
             backup_command=backup_command,
-            task_type='batch'
+            task_type='batch',
+            backup_commands=backup_commands
         )
         
         return jsonify(result)
@@ -264,6 +291,11 @@ def backup_batch_devices():
             'error': f'批量备份失败: {str(e)}'
         }), 500
 
+def _is_command_list(commands):
+    """校验命令集参数"""
+    return (isinstance(commands, list) and len(commands) > 0
+            and all(isinstance(cmd, str) and cmd.strip() for cmd in commands))
+
 @api_bp.route('/backup/progress/<int:task_id>')
 @login_required
 def get_backup_progress(task_id):
@@ -302,8 +334,8 @@ def get_recent_backups():
     """获取最近备份任务"""
     try:
         # 获取最近10个任务
-        tasks = BackupTask.query.order_by(BackupTask.created_at.desc()).limit(10).all()
-        task_data = [task.to_dict() for task in tasks]
+        rows = BackupTask.summary_query().order_by(BackupTask.created_at.desc()).limit(10).all()
+        task_data = [BackupTask.summary_dict(row) for row in rows]
         
         return jsonify({
             'success': True,
@@ -319,17 +351,38 @@ def get_recent_backups():
 @api_bp.route('/backup/device/<int:device_id>')
 @login_required
 def get_device_backups(device_id):
-    """获取特定设备的备份任务"""
+    """获取特定设备的备份任务（按创建时间倒序）
+
+    传入per_page或cursor时使用游标分页；都不传时返回设备的全部备份任务
+    """
     try:
-        # 获取指定设备的所有备份任务
-        tasks = BackupTask.query.filter_by(device_id=device_id).order_by(BackupTask.created_at.desc()).all()
-        task_data = [task.to_dict() for task in tasks]
+        query = BackupTask.summary_query().filter(BackupTask.device_id == device_id)
+        if 'per_page' in request.args or 'cursor' in request.args:
+            per_page = min(max(request.args.get('per_page', 100, type=int), 1), 500)
+            rows, next_cursor = keyset_page(query, BackupTask.created_at, BackupTask.id,
+                                            request.args.get('cursor'), per_page)
+        else:
+            rows = query.order_by(BackupTask.created_at.desc(), BackupTask.id.desc()).all()
+            next_cursor = None
+        task_data = [BackupTask.summary_dict(row) for row in rows]
         
-        return jsonify({
+        result = {
             'success': True,
-            'tasks': task_data
-        })
+            'tasks': task_data,
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None
+        }
+        if request.args.get('include_total', 'false').lower() == 'true':
+            result['total'], result['total_exact'] = approximate_total(
+                BackupTask.query.filter(BackupTask.device_id == device_id), BackupTask.id
+            )
+        return jsonify(result)
         
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
     except Exception as e:
         return jsonify({
             'success': False,
@@ -354,24 +407,87 @@ def download_backup_file(task_id):
                 'error': '备份文件不存在'
             }), 404
         
-        file_path = Path(task.file_path)
-        if not file_path.exists():
-            return jsonify({
-                'success': False,
-                'error': '备份文件已丢失'
-            }), 404
-        
         # 生成下载文件名
         device_name = task.device.alias or task.device.ip_address
         timestamp = task.completed_at.strftime('%Y%m%d_%H%M%S') if task.completed_at else 'unknown'
         filename = f"{device_name}_{timestamp}_backup.txt"
         
-        return send_file(
-            file_path,
+        # 从磁盘流式发送明文内容，不把整个备份读入内存
+        response = backup_service.with_content_path(task, lambda path: send_file(
+            path.resolve(),
             as_attachment=True,
             download_name=filename,
             mimetype='text/plain'
-        )
+        ))
+        if response is None:
+            return jsonify({
+                'success': False,
+                'error': '备份文件已丢失'
+            }), 404
+        return response
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'下载失败: {str(e)}'
+        }), 500
+
+@api_bp.route('/backup/<int:task_id>/artifacts')
+@login_required
+def get_backup_artifacts(task_id):
+    """获取命令集备份的产物列表"""
+    try:
+        task = BackupTask.query.get(task_id)
+        if not task:
+            return jsonify({
+                'success': False,
+                'error': '任务不存在'
+            }), 404
+        
+        return jsonify({
+            'success': True,
+            'task_id': task.id,
+            'artifacts': [artifact.to_dict() for artifact in task.artifacts]
+        })
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'获取备份产物失败: {str(e)}'
+        }), 500
+
+@api_bp.route('/backup/artifact/<int:artifact_id>/download')
+@login_required
+def download_backup_artifact(artifact_id):
+    """下载命令集备份中的单个产物文件"""
+    try:
+        artifact = BackupArtifact.query.get(artifact_id)
+        if not artifact:
+            return jsonify({
+                'success': False,
+                'error': '备份产物不存在'
+            }), 404
+        
+        device = artifact.task.device
+        device_name = device.alias or device.ip_address
+        timestamp = artifact.completed_at.strftime('%Y%m%d_%H%M%S') if artifact.completed_at else 'unknown'
+        command_name = artifact.command.replace(' ', '_').replace('-', '_')
+        filename = f"{device_name}_{timestamp}_{command_name}.txt"
+        
+        response = None
+        if artifact.status == 'success':
+            response = backup_service.with_content_path(artifact, lambda path: send_file(
+                path.resolve(),
+                as_attachment=True,
+                download_name=filename,
+                mimetype='text/plain'
+            ))
+        if response is None:
+            return jsonify({
+                'success': False,
+                'error': '备份文件不存在'
+            }), 404
+        return response
         
     except Exception as e:
         return jsonify({
@@ -391,9 +507,8 @@ def delete_backup_task(task_id):
                 'error': '任务不存在'
             }), 404
         
-        # 删除备份文件
-        if task.file_path:
-            backup_service.delete_backup_file(task_id)
+        # 释放备份文件（命令集任务失败时也可能有已保存的产物）
+        backup_service.delete_backup_file(task_id)
         
         # 删除任务记录
         db.session.delete(task)
@@ -711,10 +826,10 @@ def download_template():
 @api_bp.route('/logs/view/<filename>')
 @login_required
 def view_log_file(filename):
-    """查看日志文件内容"""
+    """查看日志文件内容（从末尾向前分段读取）"""
     try:
         # 安全检查：只允许查看指定目录下的日志文件
-        if not filename.endswith('.log'):
+        if not is_log_file_name(filename):
             return jsonify({
                 'success': False,
                 'error': '只能查看.log文件'
@@ -731,14 +846,11 @@ def view_log_file(filename):
                 'error': '日志文件不存在'
             }), 404
         
-        # 读取日志文件内容
-        try:
-            with open(log_file, 'r', encoding='utf-8') as f:
-                content = f.read()
-        except UnicodeDecodeError:
-            # 如果UTF-8解码失败，尝试GBK编码
-            with open(log_file, 'r', encoding='gbk') as f:
-                content = f.read()
+        # 读取before位置（默认文件末尾）之前的最后若干行
+        lines = min(max(request.args.get('lines', 1000, type=int), 1), 10000)
+        before = request.args.get('before', type=int)
+        data, start_offset = read_tail(log_file, lines, before)
+        content = decode_log(data)
         
         # 获取文件信息
         file_size = log_file.stat().st_size
@@ -748,6 +860,8 @@ def view_log_file(filename):
             'success': True,
             'filename': filename,
             'content': content,
+            'start_offset': start_offset,
+            'has_more': start_offset > 0,
             'file_size': file_size,
             'modified_time': modified_time.isoformat()
         })
@@ -763,16 +877,9 @@ def view_log_file(filename):
 def list_log_files():
     """获取日志文件列表"""
     try:
-        log_dir = Path('logs')
-        if not log_dir.exists():
-            return jsonify({
-                'success': True,
-                'files': []
-            })
-        
-        # 获取所有.log文件
+        # 获取所有日志文件（含轮转文件），按修改时间排序
         log_files = []
-        for file_path in log_dir.glob('*.log'):
+        for file_path in list_log_paths(Path('logs')):
             stat = file_path.stat()
             log_files.append({
                 'filename': file_path.name,
@@ -780,9 +887,6 @@ def list_log_files():
                 'modified_time': datetime.fromtimestamp(stat.st_mtime).isoformat()
             })
         
-        # 按修改时间排序
-        log_files.sort(key=lambda x: x['modified_time'], reverse=True)
-        
         return jsonify({
             'success': True,
             'files': log_files
@@ -797,66 +901,29 @@ def list_log_files():
 @api_bp.route('/logs/entries')
 @login_required
 def get_log_entries():
-    """获取日志条目"""
+    """获取日志条目（通过日志偏移索引分页，最新的在前）"""
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', 20, type=int), 1), 500)
         level = request.args.get('level', '')
+        start_time = parse_log_time(request.args.get('start_time', ''))
+        end_time = parse_log_time(request.args.get('end_time', ''))
         
-        # 模拟日志条目数据
-        log_entries = []
-        
-        # 从日志文件中读取最近的条目
-        log_dir = Path('logs')
-        if log_dir.exists():
-            for log_file in log_dir.glob('*.log'):
-                try:
-                    with open(log_file, 'r', encoding='utf-8') as f:
-                        lines = f.readlines()
-                        # 取最后50行作为示例
-                        recent_lines = lines[-50:] if len(lines) > 50 else lines
-                        
-                        for line in recent_lines:
-                            line = line.strip()
-                            if line:
-                                # 解析日志行格式: 2025-10-22 09:57:05,555 - module - LEVEL - message
-                                parts = line.split(' - ', 3)
-                                if len(parts) >= 4:
-                                    timestamp_str = parts[0]
-                                    module = parts[1]
-                                    log_level = parts[2]
-                                    message = parts[3]
-                                    
-                                    # 过滤级别
-                                    if level and log_level.lower() != level.lower():
-                                        continue
-                                    
-                                    log_entries.append({
-                                        'timestamp': timestamp_str,
-                                        'level': log_level,
-                                        'module': module,
-                                        'message': message
-                                    })
-                except Exception as e:
-                    continue
-        
-        # 按时间排序
-        log_entries.sort(key=lambda x: x['timestamp'], reverse=True)
-        
-        # 分页
-        total = len(log_entries)
-        start = (page - 1) * per_page
-        end = start + per_page
-        paginated_entries = log_entries[start:end]
+        log_entries, total = log_reader.entries(page, per_page, level, start_time, end_time)
         
         return jsonify({
             'success': True,
-            'logs': paginated_entries,
+            'logs': log_entries,
             'total': total,
             'pages': (total + per_page - 1) // per_page,
             'current_page': page
         })
         
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
     except Exception as e:
         return jsonify({
             'success': False,
@@ -866,7 +933,11 @@ def get_log_entries():
 @api_bp.route('/backup/<int:backup_id>/content')
 @login_required
 def get_backup_content(backup_id):
-    """获取备份文件内容"""
+    """获取备份文件内容
+
+    指定start_line或end_line时只返回该行范围（从1开始，包含两端，最多5000行），
+    否则返回完整内容
+    """
     try:
         # 获取备份任务信息
         task = BackupTask.query.get(backup_id)
@@ -876,39 +947,42 @@ def get_backup_content(backup_id):
                 'error': '备份任务不存在'
             }), 404
         
-        # 检查备份文件是否存在
-        if not task.file_path or not os.path.exists(task.file_path):
+        file_info = {
+            'file_path': task.file_path,
+            'file_size': task.file_size,
+            'created_at': task.created_at.isoformat(),
+            'device_alias': task.device.alias if task.device else '未知设备',
+            'backup_command': task.backup_command
+        }
+        
+        if 'start_line' in request.args or 'end_line' in request.args:
+            start_line = max(request.args.get('start_line', 1, type=int), 1)
+            end_line = request.args.get('end_line', start_line + 999, type=int)
+            end_line = min(end_line, start_line + 4999)
+            window = backup_service.read_backup_lines(task, start_line, end_line)
+            if window is None:
+                return jsonify({
+                    'success': False,
+                    'error': '备份文件不存在'
+                }), 404
+            return jsonify({
+                'success': True,
+                **window,
+                'file_info': file_info
+            })
+        
+        # 读取备份文件内容（自动还原压缩和差异存储的版本）
+        content = backup_service.read_backup_content(task)
+        if content is None:
             return jsonify({
                 'success': False,
                 'error': '备份文件不存在'
             }), 404
         
-        # 读取备份文件内容
-        try:
-            with open(task.file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-        except UnicodeDecodeError:
-            # 如果UTF-8解码失败，尝试其他编码
-            try:
-                with open(task.file_path, 'r', encoding='gbk') as f:
-                    content = f.read()
-            except:
-                with open(task.file_path, 'r', encoding='latin-1') as f:
-                    content = f.read()
-        
-        # 获取文件信息
-        file_stat = os.stat(task.file_path)
-        
         return jsonify({
             'success': True,
             'content': content,
-            'file_info': {
-                'file_path': task.file_path,
-                'file_size': file_stat.st_size,
-                'created_at': task.created_at.isoformat(),
-                'device_alias': task.device.alias if task.device else '未知设备',
-                'backup_command': task.backup_command
-            }
+            'file_info': file_info
         })
         
     except Exception as e:
@@ -917,14 +991,53 @@ def get_backup_content(backup_id):
             'error': f'获取备份内容失败: {str(e)}'
         }), 500
 
+@api_bp.route('/backup/<int:backup_id>/content/raw')
+@login_required
+def stream_backup_content(backup_id):
+    """以文本流返回备份内容，支持HTTP Range分段读取和条件请求"""
+    try:
+        task = BackupTask.query.get(backup_id)
+        if not task:
+            return jsonify({
+                'success': False,
+                'error': '备份任务不存在'
+            }), 404
+        
+        def send(path):
+            encoding = backup_service.backup_encoding(task, path)
+            # send_file立即打开文件，之后缓存清理删除文件也不影响本次响应
+            response = send_file(
+                path.resolve(),
+                mimetype='text/plain',
+                conditional=True,
+                etag=task.file_hash or True,
+                max_age=3600
+            )
+            response.headers['Content-Type'] = f'text/plain; charset={encoding}'
+            return response
+        
+        response = backup_service.with_content_path(task, send)
+        if response is None:
+            return jsonify({
+                'success': False,
+                'error': '备份文件不存在'
+            }), 404
+        return response
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'读取备份内容失败: {str(e)}'
+        }), 500
+
 @api_bp.route('/backup/compare/<int:task_id1>/<int:task_id2>')
 @login_required
 def compare_backup_files(task_id1, task_id2):
     """比较两个备份文件"""
     try:
         # 获取两个备份任务
-        task1 = BackupTask.query.get(task_id1)
-        task2 = BackupTask.query.get(task_id2)
+        task1 = db.session.get(BackupTask, task_id1, options=BackupTask.eager_options())
+        task2 = db.session.get(BackupTask, task_id2, options=BackupTask.eager_options())
         
         if not task1 or not task2:
             return jsonify({
@@ -938,30 +1051,14 @@ def compare_backup_files(task_id1, task_id2):
                 'error': '备份任务未成功完成'
             }), 400
         
-        if not task1.file_path or not task2.file_path:
+        # 计算差异（相同内容的比较结果会命中差异缓存）
+        diff_result = _calculate_config_diff(task1, task2)
+        if diff_result is None:
             return jsonify({
                 'success': False,
                 'error': '备份文件不存在'
             }), 404
         
-        # 读取两个文件内容
-        try:
-            with open(task1.file_path, 'r', encoding='utf-8') as f:
-                content1 = f.read()
-        except UnicodeDecodeError:
-            with open(task1.file_path, 'r', encoding='gbk') as f:
-                content1 = f.read()
-        
-        try:
-            with open(task2.file_path, 'r', encoding='utf-8') as f:
-                content2 = f.read()
-        except UnicodeDecodeError:
-            with open(task2.file_path, 'r', encoding='gbk') as f:
-                content2 = f.read()
-        
-        # 计算差异
-        diff_result = _calculate_config_diff(content1, content2)
-        
         return jsonify({
             'success': True,
             'task1': {
@@ -1014,7 +1111,7 @@ def compare_latest_backups(device_id):
 @api_bp.route('/backup/compare/quick/<int:device_id>')
 @login_required
 def quick_compare_latest_backups(device_id):
-    """快速比较设备的最新两个备份（简化版本）"""
+    """快速比较设备的最新两个备份（只返回差异统计）"""
     try:
         # 获取设备的最新两个成功备份
         latest_backups = BackupTask.query.filter_by(
@@ -1031,38 +1128,18 @@ def quick_compare_latest_backups(device_id):
         task1 = latest_backups[1]
         task2 = latest_backups[0]
         
-        # 检查文件是否存在
-        if not task1.file_path or not task2.file_path:
-            return jsonify({
-                'success': False,
-                'error': '备份文件不存在'
-            }), 404
-        
-        # 读取文件内容（限制大小）
-        try:
-            with open(task1.file_path, 'r', encoding='utf-8') as f:
-                content1 = f.read(1024 * 1024)  # 限制1MB
-        except UnicodeDecodeError:
-            with open(task1.file_path, 'r', encoding='gbk') as f:
-                content1 = f.read(1024 * 1024)
-        
-        try:
-            with open(task2.file_path, 'r', encoding='utf-8') as f:
-                content2 = f.read(1024 * 1024)  # 限制1MB
-        except UnicodeDecodeError:
-            with open(task2.file_path, 'r', encoding='gbk') as f:
-                content2 = f.read(1024 * 1024)
-        
-        # 简单比较：只检查行数差异
-        lines1 = content1.splitlines()
-        lines2 = content2.splitlines()
-        
-        # 计算基本统计
-        added_lines = len(lines2) - len(lines1)
-        removed_lines = 0
-        if added_lines < 0:
-            removed_lines = -added_lines
-            added_lines = 0
+        # 只返回差异统计：优先使用备份完成时记录的配置变更，没有记录时比较（结果会写入差异缓存）
+        change = ConfigChange.query.filter_by(task_id=task2.id, previous_task_id=task1.id).first()
+        if change is not None and change.old_line_count is not None:
+            summary = change.summary()
+        else:
+            diff_result = backup_service.compare_backups(task1, task2)
+            if diff_result is None:
+                return jsonify({
+                    'success': False,
+                    'error': '备份文件不存在'
+                }), 404
+            summary = diff_result['summary']
         
         return jsonify({
             'success': True,
@@ -1071,25 +1148,20 @@ def quick_compare_latest_backups(device_id):
                 'device': task1.device.alias or task1.device.ip_address,
                 'created_at': task1.created_at.isoformat(),
                 'file_size': task1.file_size,
-                'lines': len(lines1)
+                'lines': summary['old_lines']
             },
             'task2': {
                 'id': task2.id,
                 'device': task2.device.alias or task2.device.ip_address,
                 'created_at': task2.created_at.isoformat(),
                 'file_size': task2.file_size,
-                'lines': len(lines2)
+                'lines': summary['new_lines']
             },
             'diff': {
-                'summary': {
-                    'total_changes': abs(len(lines2) - len(lines1)),
-                    'added_lines': added_lines,
-                    'removed_lines': removed_lines,
-                    'modified_lines': 0,
-                    'has_changes': len(lines1) != len(lines2)
-                },
+                'summary': summary,
                 'diff_blocks': [],
-                'raw_diff': f'配置文件行数变化: {len(lines1)} -> {len(lines2)}'
+                'raw_diff': (f"配置文件行数变化: {summary['old_lines']} -> {summary['new_lines']}，"
+                             f"{summary['changed_sections']} 个配置段有变化")
             }
         })
         
@@ -1099,110 +1171,431 @@ def quick_compare_latest_backups(device_id):
             'error': f'快速比较失败: {str(e)}'
         }), 500
 
-def _calculate_config_diff(content1, content2):
-    """计算两个配置文件的差异"""
+def _parse_time_arg(name, default=None):
+    """解析时间查询参数（ISO格式），带时区的时间转换为UTC"""
+    value = request.args.get(name)
+    if not value:
+        return default
     try:
-        # 检查文件大小，如果太大则限制处理
-        max_size = 1024 * 1024  # 1MB限制
-        if len(content1) > max_size or len(content2) > max_size:
-            return {
-                'summary': {
-                    'total_changes': 0,
-                    'added_lines': 0,
-                    'removed_lines': 0,
-                    'modified_lines': 0,
-                    'has_changes': False,
-                    'error': '配置文件过大，无法进行比较'
-                },
-                'diff_blocks': [],
-                'raw_diff': ''
+        moment = datetime.fromisoformat(value)
+    except ValueError as e:
+        raise ValueError(f'无效的时间: {value}') from e
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+@api_bp.route('/changes')
+@login_required
+def get_config_changes():
+    """配置变更记录（按检测时间倒序的游标分页），可按设备和时间范围过滤"""
+    try:
+        per_page = min(max(request.args.get('per_page', 50, type=int), 1), 500)
+        include_sections = request.args.get('include_sections', 'false').lower() == 'true'
+        since = _parse_time_arg('since')
+        until = _parse_time_arg('until')
+        device_id = request.args.get('device_id', type=int)
+        
+        columns = [
+            ConfigChange.id, ConfigChange.device_id, ConfigChange.task_id, ConfigChange.previous_task_id,
+            ConfigChange.added_lines, ConfigChange.removed_lines, ConfigChange.modified_lines,
+            ConfigChange.changed_sections, ConfigChange.detected_at, Device.alias, Device.ip_address
+        ]
+        if include_sections:
+            columns.append(ConfigChange.sections)
+        query = db.session.query(*columns).join(Device, ConfigChange.device_id == Device.id)
+        if device_id:
+            query = query.filter(ConfigChange.device_id == device_id)
+        if since:
+            query = query.filter(ConfigChange.detected_at >= since)
+        if until:
+            query = query.filter(ConfigChange.detected_at < until)
+        rows, next_cursor = keyset_page(query, ConfigChange.detected_at, ConfigChange.id,
+                                        request.args.get('cursor'), per_page)
+        
+        changes = []
+        for row in rows:
+            change = {
+                'id': row.id,
+                'device_id': row.device_id,
+                'device_alias': row.alias,
+                'device_ip': row.ip_address,
+                'task_id': row.task_id,
+                'previous_task_id': row.previous_task_id,
+                'added_lines': row.added_lines,
+                'removed_lines': row.removed_lines,
+                'modified_lines': row.modified_lines,
+                'changed_sections': row.changed_sections,
+                'detected_at': row.detected_at.isoformat()
             }
+            if include_sections:
+                change['sections'] = json.loads(row.sections) if row.sections else []
+            changes.append(change)
+        
+        return jsonify({
+            'success': True,
+            'changes': changes,
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None
+        })
+        
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'获取配置变更失败: {str(e)}'
+        }), 500
+
+@api_bp.route('/changes/devices')
+@login_required
+def get_changed_devices():
+    """时间范围内（默认最近24小时）配置发生变化的设备及其变更次数"""
+    try:
+        until = _parse_time_arg('until')
+        since = _parse_time_arg('since', (until or datetime.utcnow()) - timedelta(days=1))
+        
+        query = db.session.query(
+            ConfigChange.device_id, Device.alias, Device.ip_address,
+            func.count(ConfigChange.id).label('change_count'),
+            func.max(ConfigChange.detected_at).label('last_change'),
+            func.sum(ConfigChange.added_lines).label('added_lines'),
+            func.sum(ConfigChange.removed_lines).label('removed_lines'),
+            func.sum(ConfigChange.modified_lines).label('modified_lines')
+        ).join(Device, ConfigChange.device_id == Device.id).filter(ConfigChange.detected_at >= since)
+        if until:
+            query = query.filter(ConfigChange.detected_at < until)
+        rows = query.group_by(ConfigChange.device_id, Device.alias, Device.ip_address) \
+            .order_by(func.max(ConfigChange.detected_at).desc()).all()
+        
+        return jsonify({
+            'success': True,
+            'since': since.isoformat(),
+            'until': until.isoformat() if until else None,
+            'devices': [{
+                'device_id': row.device_id,
+                'device_alias': row.alias,
+                'device_ip': row.ip_address,
+                'change_count': row.change_count,
+                'last_change': row.last_change.isoformat(),
+                'added_lines': row.added_lines,
+                'removed_lines': row.removed_lines,
+                'modified_lines': row.modified_lines
+            } for row in rows]
+        })
         
-        # 将内容按行分割
-        lines1 = content1.splitlines(keepends=True)
-        lines2 = content2.splitlines(keepends=True)
-        
-        # 限制行数，避免处理过大的文件
-        max_lines = 10000
-        if len(lines1) > max_lines or len(lines2) > max_lines:
-            lines1 = lines1[:max_lines]
-            lines2 = lines2[:max_lines]
-        
-        # 使用difflib计算差异
-        differ = difflib.unified_diff(
-            lines1, lines2,
-            fromfile='旧配置',
-            tofile='新配置',
-            lineterm=''
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'获取变更设备失败: {str(e)}'
+        }), 500
+
+@api_bp.route('/changes/report')
+@login_required
+def get_change_report():
+    """全网配置变更报告：比较每台设备在since和until时的配置，按NDJSON逐台设备返回，最后一行为汇总"""
+    try:
+        since = _parse_time_arg('since')
+        if since is None:
+            raise ValueError('缺少参数 since')
+        until = _parse_time_arg('until', datetime.utcnow())
+        if until <= since:
+            raise ValueError('until 必须晚于 since')
+        device_ids = [int(value) for value in request.args.get('device_ids', '').split(',') if value.strip()]
+        compare = request.args.get('compare', 'true').lower() == 'true'
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    
+    lines = generate_report(backup_service, since, until, device_ids or None, compare)
+    body = (json.dumps(line, ensure_ascii=False) + '\n' for line in lines)
+    return Response(stream_with_context(body), mimetype='application/x-ndjson')
+
+@api_bp.route('/search')
+@login_required
+def search_backups():
+    """在备份配置中搜索文本或正则表达式，返回匹配的设备、行号和匹配行
+
+    scope=latest（默认）只搜索每台设备最近一次成功备份，scope=all包括历史版本
+    """
+    try:
+        device_ids = [int(value) for value in request.args.get('device_ids', '').split(',') if value.strip()]
+        result = search_configs(
+            request.args.get('q', ''),
+            regex=request.args.get('regex', 'false').lower() == 'true',
+            ignore_case=request.args.get('ignore_case', 'true').lower() == 'true',
+            scope=request.args.get('scope', 'latest'),
+            device_ids=device_ids or None,
+            limit=min(max(request.args.get('limit', 100, type=int), 1), 1000)
         )
+        return jsonify({
+            'success': True,
+            **result
+        })
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'搜索配置失败: {str(e)}'
+        }), 500
+
+RULE_FIELDS = ('name', 'description', 'rule_type', 'match_type', 'pattern', 'section', 'device_type',
+               'severity', 'is_active')
+RULE_CHECK_FIELDS = ('rule_type', 'match_type', 'pattern', 'section')  # 修改后需要重新检查的字段
+
+def _apply_rule_fields(rule, data):
+    """把请求中的规则字段写入规则，检查内容变化时递增版本，规则无效时抛出ValueError"""
+    changed = False
+    for field in RULE_FIELDS:
+        if field in data:
+            value = data[field]
+            if isinstance(value, str):
+                value = value.strip() if field != 'pattern' else value
+                value = value or None
+            if field in RULE_CHECK_FIELDS and value != getattr(rule, field):
+                changed = True
+            setattr(rule, field, value)
+    if not rule.name:
+        raise ValueError('name 不能为空')
+    if rule.severity not in (None, 'low', 'medium', 'high'):
+        raise ValueError('severity 只能是 low、medium 或 high')
+    validate_rule(rule.rule_type, rule.match_type, rule.pattern, rule.section)
+    duplicate = ComplianceRule.query.filter(ComplianceRule.name == rule.name, ComplianceRule.id != rule.id).first()
+    if duplicate:
+        raise ValueError('规则名称已存在')
+    return changed
+
+@api_bp.route('/compliance/rules')
+@login_required
+def get_compliance_rules():
+    """合规规则列表"""
+    try:
+        rules = ComplianceRule.query.order_by(ComplianceRule.id).all()
+        return jsonify({
+            'success': True,
+            'rules': [rule.to_dict() for rule in rules]
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'获取合规规则失败: {str(e)}'
+        }), 500
+
+@api_bp.route('/compliance/rules', methods=['POST'])
+@login_required
+def add_compliance_rule():
+    """添加合规规则（下次检查时对所有设备求值）"""
+    try:
+        data = request.get_json() or {}
+        rule = ComplianceRule(rule_type='required', match_type='literal', severity='medium', is_active=True, revision=1)
+        _apply_rule_fields(rule, data)
+        db.session.add(rule)
+        db.session.commit()
+        return jsonify({
+            'success': True,
+            'message': '规则添加成功',
+            'rule': rule.to_dict()
+        })
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'error': f'添加合规规则失败: {str(e)}'
+        }), 500
+
+@api_bp.route('/compliance/rules/<int:rule_id>', methods=['PUT'])
+@login_required
+def update_compliance_rule(rule_id):
+    """更新合规规则，检查内容变化时下次检查重新求值该规则"""
+    try:
+        rule = db.session.get(ComplianceRule, rule_id)
+        if not rule:
+            return jsonify({
+                'success': False,
+                'error': '规则不存在'
+            }), 404
         
-        # 转换为列表，限制结果大小
-        diff_lines = list(differ)
-        if len(diff_lines) > 5000:  # 限制差异行数
-            diff_lines = diff_lines[:5000]
-        
-        # 统计差异信息
-        added_lines = 0
-        removed_lines = 0
-        modified_lines = 0
-        
-        diff_result = []
-        current_hunk = None
-        
-        for line in diff_lines:
-            if line.startswith('@@'):
-                # 新的差异块
-                if current_hunk:
-                    diff_result.append(current_hunk)
-                current_hunk = {
-                    'header': line.strip(),
-                    'changes': []
-                }
-            elif line.startswith('+') and not line.startswith('+++'):
-                # 新增行
-                added_lines += 1
-                if current_hunk:
-                    current_hunk['changes'].append({
-                        'type': 'added',
-                        'content': line[1:].rstrip('\n')
-                    })
-            elif line.startswith('-') and not line.startswith('---'):
-                # 删除行
-                removed_lines += 1
-                if current_hunk:
-                    current_hunk['changes'].append({
-                        'type': 'removed',
-                        'content': line[1:].rstrip('\n')
-                    })
-            elif line.startswith(' '):
-                # 上下文行
-                if current_hunk:
-                    current_hunk['changes'].append({
-                        'type': 'context',
-                        'content': line[1:].rstrip('\n')
-                    })
-        
-        # 添加最后一个差异块
-        if current_hunk:
-            diff_result.append(current_hunk)
-        
-        # 计算修改行数（新增和删除的组合）
-        modified_lines = min(added_lines, removed_lines)
-        added_lines -= modified_lines
-        removed_lines -= modified_lines
+        if _apply_rule_fields(rule, request.get_json() or {}):
+            rule.revision += 1
+        db.session.commit()
+        return jsonify({
+            'success': True,
+            'message': '规则更新成功',
+            'rule': rule.to_dict()
+        })
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'error': f'更新合规规则失败: {str(e)}'
+        }), 500
+
+@api_bp.route('/compliance/rules/<int:rule_id>', methods=['DELETE'])
+@login_required
+def delete_compliance_rule(rule_id):
+    """删除合规规则及其检查结果"""
+    try:
+        rule = db.session.get(ComplianceRule, rule_id)
+        if not rule:
+            return jsonify({
+                'success': False,
+                'error': '规则不存在'
+            }), 404
         
-        return {
-            'summary': {
-                'total_changes': len(diff_lines),
-                'added_lines': added_lines,
-                'removed_lines': removed_lines,
-                'modified_lines': modified_lines,
-                'has_changes': len(diff_lines) > 0
-            },
-            'diff_blocks': diff_result,
-            'raw_diff': '\n'.join(diff_lines)
-        }
+        db.session.delete(rule)
+        db.session.commit()
+        return jsonify({
+            'success': True,
+            'message': '规则删除成功'
+        })
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'error': f'删除合规规则失败: {str(e)}'
+        }), 500
+
+@api_bp.route('/compliance/run', methods=['POST'])
+@login_required
+def run_compliance_check():
+    """在后台开始一次合规检查（默认增量，full=true时重新检查全部设备和规则）"""
+    if compliance.is_running():
+        return jsonify({
+            'success': False,
+            'error': '合规检查正在运行'
+        }), 409
+    try:
+        data = request.get_json(silent=True) or {}
+        device_ids = [int(device_id) for device_id in data.get('device_ids') or []]
+        full = bool(data.get('full', False))
+    except (TypeError, ValueError):
+        return jsonify({
+            'success': False,
+            'error': 'device_ids 必须是设备ID列表'
+        }), 400
+    
+    app = current_app._get_current_object()
+    
+    def run():
+        with app.app_context():
+            try:
+                compliance.run_compliance(backup_service, device_ids or None, full)
+            except Exception as e:
+                db.session.rollback()
+                current_app.logger.error(f"合规检查失败: {str(e)}")
+    
+    threading.Thread(target=run, name='compliance-run', daemon=True).start()
+    return jsonify({
+        'success': True,
+        'message': '合规检查已开始'
+    })
+
+@api_bp.route('/compliance/summary')
+@login_required
+def get_compliance_summary():
+    """合规概况：各规则的通过和违规设备数、不合规设备数和上次检查的统计"""
+    try:
+        devices = db.session.query(func.count(DeviceCompliance.device_id)).scalar()
+        non_compliant = db.session.query(func.count(DeviceCompliance.device_id)) \
+            .filter(DeviceCompliance.failed_rules > 0).scalar()
+        return jsonify({
+            'success': True,
+            'rules': compliance.rule_summary(),
+            'devices': devices,
+            'non_compliant_devices': non_compliant,
+            'running': compliance.is_running(),
+            'last_run': compliance.last_run
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'获取合规概况失败: {str(e)}'
+        }), 500
+
+@api_bp.route('/compliance/results')
+@login_required
+def get_compliance_results():
+    """合规检查结果（按检查时间倒序的游标分页），可按规则、设备和状态过滤"""
+    try:
+        per_page = min(max(request.args.get('per_page', 50, type=int), 1), 500)
+        rule_id = request.args.get('rule_id', type=int)
+        device_id = request.args.get('device_id', type=int)
+        status = request.args.get('status')
+        if status and status not in ('pass', 'fail', 'not_applicable'):
+            raise ValueError('status 只能是 pass、fail 或 not_applicable')
+        
+        # 行中单独带上排序列，供游标分页读取
+        query = db.session.query(
+            ComplianceResult, Device.alias, Device.ip_address, ComplianceRule.name, ComplianceRule.severity,
+            ComplianceResult.evaluated_at, ComplianceResult.id
+        ).join(Device, ComplianceResult.device_id == Device.id) \
+            .join(ComplianceRule, ComplianceResult.rule_id == ComplianceRule.id)
+        if rule_id:
+            query = query.filter(ComplianceResult.rule_id == rule_id)
+        if device_id:
+            query = query.filter(ComplianceResult.device_id == device_id)
+        if status:
+            query = query.filter(ComplianceResult.status == status)
+        rows, next_cursor = keyset_page(query, ComplianceResult.evaluated_at, ComplianceResult.id,
+                                        request.args.get('cursor'), per_page)
+        
+        results = []
+        for result, alias, ip_address, rule_name, severity, _, _ in rows:
+            item = result.to_dict()
+            item.update({
+                'device_alias': alias,
+                'device_ip': ip_address,
+                'rule_name': rule_name,
+                'severity': severity
+            })
+            results.append(item)
         
+        return jsonify({
+            'success': True,
+            'results': results,
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None
+        })
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'获取合规检查结果失败: {str(e)}'
+        }), 500
+
+def _calculate_config_diff(task1, task2):
+    """计算两个备份配置的差异（按配置段分组），备份文件不存在时返回None"""
+    try:
+        return backup_service.compare_backups(task1, task2)
     except Exception as e:
         return {
             'summary': {
@@ -1220,35 +1613,65 @@ def _calculate_config_diff(content1, content2):
 @api_bp.route('/backup/history')
 @login_required
 def get_backup_history():
-    """获取备份历史"""
+    """获取备份历史（按创建时间倒序）
+
+    传入page时按页码分页并返回total、pages和current_page；否则使用游标分页，
+    翻页时传入上一页返回的next_cursor
+    """
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
-        
-        tasks = BackupTask.query.order_by(BackupTask.created_at.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
-        )
+        per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+        page = request.args.get('page', type=int)
+        cursor = request.args.get('cursor')
+        
+        query = db.session.query(
+            BackupTask.id, BackupTask.backup_command, BackupTask.status, BackupTask.created_at,
+            BackupTask.started_at, BackupTask.completed_at, Device.alias
+        ).outerjoin(Device, BackupTask.device_id == Device.id)
+        if page is not None and not cursor:
+            page = max(page, 1)
+            tasks = query.order_by(BackupTask.created_at.desc(), BackupTask.id.desc()) \
+                .limit(per_page).offset((page - 1) * per_page).all()
+            next_cursor = None
+        else:
+            tasks, next_cursor = keyset_page(query, BackupTask.created_at, BackupTask.id, cursor, per_page)
         
         history = []
-        for task in tasks.items:
-            device = Device.query.get(task.device_id)
+        for task in tasks:
             history.append({
                 'id': task.id,
-                'device_alias': device.alias if device else '未知设备',
+                'device_alias': task.alias or '未知设备',
                 'backup_command': task.backup_command,
                 'status': task.status,
                 'created_at': task.created_at.isoformat(),
-                'duration': task.get_duration()
+                'duration': (task.completed_at - task.started_at).total_seconds()
+                            if task.started_at and task.completed_at else None
             })
         
-        return jsonify({
+        if page is not None and not cursor:
+            total = BackupTask.query.count()
+            return jsonify({
+                'success': True,
+                'tasks': history,
+                'total': total,
+                'pages': (total + per_page - 1) // per_page,
+                'current_page': page
+            })
+        
+        result = {
             'success': True,
             'tasks': history,
-            'total': tasks.total,
-            'pages': tasks.pages,
-            'current_page': page
-        })
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None
+        }
+        if request.args.get('include_total', 'false').lower() == 'true':
+            result['total'], result['total_exact'] = approximate_total(BackupTask.query, BackupTask.id)
+        return jsonify(result)
         
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
     except Exception as e:
         return jsonify({
             'success': False,
@@ -1360,13 +1783,35 @@ def compare_backups():
                 'error': '备份任务不存在'
             }), 404
         
-        # 这里实现配置对比逻辑
-        # 暂时返回模拟结果
+        diff_result = backup_service.compare_backups(
+            first_task, second_task,
+            ignore_whitespace=bool(ignore_whitespace), ignore_case=bool(ignore_case)
+        )
+        if diff_result is None:
+            return jsonify({
+                'success': False,
+                'error': '备份文件不存在'
+            }), 404
+        
+        # 差异明细：修改的行两侧都标记为修改
+        diff_details = []
+        for block in diff_result['diff_blocks']:
+            for change in block['changes']:
+                if change['type'] == 'context':
+                    continue
+                diff_details.append({
+                    'line_number': change.get('new_line', change.get('old_line')),
+                    'type': 'modified' if change.get('modified') else change['type'],
+                    'content': change['content'],
+                    'section': block.get('section')
+                })
+        
         result = {
-            'differences': 0,
+            'differences': diff_result['summary']['total_changes'],
             'first_backup_time': first_task.created_at.isoformat(),
             'second_backup_time': second_task.created_at.isoformat(),
-            'diff_details': []
+            'summary': diff_result['summary'],
+            'diff_details': diff_details
         }
         
         return jsonify({
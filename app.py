@@ -29,6 +29,8 @@ from device_manager import DeviceManager
 from backup_service import BackupService
 from scheduler import BackupScheduler
 from task_scheduler import task_scheduler
+from schema_migrations import upgrade_schema
+from db_engine import engine_options, configure_engine
 
 # 配置日志
 logging.basicConfig(
@@ -49,6 +51,7 @@ def create_app():
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///backup_system.db')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
     
     # 文件上传配置
     app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB
@@ -61,6 +64,8 @@ def create_app():
     
     # 初始化扩展
     db.init_app(app)
+    with app.app_context():
+        configure_engine(db.engine)
     migrate = Migrate(app, db)
     
     # 初始化登录管理器
@@ -160,7 +165,7 @@ def compare():
 
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        upgrade_schema()
         # 创建默认管理员用户
         if not User.query.filter_by(username='admin').first():
             admin = User(
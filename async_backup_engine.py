@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+异步备份引擎
+基于asyncssh在单个事件循环中并发执行大量设备备份
+"""
+
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+from device_manager import (decrypt_password, build_prompt_pattern, read_idle_timeout,
+                            PromptReader, END_TRAILER_GRACE)
+
+logger = logging.getLogger(__name__)
+
+# 登录后的首个提示符：主机名后跟 > 或 #
+PROMPT_PATTERN = re.compile(r'^([\w.\-@/:]+)(\([\w.\-]+\))?[>#]\s*$')
+
+def is_available() -> bool:
+    """是否安装了asyncssh"""
+    return asyncssh is not None
+
+class AsyncBackupEngine:
+    """异步备份引擎
+
+    在独立线程中运行一个事件循环，所有设备会话都是该循环中的协程。
+    信号量限制同时在线的会话数，排队中的任务只占用一个挂起的协程，
+    因此单进程可以同时维持数百个会话且内存占用有上限。
+    数据库和文件操作通过小线程池执行，避免阻塞事件循环。
+    """
+
+    def __init__(self, backup_service, max_sessions: int = 200,
+                 connect_timeout: int = 60, command_timeout: int = 300,
+                 db_workers: int = 4, known_hosts: str = '~/.ssh/known_hosts'):
+        if asyncssh is None:
+            raise RuntimeError('未安装asyncssh，无法使用异步备份引擎')
+
+        self.backup_service = backup_service
+        self.max_sessions = max_sessions  # 同时在线的最大会话数
+        self.connect_timeout = connect_timeout
+        self.command_timeout = command_timeout  # 单条命令的总超时时间（秒）
+        # 校验设备主机密钥的known_hosts文件，为空或none时不校验
+        if not known_hosts or known_hosts.lower() == 'none':
+            self.known_hosts = None
+            logger.warning("异步备份引擎未启用SSH主机密钥校验")
+        else:
+            self.known_hosts = os.path.expanduser(known_hosts)
+        self.db_executor = ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix='async-backup-db')
+        self.loop = None
+        self._semaphore = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """启动事件循环线程"""
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return
+
+            ready = threading.Event()
+
+            def run_loop():
+                self.loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(self.loop)
+                self._semaphore = asyncio.Semaphore(self.max_sessions)
+                ready.set()
+                self.loop.run_forever()
+
+            self._thread = threading.Thread(target=run_loop, name='async-backup-loop', daemon=True)
+            self._thread.start()
+            ready.wait()
+            logger.info(f"异步备份引擎已启动，最大并发会话数: {self.max_sessions}")
+
+    def shutdown(self):
+        """停止事件循环"""
+        if self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self.db_executor.shutdown(wait=False)
+
+    def submit(self, job):
+        """提交备份作业（BackupJob），返回concurrent.futures.Future"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(self._run_task(job), self.loop)
+
+    async def _run_task(self, job):
+        """执行单个备份作业，任何阶段出错都将任务标记为失败（结果Future无人读取，异常不能留在其中）"""
+        task_id = job.task_id
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            try:
+                await self._execute(loop, job)
+            except Exception as e:
+                logger.error(f"异步备份任务 {task_id} 失败: {str(e)}")
+                try:
+                    await loop.run_in_executor(self.db_executor, self.backup_service._fail_backup, task_id, str(e))
+                except Exception as fail_error:
+                    logger.error(f"标记任务 {task_id} 失败时出错: {str(fail_error)}")
+
+    async def _execute(self, loop, job):
+        """准备、登录设备采集并记录结果"""
+        task_id = job.task_id
+        marker_command, known_marker = await loop.run_in_executor(
+            self.db_executor, self.backup_service._prepare_async_backup, job)
+        captured = await self._capture_or_fail(loop, job, marker_command, known_marker)
+        if captured is None:
+            return
+        results, marker = captured
+        if results is None:
+            if await loop.run_in_executor(self.db_executor, self.backup_service._complete_unchanged,
+                                          task_id, marker):
+                return
+            # 上次的备份对象已不存在，与线程池引擎一样重新完整备份
+            captured = await self._capture_or_fail(loop, job)
+            if captured is None:
+                return
+            results = captured[0]
+
+        await loop.run_in_executor(self.db_executor, self.backup_service._complete_backup,
+                                   task_id, results, marker)
+
+    async def _capture_or_fail(self, loop, job, marker_command: str = None, known_marker: str = None):
+        """采集设备输出，会话失败时将任务标记为失败并返回None"""
+        try:
+            return await self._capture(job.device_info(), list(job.commands), marker_command, known_marker)
+        except Exception as e:
+            logger.error(f"异步备份任务 {job.task_id} 失败: {str(e)}")
+            await loop.run_in_executor(self.db_executor, self.backup_service._fail_backup,
+                                       job.task_id, f'设备会话失败: {str(e)}')
+            return None
+
+    async def _capture(self, device_info: Dict[str, Any], commands: List[str],
+                       marker_command: str = None, known_marker: str = None):
+        """登录设备并依次执行命令，输出流式写入对象存储暂存区
+
+        返回(命令结果列表, 配置变更标记)；标记与known_marker相同时不执行命令，结果列表为None
+        """
+        password = decrypt_password(device_info.get('password_encrypted'))
+        enable_password = None
+        if device_info.get('enable_password_encrypted'):
+            enable_password = decrypt_password(device_info.get('enable_password_encrypted'))
+
+        conn = await asyncio.wait_for(
+            asyncssh.connect(
+                device_info.get('ip_address'),
+                port=int(device_info.get('port') or 22),
+                username=device_info.get('username'),
+                password=password,
+                known_hosts=self.known_hosts,
+                client_keys=None
+            ),
+            timeout=self.connect_timeout
+        )
+
+        async with conn:
+            process = await conn.create_process(term_type='vt100', term_size=(511, 24))
+            try:
+                process.stdin.write('\n')
+                prompt = await self._read_first_prompt(process)
+                # 之后只认当前设备的主机名提示符，避免配置内容误判
+                device_prompt = build_prompt_pattern(PROMPT_PATTERN.match(prompt).group(1))
+
+                if prompt.endswith('>') and enable_password:
+                    await self._send(process, 'enable', re.compile(r'^.*[Pp]assword:\s*$'))
+                    process.stdin.write(enable_password + '\n')
+                    await self._send(process, '', device_prompt)
+
+                for setup in ('terminal length 0', 'terminal width 511'):
+                    await self._send(process, setup, device_prompt)
+
+                marker = None
+                if marker_command:
+                    output = await self._send(process, marker_command, device_prompt)
+                    marker = self.backup_service._parse_change_marker({'success': True, 'output': output})
+                    if marker and marker == known_marker:
+                        process.stdin.write('exit\n')
+                        return None, marker
+
+                results = []
+                session_error = None
+                for command in commands:
+                    if session_error:
+                        results.append({'success': False, 'error': session_error})
+                        continue
+
+                    sink = self.backup_service.object_store.open_sink()
+                    try:
+                        await self._send(process, command, device_prompt, on_output=sink.write)
+                        sink.finish()
+                    except Exception as e:
+                        sink.abort()
+                        session_error = str(e)
+                        results.append({'success': False, 'error': session_error})
+                        continue
+
+                    results.append({'success': True, 'error': None, 'sink': sink})
+
+                if not session_error:
+                    process.stdin.write('exit\n')
+                return results, marker
+            finally:
+                process.close()
+
+    async def _read_first_prompt(self, process) -> str:
+        """读取登录后的第一个提示符"""
+        deadline = time.monotonic() + self.connect_timeout
+        buffer = ''
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError('等待设备提示符超时')
+            data = await asyncio.wait_for(process.stdout.read(65536), timeout=remaining)
+            if not data:
+                raise ConnectionError('设备会话已关闭')
+            buffer = (buffer + data.replace('\r', ''))[-1024:]
+            last_line = buffer.rsplit('\n', 1)[-1].strip()
+            if PROMPT_PATTERN.match(last_line):
+                return last_line
+
+    async def _send(self, process, command: str, pattern, on_output=None) -> str:
+        """发送命令并读取输出，检测到提示符或配置结尾时立即返回
+
+        空闲超时随已接收的输出量增长；指定on_output时输出流式交给回调
+        """
+        reader = PromptReader(command, pattern, on_output)
+        if command:
+            process.stdin.write(command + '\n')
+        else:
+            # 不回显的输入（如enable密码）无需等待回显
+            reader.echo_seen = True
+
+        start = time.monotonic()
+        while True:
+            remaining = start + self.command_timeout - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f'命令 {command} 执行超过 {self.command_timeout} 秒')
+
+            wait = END_TRAILER_GRACE if reader.saw_end_trailer else read_idle_timeout(reader.bytes_received)
+            try:
+                data = await asyncio.wait_for(process.stdout.read(65536), timeout=min(wait, remaining))
+            except asyncio.TimeoutError:
+                if reader.saw_end_trailer:
+                    return reader.finish()
+                raise TimeoutError(f'命令 {command} 在 {wait:.0f} 秒内没有新的输出')
+
+            if not data:
+                raise ConnectionError('设备会话已关闭')
+            if reader.feed(data):
+                return reader.finish()
+            if reader.more_prompt:
+                process.stdin.write(' ')
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+备份作业描述
+创建任务时一次性生成，备份引擎执行时不再重新查询任务和设备
+"""
+
+from dataclasses import dataclass
+from typing import Dict, Any, Optional, Tuple
+
+@dataclass(frozen=True)
+class BackupJob:
+    """不可变的备份作业描述"""
+    task_id: int
+    device_id: int
+    ip_address: str
+    port: int
+    protocol: str
+    device_type: str
+    username: str
+    password_encrypted: str
+    enable_password_encrypted: Optional[str]
+    backup_command: str  # 任务记录中的备份命令（命令集模式为拼接后的摘要）
+    commands: Tuple[str, ...]  # 需要依次执行的命令
+    command_set: bool  # 是否为命令集模式
+    config_change_marker: Optional[str]  # 创建任务时设备上保存的配置变更标记
+
+    @classmethod
+    def build(cls, task_id: int, device, backup_command: str, commands=None) -> 'BackupJob':
+        """根据设备记录生成作业，commands非空时为命令集模式"""
+        commands = tuple(commands or ())
+        return cls(
+            task_id=task_id,
+            device_id=device.id,
+            ip_address=device.ip_address,
+            port=device.port,
+            protocol=device.protocol,
+            device_type=device.device_type,
+            username=device.username,
+            password_encrypted=device.password_encrypted,
+            enable_password_encrypted=device.enable_password_encrypted,
+            backup_command=backup_command,
+            commands=commands or (backup_command,),
+            command_set=bool(commands),
+            config_change_marker=device.config_change_marker
+        )
+
+    def device_info(self) -> Dict[str, Any]:
+        """设备连接信息（DeviceManager使用的格式）"""
+        return {
+            'id': self.device_id,
+            'ip_address': self.ip_address,
+            'username': self.username,
+            'password_encrypted': self.password_encrypted,
+            'enable_password_encrypted': self.enable_password_encrypted,
+            'device_type': self.device_type,
+            'port': self.port,
+            'protocol': self.protocol
+        }
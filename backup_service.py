@@ -5,11 +5,11 @@
 负责执行设备配置备份、文件存储、差异比较等功能
 """
 
-import os
+import re
+import codecs
 import hashlib
-import gzip
-import shutil
-import difflib
+import json
+from array import array
 from datetime import datetime
 from pathlib import Path
 from typing import Dict, Any, Optional, List
@@ -17,11 +17,40 @@ import logging
 import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from models import db, Device, BackupTask, BackupLog
+from sqlalchemy import insert
+
+from config import Config
+from models import db, Device, BackupTask, BackupArtifact, ConfigChange
 from device_manager import DeviceManager
+from backup_storage import ObjectStore, read_file_bytes
+from disk_cache import DiskCache
+from config_sections import diff_sections
+from backup_job import BackupJob
+from batch_scheduler import AdaptiveBatchScheduler, build_jobs
+from task_event_writer import task_event_writer
+import backup_statistics
+import async_backup_engine
+import config_search
 
 logger = logging.getLogger(__name__)
 
+# 所有BackupService实例共享同一个对象存储
+object_store = ObjectStore(Path('backups') / 'objects')
+
+# 还原后的备份内容、行偏移索引和差异结果的缓存（都按内容哈希寻址，缓存不会过期）
+content_cache = DiskCache(Path(Config.CACHE_DIR), Config.CACHE_MAX_SIZE_MB * 1024 * 1024)
+
+IN_QUERY_CHUNK = 500  # 批量IN查询每次的ID数量
+CONTENT_BLOCK_SIZE = 1024 * 1024  # 扫描备份内容时每次读取的字节数
+DIFF_CACHE_VERSION = 1  # 差异结果的格式变化时递增，旧格式的缓存不再命中
+
+# 获取配置变更标记的命令，标记未变化时跳过完整的running-config传输
+CHANGE_MARKER_COMMANDS = {
+    'cisco_ios': 'show running-config | include Last configuration change',
+    'cisco_xe': 'show running-config | include Last configuration change',
+}
+CHANGE_MARKER_PATTERN = re.compile(r'Last configuration change at .+')
+
 class BackupService:
     """备份服务类"""
     
@@ -29,12 +58,50 @@ class BackupService:
         self.device_manager = DeviceManager()
         self.backup_base_path = Path('backups')
         self.backup_base_path.mkdir(exist_ok=True)
-        self.executor = ThreadPoolExecutor(max_workers=10)
+        self.object_store = object_store
+        self.content_cache = content_cache
+        self.event_writer = task_event_writer
+        self.skip_unchanged = Config.BACKUP_SKIP_UNCHANGED
+        self.executor = ThreadPoolExecutor(max_workers=Config.MAX_CONCURRENT_BACKUPS)
+        
+        # 备份引擎：thread（默认，netmiko线程池）或 asyncio（asyncssh事件循环）
+        self.engine = Config.BACKUP_ENGINE
+        self.async_engine = None
+        if self.engine == 'asyncio':
+            if async_backup_engine.is_available():
+                self.async_engine = async_backup_engine.AsyncBackupEngine(
+                    self,
+                    max_sessions=Config.ASYNC_BACKUP_MAX_SESSIONS,
+                    command_timeout=Config.BACKUP_TIMEOUT,
+                    known_hosts=Config.SSH_KNOWN_HOSTS
+                )
+            else:
+                logger.warning("未安装asyncssh，回退到线程池备份引擎")
+        
+        # 批量备份的并发上限默认与备份引擎的容量一致
+        default_parallel = self.async_engine.max_sessions if self.async_engine else self.executor._max_workers
+        self.batch_max_parallel = Config.BATCH_MAX_PARALLEL or default_parallel
+        self.batch_initial_parallel = Config.BATCH_INITIAL_PARALLEL
+        self.batch_site_max_parallel = Config.BATCH_SITE_MAX_PARALLEL
+    
+    def _submit(self, job: BackupJob):
+        """按配置的备份引擎提交作业，返回在备份结束时完成的Future
+
+        异步引擎只支持SSH，Telnet设备始终由线程池执行
+        """
+        if self.async_engine and (job.protocol or 'ssh').lower() != 'telnet':
+            return self.async_engine.submit(job)
+        return self.executor.submit(self._run_job, job)
     
     def backup_single_device(self, device_id: int, user_id: int, 
                            backup_command: str = None, 
-                           task_type: str = 'manual') -> Dict[str, Any]:
-        """备份单个设备"""
+                           task_type: str = 'manual',
+                           backup_commands: List[str] = None) -> Dict[str, Any]:
+        """备份单个设备
+
+        传入backup_commands时以命令集模式在同一会话中依次执行，
+        每条命令的输出保存为独立的备份产物
+        """
         try:
             # 获取设备信息
             device = Device.query.get(device_id)
@@ -46,19 +113,12 @@ class BackupService:
                 }
             
             # 创建备份任务
-            task = BackupTask(
-                device_id=device_id,
-                user_id=user_id,
-                task_type=task_type,
-                status='pending',
-                backup_command=backup_command or device.backup_command,
-                max_retries=3
-            )
-            db.session.add(task)
+            task = self._create_task(device, user_id, task_type, backup_command, backup_commands)
             db.session.commit()
             
             # 异步执行备份
-            future = self.executor.submit(self._execute_backup, task.id)
+            future = self._submit(BackupJob.build(task.id, device, task.backup_command,
+                                                  self._clean_commands(backup_commands)))
             
             return {
                 'success': True,
@@ -76,42 +136,40 @@ class BackupService:
     
     def backup_multiple_devices(self, device_ids: List[int], user_id: int,
                                backup_command: str = None,
-                               task_type: str = 'batch') -> Dict[str, Any]:
-        """批量备份设备"""
+                               task_type: str = 'batch',
+                               backup_commands: List[str] = None) -> Dict[str, Any]:
+        """批量备份设备
+
+        设备用IN查询批量加载，任务和产物记录批量插入，
+        生成的作业描述直接交给调度器，执行时不再重新查询
+        """
         try:
-            tasks = []
-            
-            # 为每个设备创建备份任务
-            for device_id in device_ids:
-                device = Device.query.get(device_id)
-                if device and device.is_active:
-                    task = BackupTask(
-                        device_id=device_id,
-                        user_id=user_id,
-                        task_type=task_type,
-                        status='pending',
-                        backup_command=backup_command or device.backup_command,
-                        max_retries=3
-                    )
-                    db.session.add(task)
-                    tasks.append(task)
-            
+            devices = self._load_active_devices(device_ids)
+            jobs = self._create_tasks_bulk(devices, user_id, task_type, backup_command, backup_commands)
+            # 提交前生成调度信息：出错时任务随事务回滚，不会留下永远等待执行的任务
+            scheduled = build_jobs(jobs) if jobs else []
             db.session.commit()
             
-            # 异步执行所有备份任务
-            futures = []
-            for task in tasks:
-                future = self.executor.submit(self._execute_backup, task.id)
-                futures.append(future)
+            # 由自适应调度器按设备历史耗时和站点分组逐步提交任务
+            if scheduled:
+                scheduler = AdaptiveBatchScheduler(
+                    self._submit, self._task_outcome, self._fail_backup,
+                    max_parallel=self.batch_max_parallel,
+                    initial_parallel=self.batch_initial_parallel,
+                    site_max_parallel=self.batch_site_max_parallel
+                )
+                threading.Thread(target=scheduler.run, args=(scheduled,),
+                                 name='batch-backup-scheduler', daemon=True).start()
             
             return {
                 'success': True,
-                'task_count': len(tasks),
-                'task_ids': [task.id for task in tasks],
-                'message': f'已提交 {len(tasks)} 个备份任务'
+                'task_count': len(jobs),
+                'task_ids': [job.task_id for job in jobs],
+                'message': f'已提交 {len(jobs)} 个备份任务'
             }
             
         except Exception as e:
+            db.session.rollback()
             logger.error(f"批量备份失败: {str(e)}")
             return {
                 'success': False,
@@ -119,91 +177,405 @@ class BackupService:
                 'task_count': 0
             }
     
+    def _task_outcome(self, task_id: int) -> Optional[bool]:
+        """查询任务结果（供批量调度器调用）：True成功，False失败，None未完成"""
+        from app import app
+        
+        with app.app_context():
+            task = BackupTask.query.get(task_id)
+            if not task or task.status not in ('success', 'failed'):
+                return None
+            return task.status == 'success'
+    
+    def _load_active_devices(self, device_ids: List[int]) -> List[Device]:
+        """用IN查询批量加载启用的设备，保持传入的顺序"""
+        devices = {}
+        unique_ids = list(dict.fromkeys(device_ids))
+        for start in range(0, len(unique_ids), IN_QUERY_CHUNK):
+            chunk = unique_ids[start:start + IN_QUERY_CHUNK]
+            for device in Device.query.filter(Device.id.in_(chunk), Device.is_active == True).all():
+                devices[device.id] = device
+        return [devices[device_id] for device_id in unique_ids if device_id in devices]
+    
+    def _create_tasks_bulk(self, devices: List[Device], user_id: int, task_type: str,
+                           backup_command: str = None, backup_commands: List[str] = None) -> List[BackupJob]:
+        """批量插入备份任务（命令集模式同时插入产物记录），返回各任务的作业描述
+
+        不提交事务，由调用方在生成调度信息后提交
+        """
+        if not devices:
+            return []
+        
+        commands = self._clean_commands(backup_commands)
+        task_commands = [('; '.join(commands)[:200] if commands else backup_command or device.backup_command)
+                         for device in devices]
+        rows = [{
+            'device_id': device.id,
+            'user_id': user_id,
+            'task_type': task_type,
+            'status': 'pending',
+            'backup_command': command,
+            'max_retries': 3
+        } for device, command in zip(devices, task_commands)]
+        
+        # 按设备ID对应返回的任务ID（同一批次中设备不重复），SQLite的RETURNING不保证顺序
+        result = db.session.execute(insert(BackupTask).returning(BackupTask.id, BackupTask.device_id), rows)
+        task_ids = {device_id: task_id for task_id, device_id in result}
+        
+        if commands:
+            db.session.execute(insert(BackupArtifact), [
+                {'task_id': task_id, 'sequence': sequence, 'command': command, 'status': 'pending'}
+                for task_id in task_ids.values() for sequence, command in enumerate(commands)
+            ])
+        
+        # 提交前生成作业描述，避免提交后访问设备属性逐个刷新
+        jobs = [BackupJob.build(task_ids[device.id], device, command, commands)
+                for device, command in zip(devices, task_commands)]
+        backup_statistics.record_tasks_created(len(task_ids))
+        return jobs
+    
+    def _clean_commands(self, backup_commands: List[str] = None) -> List[str]:
+        """去除命令集中的空命令"""
+        return [cmd.strip() for cmd in (backup_commands or []) if cmd and cmd.strip()]
+    
+    def _create_task(self, device: Device, user_id: int, task_type: str,
+                     backup_command: str = None, backup_commands: List[str] = None) -> BackupTask:
+        """创建备份任务，命令集模式下同时创建各命令的备份产物记录"""
+        commands = self._clean_commands(backup_commands)
+        
+        task = BackupTask(
+            device_id=device.id,
+            user_id=user_id,
+            task_type=task_type,
+            status='pending',
+            backup_command=('; '.join(commands)[:200] if commands
+                            else backup_command or device.backup_command),
+            max_retries=3
+        )
+        db.session.add(task)
+        
+        for sequence, command in enumerate(commands):
+            task.artifacts.append(BackupArtifact(sequence=sequence, command=command, status='pending'))
+        
+        return task
+    
     def _execute_backup(self, task_id: int):
-        """执行备份任务"""
+        """按任务ID执行备份（兼容旧的调用方式，先加载作业描述）"""
+        from app import app
+        
+        with app.app_context():
+            job = self._load_job(task_id)
+        if job:
+            self._run_job(job)
+    
+    def _run_job(self, job: BackupJob):
+        """执行备份作业"""
         from app import app
         
         with app.app_context():
-            logger.info(f"开始执行备份任务 {task_id}")
+            logger.info(f"开始执行备份任务 {job.task_id}")
+            connection = None
+            connection_ok = False
+            results = []
             try:
-                task = BackupTask.query.get(task_id)
-                if not task:
-                    logger.error(f"任务 {task_id} 不存在")
-                    return
+                self._start_job(job)
                 
-                device = task.device
-                if not device:
-                    logger.error(f"任务 {task_id} 的设备不存在")
-                    self._update_task_status(task, 'failed', '设备不存在')
-                    return
-                    
-                logger.info(f"任务 {task_id} 开始备份设备 {device.ip_address}")
-                
-                # 更新任务状态
-                self._update_task_status(task, 'running')
-                self._log_task(task, 'info', f'开始备份设备 {device.ip_address}')
-                
-                # 获取设备连接
-                device_info = {
-                    'id': device.id,
-                    'ip_address': device.ip_address,
-                    'username': device.username,
-                    'password_encrypted': device.password_encrypted,
-                    'enable_password_encrypted': device.enable_password_encrypted,
-                    'device_type': device.device_type,
-                    'port': device.port,
-                    'protocol': device.protocol
-                }
-                
-                connection = self.device_manager.get_connection(device_info)
+                connection = self.device_manager.get_connection(job.device_info())
                 if not connection:
-                    self._update_task_status(task, 'failed', '无法建立设备连接')
+                    self._fail_task(job.task_id, '无法建立设备连接')
                     return
                 
-                # 执行备份命令
-                result = connection.execute_command(task.backup_command)
-                if not result['success']:
-                    self._update_task_status(task, 'failed', f"命令执行失败: {result['error']}")
-                    return
+                # 先获取配置变更标记，配置未变化时不再传输完整配置
+                marker = None
+                marker_command = self._change_marker_command(job)
+                if marker_command:
+                    marker = self._parse_change_marker(connection.execute_command(marker_command))
+                    if marker and marker == job.config_change_marker and self._record_unchanged(job, marker):
+                        connection_ok = True
+                        return
                 
-                # 生成备份文件路径
-                file_path = self._generate_backup_path(device, task)
-                
-                # 保存备份文件
-                backup_content = result['output']
-                if not self._save_backup_file(file_path, backup_content):
-                    self._update_task_status(task, 'failed', '保存备份文件失败')
-                    return
-                
-                # 计算文件哈希
-                file_hash = self._calculate_file_hash(file_path)
-                file_size = os.path.getsize(file_path)
-                
-                # 更新任务状态
-                task.status = 'success'
-                task.file_path = str(file_path)
-                task.file_size = file_size
-                task.file_hash = file_hash
-                task.completed_at = datetime.utcnow()
+                # 同一会话中依次执行任务的所有命令，输出直接流式写入对象存储暂存区
+                results = [self._capture_to_file(connection, command) for command in job.commands]
+                connection_ok = all(result['success'] for result in results)
                 
-                # 更新设备最后备份信息
-                device.last_backup = datetime.utcnow()
-                device.last_backup_status = 'success'
-                
-                db.session.commit()
-                
-                self._log_task(task, 'info', f'备份完成，文件大小: {file_size} 字节')
-                
-                # 执行差异比较
-                self._compare_with_previous_backup(device, file_path)
+                self._record_job(job.task_id, results, marker)
                 
             except Exception as e:
-                logger.error(f"执行备份任务 {task_id} 失败: {str(e)}")
-                self._update_task_status(task, 'failed', str(e))
+                logger.error(f"执行备份任务 {job.task_id} 失败: {str(e)}")
+                self._discard_results(results)
+                self._fail_task(job.task_id, str(e))
             finally:
-                # 释放设备连接
-                if 'device' in locals() and device:
-                    self.device_manager.release_connection(device.id)
+                # 归还设备连接，会话异常时丢弃
+                if connection:
+                    self.device_manager.release_connection(connection, discard=not connection_ok)
+    
+    def _load_job(self, task_id: int) -> Optional[BackupJob]:
+        """从数据库加载任务并生成作业描述"""
+        task = BackupTask.query.get(task_id)
+        if not task:
+            logger.error(f"任务 {task_id} 不存在")
+            return None
+        
+        device = task.device
+        if not device:
+            logger.error(f"任务 {task_id} 的设备不存在")
+            self._update_task_status(task, 'failed', '设备不存在')
+            return None
+        
+        commands = [artifact.command for artifact in task.artifacts]
+        return BackupJob.build(task.id, device, task.backup_command, commands)
+    
+    def _start_job(self, job: BackupJob):
+        """将任务标记为运行中（由后台写入线程批量写入，不加载任务记录）"""
+        logger.info(f"任务 {job.task_id} 开始备份设备 {job.ip_address}")
+        self.event_writer.task_started(job.task_id)
+        self.event_writer.log(job.task_id, 'info', f'开始备份设备 {job.ip_address}')
+    
+    def _fail_task(self, task_id: int, error_message: str):
+        """将任务标记为失败"""
+        task = BackupTask.query.get(task_id)
+        if task:
+            self._update_task_status(task, 'failed', error_message)
+    
+    def _capture_to_file(self, connection, command: str) -> Dict[str, Any]:
+        """执行命令并将输出流式写入暂存文件，由_record_results入库"""
+        sink = self.object_store.open_sink()
+        try:
+            result = connection.execute_command(command, on_output=sink.write)
+            if not result['success']:
+                sink.abort()
+                return {'success': False, 'error': result['error']}
+            
+            sink.finish()
+            return {'success': True, 'error': None, 'sink': sink}
+        except Exception as e:
+            sink.abort()
+            logger.error(f"保存备份文件失败: {str(e)}")
+            return {'success': False, 'error': f'保存备份文件失败: {str(e)}'}
+    
+    def _prepare_async_backup(self, job: BackupJob):
+        """异步引擎的准备阶段，返回(变更标记命令, 可沿用的变更标记)"""
+        from app import app
+        
+        with app.app_context():
+            self._start_job(job)
+            marker_command = self._change_marker_command(job)
+            known_marker = None
+            if marker_command and job.config_change_marker and self._unchanged_source(job):
+                known_marker = job.config_change_marker
+            return marker_command, known_marker
+    
+    def _complete_backup(self, task_id: int, results: List[Dict[str, Any]], marker: str = None):
+        """在新的应用上下文中记录命令结果（供异步引擎调用）"""
+        from app import app
+        
+        with app.app_context():
+            try:
+                self._record_job(task_id, results, marker)
+            except Exception as e:
+                self._discard_results(results)
+                logger.error(f"执行备份任务 {task_id} 失败: {str(e)}")
+                self._fail_task(task_id, str(e))
+    
+    def _complete_unchanged(self, task_id: int, marker: str) -> bool:
+        """变更标记未变化时沿用上次的备份（供异步引擎调用），无法沿用时返回False，由调用方完整备份"""
+        from app import app
+        
+        with app.app_context():
+            task = BackupTask.query.get(task_id)
+            if not task:
+                logger.error(f"任务 {task_id} 不存在")
+                return True
+            return self._record_unchanged(BackupJob.build(task.id, task.device, task.backup_command), marker)
+    
+    def _record_job(self, task_id: int, results: List[Dict[str, Any]], marker: str = None):
+        """加载任务记录并保存命令结果"""
+        task = BackupTask.query.get(task_id)
+        if not task:
+            logger.error(f"任务 {task_id} 不存在")
+            self._discard_results(results)
+            return
+        self._record_results(task, task.device, results, marker)
+    
+    def _fail_backup(self, task_id: int, error_message: str):
+        """在新的应用上下文中将任务标记为失败（供异步引擎和批量调度器调用）"""
+        from app import app
+        
+        with app.app_context():
+            self._fail_task(task_id, error_message)
+    
+    def _record_results(self, task: BackupTask, device: Device, results: List[Dict[str, Any]],
+                        marker: str = None):
+        """将命令输出存入对象存储并更新任务状态
+
+        内容相同的备份共享同一个对象文件，任务只记录对象路径和哈希；
+        marker为备份前获取的配置变更标记，备份成功后保存到设备上
+        """
+        artifacts = task.artifacts.all()
+        if artifacts:
+            # 命令集模式：每条命令的输出保存为独立产物
+            file_path, file_size, file_hash = self._store_command_set(task, device, artifacts, results)
+            if not file_path:
+                return
+        else:
+            result = results[0]
+            if not result['success']:
+                self._update_task_status(task, 'failed', f"命令执行失败: {result['error']}")
+                return
+            
+            obj = self.object_store.commit(result['sink'],
+                                           self._previous_object_hash(device, task, task.backup_command))
+            file_path = Path(obj.file_path)
+            file_size = obj.content_size
+            file_hash = obj.file_hash
+        
+        # 更新任务状态
+        task.status = 'success'
+        task.file_path = str(file_path)
+        task.file_size = file_size
+        task.file_hash = file_hash
+        task.completed_at = datetime.utcnow()
+        
+        # 更新设备最后备份信息
+        device.last_backup = datetime.utcnow()
+        device.last_backup_status = 'success'
+        if marker:
+            device.config_change_marker = marker
+        
+        db.session.commit()
+        
+        self._log_task(task, 'info', f'备份完成，文件大小: {file_size} 字节')
+        
+        # 执行差异比较
+        self._compare_with_previous_backup(device, task)
+        self._index_backup(task)
+    
+    def _store_command_set(self, task: BackupTask, device: Device,
+                           artifacts: List[BackupArtifact], results: List[Dict[str, Any]]):
+        """记录命令集各命令的结果，返回主文件的(路径, 大小, 哈希)
+
+        第一条命令的输出作为任务的主备份文件，用于差异比较和下载
+        """
+        # 先将所有输出存入对象存储，再修改产物记录：对象存储持有进程内锁，
+        # 调用时会话中不能有未提交的修改，否则与其他工作线程互相等待SQLite写锁
+        objects = [self.object_store.commit(result['sink'], self._previous_object_hash(device, task, artifact.command))
+                   if result['success'] else None
+                   for artifact, result in zip(artifacts, results)]
+        if all(objects):
+            # 任务本身也引用主文件对象，删除任务时与各产物分别释放
+            self.object_store.acquire(objects[0].file_hash)
+        
+        failed_commands = []
+        for artifact, result, obj in zip(artifacts, results, objects):
+            artifact.completed_at = datetime.utcnow()
+            if not obj:
+                artifact.status = 'failed'
+                artifact.error_message = result['error']
+                failed_commands.append(artifact.command)
+                self._log_task(task, 'error', f"命令 {artifact.command} 执行失败: {result['error']}")
+                continue
+            
+            artifact.status = 'success'
+            artifact.file_path = obj.file_path
+            artifact.file_size = obj.content_size
+            artifact.file_hash = obj.file_hash
+            self._log_task(task, 'info', f'命令 {artifact.command} 备份完成，文件大小: {artifact.file_size} 字节')
+        
+        db.session.commit()
+        
+        if failed_commands:
+            self._update_task_status(task, 'failed', f"命令执行失败: {', '.join(failed_commands)}")
+            return None, None, None
+        
+        primary = artifacts[0]
+        return Path(primary.file_path), primary.file_size, primary.file_hash
+    
+    def _change_marker_command(self, job: BackupJob) -> Optional[str]:
+        """返回获取配置变更标记的命令，设备类型或备份命令不支持时返回None
+
+        标记只反映running-config，因此只用于单命令的running-config备份
+        """
+        if not self.skip_unchanged or job.command_set:
+            return None
+        if (job.backup_command or '').strip() not in ('show running-config', 'show run'):
+            return None
+        return CHANGE_MARKER_COMMANDS.get(job.device_type or 'cisco_ios')
+    
+    def _parse_change_marker(self, result: Dict[str, Any]) -> Optional[str]:
+        """从命令输出中提取配置变更标记"""
+        if not result.get('success'):
+            return None
+        match = CHANGE_MARKER_PATTERN.search(result.get('output') or '')
+        return match.group(0).strip()[:255] if match else None
+    
+    def _unchanged_source(self, job: BackupJob) -> Optional[BackupTask]:
+        """配置未变化时可沿用的上次完整备份，必须仍在对象存储中"""
+        previous_task = BackupTask.query.filter(
+            BackupTask.device_id == job.device_id,
+            BackupTask.status == 'success',
+            BackupTask.backup_command == job.backup_command,
+            BackupTask.file_hash.isnot(None),
+            BackupTask.id != job.task_id
+        ).order_by(BackupTask.completed_at.desc()).first()
+        if previous_task and self.object_store.exists(previous_task.file_hash):
+            return previous_task
+        return None
+    
+    def _record_unchanged(self, job: BackupJob, marker: str) -> bool:
+        """变更标记与上次相同时沿用上次的备份对象并标记任务成功，无法沿用时返回False"""
+        device = Device.query.get(job.device_id)
+        if not device or not marker or marker != device.config_change_marker:
+            return False
+        previous_task = self._unchanged_source(job)
+        if not previous_task:
+            return False
+        
+        task = BackupTask.query.get(job.task_id)
+        obj = self.object_store.acquire(previous_task.file_hash)
+        task.status = 'success'
+        task.unchanged = True
+        task.file_path = obj.file_path
+        task.file_size = previous_task.file_size
+        task.file_hash = previous_task.file_hash
+        task.completed_at = datetime.utcnow()
+        
+        device.last_backup = datetime.utcnow()
+        device.last_backup_status = 'success'
+        
+        db.session.commit()
+        
+        self._log_task(task, 'info', f'配置未变化（{marker}），沿用任务 {previous_task.id} 的备份')
+        return True
+    
+    def _previous_object_hash(self, device: Device, task: BackupTask, command: str) -> Optional[str]:
+        """同一设备同一命令上一次成功备份的对象哈希，作为差异存储的基准"""
+        previous_task = BackupTask.query.filter(
+            BackupTask.device_id == device.id,
+            BackupTask.status == 'success',
+            BackupTask.backup_command == command,
+            BackupTask.file_hash.isnot(None),
+            BackupTask.id != task.id
+        ).order_by(BackupTask.completed_at.desc()).first()
+        
+        previous_artifact = BackupArtifact.query.join(BackupTask).filter(
+            BackupTask.device_id == device.id,
+            BackupArtifact.status == 'success',
+            BackupArtifact.command == command,
+            BackupArtifact.file_hash.isnot(None),
+            BackupArtifact.task_id != task.id
+        ).order_by(BackupArtifact.completed_at.desc()).first()
+        
+        candidates = [record for record in (previous_task, previous_artifact) if record]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda record: record.completed_at or datetime.min).file_hash
+    
+    def _discard_results(self, results: List[Dict[str, Any]]):
+        """丢弃尚未入库的暂存文件"""
+        for result in results:
+            sink = result.get('sink')
+            if sink and sink.tmp_path.exists():
+                sink.abort()
     
     def _update_task_status(self, task: BackupTask, status: str, error_message: str = None):
         """更新任务状态"""
@@ -221,156 +593,313 @@ class BackupService:
             logger.error(f"更新任务状态失败: {str(e)}")
     
     def _log_task(self, task: BackupTask, level: str, message: str):
-        """记录任务日志"""
-        try:
-            log = BackupLog(
-                task_id=task.id,
-                level=level,
-                message=message
-            )
-            db.session.add(log)
-            db.session.commit()
-        except Exception as e:
-            logger.error(f"记录任务日志失败: {str(e)}")
-    
-    def _generate_backup_path(self, device: Device, task: BackupTask) -> Path:
-        """生成备份文件路径"""
-        # 使用设备别名或IP作为目录名
-        device_name = device.alias or device.ip_address.replace(':', '_')
-        device_dir = self.backup_base_path / device_name
-        device_dir.mkdir(exist_ok=True)
-        
-        # 生成文件名：YYYYMMDD_HHMMSS_sh_run.txt
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        command_name = task.backup_command.replace(' ', '_').replace('-', '_')
-        filename = f"{timestamp}_{command_name}.txt"
-        
-        return device_dir / filename
+        """记录任务日志（由后台写入线程批量写入）"""
+        self.event_writer.log(task.id, level, message)
     
-    def _save_backup_file(self, file_path: Path, content: str) -> bool:
-        """保存备份文件"""
+    def _compare_with_previous_backup(self, device: Device, task: BackupTask):
+        """与上次备份比较，有变化时记录配置变更"""
         try:
-            # 确保目录存在
-            file_path.parent.mkdir(parents=True, exist_ok=True)
-            
-            # 保存文件
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(content)
-            
-            # 可选：压缩文件
-            if os.environ.get('COMPRESS_BACKUPS', 'false').lower() == 'true':
-                compressed_path = file_path.with_suffix('.txt.gz')
-                with open(file_path, 'rb') as f_in:
-                    with gzip.open(compressed_path, 'wb') as f_out:
-                        shutil.copyfileobj(f_in, f_out)
-                os.remove(file_path)
-                file_path = compressed_path
-            
-            return True
-        except Exception as e:
-            logger.error(f"保存备份文件失败: {str(e)}")
-            return False
-    
-    def _calculate_file_hash(self, file_path: Path) -> str:
-        """计算文件SHA256哈希"""
-        try:
-            hash_sha256 = hashlib.sha256()
-            with open(file_path, 'rb') as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hash_sha256.update(chunk)
-            return hash_sha256.hexdigest()
-        except Exception as e:
-            logger.error(f"计算文件哈希失败: {str(e)}")
-            return ""
-    
-    def _compare_with_previous_backup(self, device: Device, current_file_path: Path):
-        """与上次备份进行比较"""
-        try:
-            # 查找设备的上次成功备份
+            # 查找设备同一备份命令的上次成功备份（其他命令的输出不能作为比较基准）
             previous_task = BackupTask.query.filter(
                 BackupTask.device_id == device.id,
                 BackupTask.status == 'success',
-                BackupTask.id != current_file_path.stem.split('_')[0]  # 排除当前任务
+                BackupTask.backup_command == task.backup_command,
+                BackupTask.id != task.id  # 排除当前任务
             ).order_by(BackupTask.completed_at.desc()).first()
             
             if not previous_task or not previous_task.file_path:
                 return
             
-            previous_file_path = Path(previous_task.file_path)
-            if not previous_file_path.exists():
+            # 哈希相同说明配置未变化（共享同一对象），无需比较
+            if previous_task.file_hash and previous_task.file_hash == task.file_hash:
                 return
             
-            # 读取文件内容进行比较
-            with open(current_file_path, 'r', encoding='utf-8') as f:
-                current_content = f.readlines()
-            
-            with open(previous_file_path, 'r', encoding='utf-8') as f:
-                previous_content = f.readlines()
-            
-            # 生成差异报告
-            diff = list(difflib.unified_diff(
-                previous_content,
-                current_content,
-                fromfile=f'previous_{previous_file_path.name}',
-                tofile=f'current_{current_file_path.name}',
-                lineterm=''
+            # 比较结果写入差异缓存（之后比较这两个版本时直接命中），统计和变化的配置段记录到数据库
+            result = self.compare_backups(previous_task, task)
+            if result is None or not result['summary']['has_changes']:
+                return
+            summary = result['summary']
+            sections = [{
+                'section': section['section'],
+                'status': section['status'],
+                'old_line': section['old_line'],
+                'new_line': section['new_line'],
+                'added_lines': section['summary']['added_lines'],
+                'removed_lines': section['summary']['removed_lines'],
+                'modified_lines': section['summary']['modified_lines']
+            } for section in result['sections']]
+            db.session.add(ConfigChange(
+                device_id=device.id,
+                task_id=task.id,
+                previous_task_id=previous_task.id,
+                added_lines=summary['added_lines'],
+                removed_lines=summary['removed_lines'],
+                modified_lines=summary['modified_lines'],
+                changed_sections=summary['changed_sections'],
+                old_line_count=summary['old_lines'],
+                new_line_count=summary['new_lines'],
+                sections=json.dumps(sections, ensure_ascii=False),
+                detected_at=task.completed_at or datetime.utcnow()
             ))
+            db.session.commit()
             
-            if diff:
-                # 保存差异报告
-                diff_file_path = current_file_path.with_suffix('.diff')
-                with open(diff_file_path, 'w', encoding='utf-8') as f:
-                    f.write('\n'.join(diff))
-                
-                logger.info(f"生成差异报告: {diff_file_path}")
+            logger.info(f"记录配置变更: 任务 {task.id}，{summary['changed_sections']} 个配置段有变化")
             
         except Exception as e:
+            db.session.rollback()
             logger.error(f"比较备份文件失败: {str(e)}")
     
-    def get_backup_file(self, task_id: int) -> Optional[Path]:
-        """获取备份文件路径"""
-        task = BackupTask.query.get(task_id)
-        if task and task.file_path:
-            file_path = Path(task.file_path)
-            if file_path.exists():
-                return file_path
+    def _index_backup(self, task: BackupTask):
+        """将新备份交给后台线程建立搜索索引（内容与已索引的备份相同时直接跳过）"""
+        if Config.SEARCH_INDEX_ENABLED and task.file_hash and not config_search.is_indexed(task.file_hash):
+            config_search.background_indexer.submit(self, task.id)
+    
+    def compare_backups(self, old_record, new_record, context: int = 3,
+                        ignore_whitespace: bool = False, ignore_case: bool = False) -> Optional[Dict[str, Any]]:
+        """按配置段比较两个备份，备份文件不存在时返回None
+
+        结果按 (旧内容哈希, 新内容哈希, 比较选项) 缓存，重复比较只需读取缓存；
+        缓存键只取决于内容，任务删除后重新创建也能命中
+        """
+        key = self.diff_cache_key(old_record, new_record, context, ignore_whitespace, ignore_case)
+        cached = self.cached_diff(key)
+        if cached is not None:
+            return cached
+        
+        old_content = self.read_backup_content(old_record)
+        new_content = self.read_backup_content(new_record)
+        if old_content is None or new_content is None:
+            return None
+        result = diff_sections(old_content, new_content, context, ignore_whitespace, ignore_case)
+        self.store_diff(key, result)
+        return result
+    
+    def diff_cache_key(self, old_record, new_record, context: int = 3,
+                       ignore_whitespace: bool = False, ignore_case: bool = False) -> str:
+        """差异结果的缓存键：两份内容的键和比较选项"""
+        options = f'v{DIFF_CACHE_VERSION}c{context}w{int(ignore_whitespace)}i{int(ignore_case)}'
+        return f'diff-{self.content_key(old_record)}-{self.content_key(new_record)}-{options}'
+    
+    def cached_diff(self, key: str) -> Optional[Dict[str, Any]]:
+        """读取缓存的差异结果，不存在或已损坏时返回None"""
+        cached = self.content_cache.read(key)
+        if cached is None:
+            return None
+        try:
+            return json.loads(cached)
+        except ValueError:
+            logger.warning(f"差异缓存 {key} 已损坏，重新比较")
+            return None
+    
+    def store_diff(self, key: str, result: Dict[str, Any]):
+        """缓存差异结果"""
+        self.content_cache.put(key, json.dumps(result, ensure_ascii=False).encode('utf-8'))
+    
+    def read_backup_bytes(self, record) -> Optional[bytes]:
+        """读取任务或产物的备份原始内容
+
+        对象存储中的备份（包括差异存储的版本）会还原为完整内容，
+        对象存储之前生成的旧备份文件直接读取，不存在时返回None
+        """
+        if not record or not record.file_path:
+            return None
+        if self.object_store.exists(record.file_hash):
+            return self.object_store.read_bytes(record.file_hash)
+        file_path = Path(record.file_path)
+        if file_path.exists():
+            return read_file_bytes(file_path)
         return None
     
+    def read_backup_content(self, record) -> Optional[str]:
+        """读取任务或产物的备份文本内容（使用检测并缓存的编码）"""
+        return self.with_content_path(
+            record, lambda path: path.read_bytes().decode(self.backup_encoding(record, path), errors='replace'))
+    
+    def with_content_path(self, record, reader):
+        """用备份明文内容所在的文件调用reader(path)，内容不存在时返回None
+
+        缓存文件可能在取得路径之后、读取之前被清理，此时重新生成并再读取一次
+        """
+        for attempt in range(2):
+            path = self.backup_content_path(record)
+            if path is None:
+                return None
+            try:
+                return reader(path)
+            except FileNotFoundError:
+                if attempt:
+                    raise
+                logger.info(f"备份内容文件 {path} 已被清理，重新生成")
+    
+    def content_key(self, record) -> str:
+        """备份内容的缓存键：内容哈希，旧备份没有哈希时使用文件路径的哈希"""
+        return record.file_hash or hashlib.sha1(record.file_path.encode('utf-8')).hexdigest()
+    
+    def backup_content_path(self, record) -> Optional[Path]:
+        """备份明文内容所在的文件，不存在时返回None
+
+        未压缩的完整对象和旧备份文件直接返回原文件；
+        压缩或差异存储的对象还原后写入缓存，之后直接读取缓存文件
+        """
+        if not record or not record.file_path:
+            return None
+        plain_path = self.object_store.plain_path(record.file_hash)
+        if plain_path is not None:
+            return plain_path if plain_path.exists() else None
+        file_path = Path(record.file_path)
+        if not self.object_store.exists(record.file_hash) and file_path.suffix != '.gz':
+            return file_path if file_path.exists() else None
+        
+        key = f'content-{self.content_key(record)}'
+        path = self.content_cache.get(key)
+        if path is None:
+            data = self.read_backup_bytes(record)
+            if data is None:
+                return None
+            path = self.content_cache.put(key, data)
+        return path
+    
+    def backup_line_index(self, record, path: Path = None) -> Optional[array]:
+        """备份内容每一行的起始字节偏移（最后一项为文件大小），生成后缓存"""
+        path = path or self.backup_content_path(record)
+        if path is None:
+            return None
+        key = f'lines-{self.content_key(record)}'
+        offsets = array('Q')
+        data = self.content_cache.read(key)
+        if data is not None:
+            offsets.frombytes(data)
+            return offsets
+        
+        offsets.append(0)
+        position = 0
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(CONTENT_BLOCK_SIZE), b''):
+                start = 0
+                while True:
+                    newline = block.find(b'\n', start)
+                    if newline < 0:
+                        break
+                    offsets.append(position + newline + 1)
+                    start = newline + 1
+                position += len(block)
+        if offsets[-1] != position:
+            offsets.append(position)  # 最后一行没有换行符
+        self.content_cache.put(key, offsets.tobytes())
+        return offsets
+    
+    def backup_encoding(self, record, path: Path = None) -> Optional[str]:
+        """备份内容的编码（UTF-8、GBK或Latin-1），检测一次后保存在任务记录中"""
+        encoding = getattr(record, 'content_encoding', None)
+        if encoding:
+            return encoding
+        path = path or self.backup_content_path(record)
+        if path is None:
+            return None
+        
+        encoding = 'latin-1'
+        for candidate in ('utf-8', 'gbk'):
+            decoder = codecs.getincrementaldecoder(candidate)()
+            try:
+                with open(path, 'rb') as f:
+                    for block in iter(lambda: f.read(CONTENT_BLOCK_SIZE), b''):
+                        decoder.decode(block)
+                decoder.decode(b'', final=True)
+            except UnicodeDecodeError:
+                continue
+            encoding = candidate
+            break
+        
+        if isinstance(record, BackupTask):
+            record.content_encoding = encoding
+            db.session.commit()
+        return encoding
+    
+    def read_backup_lines(self, record, start_line: int, end_line: int) -> Optional[Dict[str, Any]]:
+        """读取第start_line到end_line行（从1开始，包含两端），只读取对应的字节范围"""
+        return self.with_content_path(record, lambda path: self._read_lines(record, path, start_line, end_line))
+    
+    def _read_lines(self, record, path: Path, start_line: int, end_line: int) -> Dict[str, Any]:
+        offsets = self.backup_line_index(record, path)
+        encoding = self.backup_encoding(record, path)
+        total_lines = len(offsets) - 1
+        
+        start_line = max(1, start_line)
+        end_line = min(end_line, total_lines)
+        lines = []
+        if start_line <= end_line:
+            with open(path, 'rb') as f:
+                f.seek(offsets[start_line - 1])
+                data = f.read(offsets[end_line] - offsets[start_line - 1])
+            lines = [line.rstrip('\r') for line in data.decode(encoding, errors='replace').split('\n')]
+            if data.endswith(b'\n'):
+                lines.pop()
+        return {
+            'start_line': start_line,
+            'end_line': start_line + len(lines) - 1,
+            'total_lines': total_lines,
+            'lines': lines,
+            'encoding': encoding,
+            'has_more': end_line < total_lines
+        }
+    
+    def get_backup_file(self, task_id: int) -> Optional[bytes]:
+        """获取任务的备份内容"""
+        return self.read_backup_bytes(BackupTask.query.get(task_id))
+    
     def delete_backup_file(self, task_id: int) -> bool:
-        """删除备份文件"""
+        """释放任务引用的备份对象（包括命令集备份的所有产物）
+
+        对象的引用数归零时才删除文件；对象存储之前生成的旧备份文件直接删除
+        """
         try:
             task = BackupTask.query.get(task_id)
-            if task and task.file_path:
-                file_path = Path(task.file_path)
+            if not task:
+                return False
+            
+            references = [(artifact.file_hash, artifact.file_path)
+                          for artifact in task.artifacts if artifact.file_path]
+            if task.file_path:
+                references.append((task.file_hash, task.file_path))
+            
+            deleted = False
+            for file_hash, path in references:
+                # 只有对象文件持有引用；旧备份文件的哈希可能与后来的对象相同，不能释放该对象
+                if self.object_store.owns(path):
+                    if self.object_store.release(file_hash):
+                        deleted = True
+                    continue
+                file_path = Path(path)
                 if file_path.exists():
                     file_path.unlink()
                     logger.info(f"已删除备份文件: {file_path}")
-                    return True
+                    deleted = True
+            return deleted
         except Exception as e:
             logger.error(f"删除备份文件失败: {str(e)}")
         return False
     
+    def get_backup_artifact_file(self, artifact_id: int) -> Optional[bytes]:
+        """获取备份产物的内容"""
+        return self.read_backup_bytes(BackupArtifact.query.get(artifact_id))
+    
     def get_backup_statistics(self) -> Dict[str, Any]:
-        """获取备份统计信息"""
+        """获取备份统计信息（读取增量维护的统计计数器）"""
         try:
-            total_tasks = BackupTask.query.count()
-            success_tasks = BackupTask.query.filter_by(status='success').count()
-            failed_tasks = BackupTask.query.filter_by(status='failed').count()
-            running_tasks = BackupTask.query.filter_by(status='running').count()
-            
-            # 计算总备份大小
-            total_size = db.session.query(db.func.sum(BackupTask.file_size)).filter(
-                BackupTask.status == 'success'
-            ).scalar() or 0
-            
-            return {
-                'total_tasks': total_tasks,
-                'success_tasks': success_tasks,
-                'failed_tasks': failed_tasks,
-                'running_tasks': running_tasks,
-                'total_size': total_size,
-                'success_rate': (success_tasks / total_tasks * 100) if total_tasks > 0 else 0
-            }
+            return backup_statistics.read_statistics()
         except Exception as e:
             logger.error(f"获取备份统计失败: {str(e)}")
             return {}
+
+def collect_garbage_job():
+    """计划任务入口：清理引用数为零的备份对象和暂存区残留文件"""
+    from app import app
+    
+    with app.app_context():
+        try:
+            removed = object_store.collect_garbage()
+            if removed:
+                logger.info(f"已清理 {removed} 个无引用的备份对象")
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"清理备份对象失败: {str(e)}")
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+备份统计
+任务总数、成功数、失败数和成功备份的总大小保存在计数器表中，
+任务状态变化时在同一事务中增量更新，定期与备份任务表核对修正，
+统计接口只读取几行计数器，不再扫描整个任务表
+"""
+
+import logging
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Any, Optional, Tuple
+
+from sqlalchemy import event, func, update
+from sqlalchemy.orm import Session
+
+from models import db, BackupTask, BackupStatistic
+
+logger = logging.getLogger(__name__)
+
+COUNTERS = ('total_tasks', 'success_tasks', 'failed_tasks', 'total_size')
+
+def _task_counters(values: Optional[Tuple[str, int]]) -> Counter:
+    """一个任务（状态, 文件大小）对各计数器的贡献"""
+    counters = Counter()
+    if values is None:
+        return counters
+    status, file_size = values
+    counters['total_tasks'] += 1
+    if status == 'success':
+        counters['success_tasks'] += 1
+        counters['total_size'] += file_size or 0
+    elif status == 'failed':
+        counters['failed_tasks'] += 1
+    return counters
+
+def _previous_values(task: BackupTask) -> Tuple[str, int]:
+    """任务修改前的（状态, 文件大小），这两列设置了active_history，修改时总会保留旧值"""
+    state = db.inspect(task)
+    values = []
+    for attr in ('status', 'file_size'):
+        history = state.attrs[attr].history
+        if history.deleted:
+            values.append(history.deleted[0])
+        elif history.unchanged:
+            values.append(history.unchanged[0])
+        else:
+            values.append(getattr(task, attr))
+    return tuple(values)
+
+def apply_deltas(connection, deltas: Counter):
+    """在当前事务中累加计数器"""
+    deltas = {name: delta for name, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    table = BackupStatistic.__table__
+    now = datetime.utcnow()
+    for name, delta in deltas.items():
+        connection.execute(
+            update(table).where(table.c.name == name).values(value=table.c.value + delta, updated_at=now)
+        )
+
+@event.listens_for(Session, 'before_flush')
+def record_task_changes(session, flush_context, instances):
+    """ORM写入的任务新增、状态变化和删除同步到计数器（与任务写入在同一事务中）"""
+    deltas = Counter()
+    for task in session.new:
+        if isinstance(task, BackupTask):
+            deltas.update(_task_counters((task.status, task.file_size)))
+    for task in session.dirty:
+        if isinstance(task, BackupTask) and session.is_modified(task):
+            deltas.update(_task_counters((task.status, task.file_size)))
+            deltas.subtract(_task_counters(_previous_values(task)))
+    for task in session.deleted:
+        if isinstance(task, BackupTask):
+            deltas.subtract(_task_counters(_previous_values(task)))
+    if deltas:
+        apply_deltas(session.connection(), deltas)
+
+def record_tasks_created(count: int):
+    """批量插入的任务（不经过ORM flush）计入总数，需与插入在同一事务中"""
+    apply_deltas(db.session.connection(), Counter(total_tasks=count))
+
+def reconcile() -> Dict[str, int]:
+    """按备份任务表重新计算计数器并覆盖"""
+    table = BackupStatistic.__table__
+    try:
+        # 先写计数器表取得写锁，再统计，统计期间的任务变化会在本事务提交后再累加
+        db.session.execute(update(table).values(updated_at=datetime.utcnow()))
+        existing = {row.name for row in db.session.query(BackupStatistic.name)}
+        for name in COUNTERS:
+            if name not in existing:
+                db.session.add(BackupStatistic(name=name, value=0))
+        db.session.flush()
+
+        rows = db.session.query(
+            BackupTask.status, func.count(BackupTask.id), func.sum(BackupTask.file_size)
+        ).group_by(BackupTask.status).all()
+        values = Counter()
+        for status, count, total_size in rows:
+            values['total_tasks'] += count
+            if status == 'success':
+                values['success_tasks'] += count
+                values['total_size'] += total_size or 0
+            elif status == 'failed':
+                values['failed_tasks'] += count
+
+        now = datetime.utcnow()
+        for name in COUNTERS:
+            db.session.execute(update(table).where(table.c.name == name).values(value=values[name], updated_at=now))
+        db.session.commit()
+        return {name: values[name] for name in COUNTERS}
+    except Exception:
+        db.session.rollback()
+        raise
+
+def reconcile_job():
+    """计划任务入口：核对统计计数器"""
+    from app import app
+
+    with app.app_context():
+        try:
+            reconcile()
+            logger.info("备份统计已核对")
+        except Exception as e:
+            logger.error(f"核对备份统计失败: {str(e)}")
+
+def read_statistics() -> Dict[str, Any]:
+    """读取统计计数器，计数器尚未初始化时先核对一次"""
+    values = {row.name: row.value for row in BackupStatistic.query.all()}
+    if any(name not in values for name in COUNTERS):
+        values = reconcile()
+
+    running_tasks = db.session.query(func.count(BackupTask.id)).filter(BackupTask.status == 'running').scalar()
+    total_tasks = values['total_tasks']
+    success_tasks = values['success_tasks']
+    return {
+        'total_tasks': total_tasks,
+        'success_tasks': success_tasks,
+        'failed_tasks': values['failed_tasks'],
+        'running_tasks': running_tasks,
+        'total_size': values['total_size'],
+        'success_rate': (success_tasks / total_tasks * 100) if total_tasks > 0 else 0
+    }
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+备份文件存储
+负责备份文件的流式写入、按内容去重存储、行级差异压缩和读取
+"""
+
+import os
+import re
+import gzip
+import hashlib
+import logging
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import List, Optional
+
+from sqlalchemy.exc import IntegrityError
+
+from config import Config
+from models import db, BackupObject
+from config_diff import line_opcodes
+
+logger = logging.getLogger(__name__)
+
+DELTA_HEADER = b'DELTA1 '
+LINE_PATTERN = re.compile(rb'[^\n]*\n|[^\n]+$')
+
+def compress_enabled() -> bool:
+    """是否启用备份文件压缩"""
+    return Config.COMPRESS_BACKUPS
+
+def keyframe_interval() -> int:
+    """每隔多少个版本保存一次完整快照，小于等于1时不使用差异存储"""
+    return Config.BACKUP_KEYFRAME_INTERVAL
+
+def split_lines(data: bytes) -> List[bytes]:
+    """按换行符切分并保留行尾，只识别\\n，保证可以逐字节还原"""
+    return LINE_PATTERN.findall(data)
+
+def make_delta(base_hash: str, base: bytes, target: bytes) -> bytes:
+    """生成从base到target的行级差异
+
+    格式：首行为 DELTA1 <基准哈希>，之后每个操作一行：
+    "= 起始行 行数" 复制基准中的行，"+ 行数" 后跟相应数量的原始新行
+    """
+    base_lines = split_lines(base)
+    target_lines = split_lines(target)
+
+    parts = [DELTA_HEADER + base_hash.encode('ascii') + b'\n']
+    for tag, i1, i2, j1, j2 in line_opcodes(base_lines, target_lines):
+        if tag == 'equal':
+            parts.append(f'= {i1} {i2 - i1}\n'.encode('ascii'))
+        elif j2 > j1:
+            parts.append(f'+ {j2 - j1}\n'.encode('ascii'))
+            parts.extend(target_lines[j1:j2])
+    return b''.join(parts)
+
+def apply_delta(base: bytes, delta: bytes) -> bytes:
+    """将make_delta生成的差异应用到base上"""
+    base_lines = split_lines(base)
+    delta_lines = split_lines(delta)
+    if not delta_lines or not delta_lines[0].startswith(DELTA_HEADER):
+        raise ValueError('差异数据格式错误')
+
+    output = []
+    i = 1
+    while i < len(delta_lines):
+        op, *args = delta_lines[i].split()
+        if op == b'=':
+            start, count = int(args[0]), int(args[1])
+            output.extend(base_lines[start:start + count])
+            i += 1
+        elif op == b'+':
+            count = int(args[0])
+            output.extend(delta_lines[i + 1:i + 1 + count])
+            i += 1 + count
+        else:
+            raise ValueError(f'未知的差异操作: {op!r}')
+    return b''.join(output)
+
+def read_file_bytes(file_path) -> bytes:
+    """读取文件的原始内容，自动处理gzip压缩"""
+    file_path = Path(file_path)
+    if file_path.suffix == '.gz':
+        with gzip.open(file_path, 'rb') as f:
+            return f.read()
+    return file_path.read_bytes()
+
+class BackupSink:
+    """单遍流式备份写入器
+
+    设备输出按块写入，同时更新SHA256哈希、（可选）gzip压缩，
+    并写入同目录下的临时文件，提交时原子重命名为最终文件。
+    内存占用与备份大小无关，每个备份只写一次磁盘。
+    哈希基于明文内容计算，与是否压缩无关。
+    """
+
+    def __init__(self, file_path: Path, compress: bool = None):
+        if compress is None:
+            compress = compress_enabled()
+
+        file_path = Path(file_path)
+        self.compressed = compress
+        self.file_path = file_path.with_name(file_path.name + '.gz') if compress else file_path
+        self.file_path.parent.mkdir(parents=True, exist_ok=True)
+
+        fd, tmp_name = tempfile.mkstemp(dir=self.file_path.parent, prefix='.', suffix='.tmp')
+        self.tmp_path = Path(tmp_name)
+        self._raw = os.fdopen(fd, 'wb')
+        self._out = gzip.GzipFile(fileobj=self._raw, mode='wb') if compress else self._raw
+        self._hasher = hashlib.sha256()
+        self.content_size = 0  # 明文字节数
+        self.file_size = 0  # 落盘字节数
+        self.file_hash = None
+        self._closed = False
+
+    def write(self, chunk: str):
+        """写入一块输出"""
+        data = chunk.encode('utf-8')
+        self._hasher.update(data)
+        self._out.write(data)
+        self.content_size += len(data)
+
+    def finish(self):
+        """结束写入，计算哈希和落盘大小（临时文件保留，等待提交）"""
+        if self._closed:
+            return
+        self._close()
+        self.file_hash = self._hasher.hexdigest()
+        self.file_size = self.tmp_path.stat().st_size
+
+    def commit(self, file_path: Path = None) -> Path:
+        """完成写入并原子替换为最终文件"""
+        self.finish()
+        if file_path is not None:
+            self.file_path = Path(file_path)
+            self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        os.chmod(self.tmp_path, 0o644)  # mkstemp默认仅属主可读
+        os.replace(self.tmp_path, self.file_path)
+        return self.file_path
+
+    def abort(self):
+        """放弃写入并删除临时文件"""
+        try:
+            self._close()
+        finally:
+            if self.tmp_path.exists():
+                self.tmp_path.unlink()
+
+    def _close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._raw.closed:
+            return
+        if self._out is not self._raw:
+            self._out.close()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None or not self.file_hash:
+            self.abort()
+        return False
+
+class ObjectStore:
+    """按内容寻址的备份对象存储
+
+    对象以明文SHA256哈希为键存放在 objects/<前2位>/<其余位>，内容相同的
+    备份只存一份，由BackupObject.ref_count记录引用数，引用归零时删除文件。
+
+    提交时如果指定了同一设备的上一版本，则只保存相对它的行级差异，
+    每keyframe_interval个版本保存一次完整快照，还原任意版本最多应用
+    keyframe_interval-1个差异。差异对象持有基准对象的一个引用。
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.staging_dir = self.root / '.staging'
+        self.staging_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+
+    def path_for(self, file_hash: str, compressed: bool = False, kind: str = 'full') -> Path:
+        """对象文件路径"""
+        suffix = '.delta' if kind == 'delta' else ''
+        if compressed:
+            suffix += '.gz'
+        return self.root / file_hash[:2] / f"{file_hash[2:]}{suffix}"
+
+    def open_sink(self, compress: bool = None) -> BackupSink:
+        """创建写入暂存区的流式写入器，内容写完后通过commit入库"""
+        return BackupSink(self.staging_dir / f"{uuid.uuid4().hex}.txt", compress)
+
+    def commit(self, sink: BackupSink, base_hash: str = None) -> BackupObject:
+        """将写完的内容入库并增加一次引用；已存在相同内容时丢弃新文件
+
+        base_hash为同一设备上一版本的对象哈希，用于差异存储
+        """
+        sink.finish()
+        with self._lock:
+            obj = db.session.get(BackupObject, sink.file_hash)
+            if obj and Path(obj.file_path).exists():
+                sink.abort()
+                obj.ref_count += 1
+                db.session.commit()
+                logger.info(f"备份内容未变化，复用已有对象 {sink.file_hash[:12]}")
+                return obj
+
+            base = self._delta_base(base_hash, sink.file_hash)
+            delta = self._try_delta(sink, base) if base else None
+            if delta is not None:
+                file_path = self.path_for(sink.file_hash, sink.compressed, 'delta')
+                file_size = self._write_object(file_path, delta, sink.compressed)
+                sink.abort()
+                base.ref_count += 1
+                kind, chain_depth = 'delta', base.chain_depth + 1
+            else:
+                file_path = sink.commit(self.path_for(sink.file_hash, sink.compressed))
+                file_size = sink.file_size
+                base, kind, chain_depth = None, 'full', 0
+
+            if obj:
+                # 对象记录存在但文件丢失，用新内容修复
+                if obj.kind == 'delta':
+                    self._release_locked(obj.base_hash)
+                obj.file_path = str(file_path)
+                obj.file_size = file_size
+                obj.compressed = sink.compressed
+                obj.kind = kind
+                obj.base_hash = base.file_hash if base else None
+                obj.chain_depth = chain_depth
+                obj.ref_count += 1
+            else:
+                obj = BackupObject(
+                    file_hash=sink.file_hash,
+                    file_path=str(file_path),
+                    file_size=file_size,
+                    content_size=sink.content_size,
+                    compressed=sink.compressed,
+                    kind=kind,
+                    base_hash=base.file_hash if base else None,
+                    chain_depth=chain_depth,
+                    ref_count=1
+                )
+                db.session.add(obj)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # 其他进程同时写入了相同内容
+                db.session.rollback()
+                obj = db.session.get(BackupObject, sink.file_hash)
+                obj.ref_count += 1
+                db.session.commit()
+            return obj
+
+    def _delta_base(self, base_hash: str, file_hash: str) -> Optional[BackupObject]:
+        """返回可作为差异基准的对象，差异链已达关键帧间隔时返回None"""
+        if not base_hash or base_hash == file_hash:
+            return None
+        base = db.session.get(BackupObject, base_hash)
+        if not base or base.chain_depth + 1 >= keyframe_interval():
+            return None
+        return base
+
+    def _try_delta(self, sink: BackupSink, base: BackupObject) -> Optional[bytes]:
+        """生成相对基准的差异，差异不足完整内容一半大小时才采用"""
+        try:
+            target = sink.tmp_path.read_bytes()
+            if sink.compressed:
+                target = gzip.decompress(target)
+            delta = make_delta(base.file_hash, self.read_bytes(base.file_hash), target)
+        except Exception as e:
+            logger.warning(f"生成差异失败，保存完整快照: {str(e)}")
+            return None
+        if len(delta) * 2 >= len(target):
+            return None
+        return delta
+
+    def _write_object(self, file_path: Path, data: bytes, compress: bool) -> int:
+        """原子写入对象文件，返回落盘大小"""
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=file_path.parent, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(gzip.compress(data) if compress else data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp_name, 0o644)
+            os.replace(tmp_name, file_path)
+        except Exception:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+            raise
+        return file_path.stat().st_size
+
+    def read_bytes(self, file_hash: str) -> bytes:
+        """读取对象的完整明文内容，差异对象沿基准链还原"""
+        chain = []
+        obj = db.session.get(BackupObject, file_hash)
+        while obj is not None and obj.kind == 'delta':
+            chain.append(obj)
+            obj = db.session.get(BackupObject, obj.base_hash)
+        if obj is None:
+            raise FileNotFoundError(f'备份对象不存在: {file_hash}')
+
+        data = read_file_bytes(obj.file_path)
+        for delta in reversed(chain):
+            data = apply_delta(data, read_file_bytes(delta.file_path))
+
+        if hashlib.sha256(data).hexdigest() != file_hash:
+            raise ValueError(f'备份对象校验失败: {file_hash}')
+        return data
+
+    def owns(self, file_path: str) -> bool:
+        """文件是否为存储中的对象文件（对象存储之前的旧备份文件不在存储目录下）"""
+        if not file_path:
+            return False
+        return self.root.resolve() in Path(file_path).resolve().parents
+
+    def plain_path(self, file_hash: str) -> Optional[Path]:
+        """未压缩的完整对象文件路径，可直接读取明文；压缩或差异存储的对象返回None"""
+        obj = db.session.get(BackupObject, file_hash) if file_hash else None
+        if obj is None or obj.compressed or obj.kind != 'full':
+            return None
+        return Path(obj.file_path)
+
+    def exists(self, file_hash: str) -> bool:
+        """对象是否在存储中"""
+        return bool(file_hash) and db.session.get(BackupObject, file_hash) is not None
+
+    def acquire(self, file_hash: str) -> Optional[BackupObject]:
+        """为已有对象增加一次引用"""
+        with self._lock:
+            obj = db.session.get(BackupObject, file_hash)
+            if obj:
+                obj.ref_count += 1
+                db.session.commit()
+            return obj
+
+    def release(self, file_hash: str) -> bool:
+        """释放一次引用，引用归零时删除对象；对象不存在时返回False"""
+        if not file_hash:
+            return False
+        with self._lock:
+            released = self._release_locked(file_hash)
+            db.session.commit()
+            return released
+
+    def _release_locked(self, file_hash: str) -> bool:
+        obj = db.session.get(BackupObject, file_hash)
+        if not obj:
+            return False
+        obj.ref_count -= 1
+        if obj.ref_count <= 0:
+            self._delete(obj)
+        return True
+
+    def collect_garbage(self, staging_max_age: int = 3600) -> int:
+        """清理引用数为零的对象和暂存区残留文件，返回清理的对象数
+
+        暂存区只清理超过staging_max_age秒未修改的文件，避免误删正在写入的备份
+        """
+        with self._lock:
+            orphans = BackupObject.query.filter(BackupObject.ref_count <= 0).all()
+            for obj in orphans:
+                self._delete(obj)
+            db.session.commit()
+
+        cutoff = time.time() - staging_max_age
+        for leftover in self.staging_dir.glob('.*.tmp'):
+            try:
+                if leftover.stat().st_mtime < cutoff:
+                    leftover.unlink()
+            except OSError:
+                pass
+        return len(orphans)
+
+    def _delete(self, obj: BackupObject):
+        file_path = Path(obj.file_path)
+        if file_path.exists():
+            file_path.unlink()
+            try:
+                file_path.parent.rmdir()  # 目录已空时一并删除
+            except OSError:
+                pass
+        db.session.delete(obj)
+        logger.info(f"已删除无引用的备份对象: {file_path}")
+        if obj.kind == 'delta':
+            # 差异对象删除后释放其对基准对象的引用
+            self._release_locked(obj.base_hash)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量备份调度器
+根据历史耗时估算每台设备的备份时间，以AIMD方式自适应调整全局和站点并发数
+"""
+
+import heapq
+import ipaddress
+import logging
+import statistics
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Callable, Optional
+
+from sqlalchemy import func
+
+from models import db, BackupTask
+from backup_job import BackupJob
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DURATION = 30.0  # 没有历史记录时估算的备份耗时（秒）
+HISTORY_DAYS = 30  # 统计耗时使用的历史范围
+HISTORY_SAMPLES = 5  # 每台设备取最近几次成功备份的耗时
+IN_QUERY_CHUNK = 500  # 批量IN查询每次的ID数量
+SLOW_FACTOR = 2.0  # 耗时超过估算值的倍数时视为拥塞
+
+def site_key(ip_address: str) -> str:
+    """设备所属站点：IPv4按/24、IPv6按/64划分，无法解析时按原地址"""
+    try:
+        ip = ipaddress.ip_address(ip_address)
+    except ValueError:
+        return ip_address or ''
+    prefix = 24 if ip.version == 4 else 64
+    return str(ipaddress.ip_network(f'{ip}/{prefix}', strict=False))
+
+def load_device_durations(device_ids: List[int]) -> Dict[int, float]:
+    """从历史成功任务中统计每台设备的平均备份耗时（秒），每台设备只读取最近HISTORY_SAMPLES次"""
+    since = datetime.utcnow() - timedelta(days=HISTORY_DAYS)
+    unique_ids = sorted(set(device_ids))
+    samples: Dict[int, List[float]] = {}
+    for start in range(0, len(unique_ids), IN_QUERY_CHUNK):
+        chunk = unique_ids[start:start + IN_QUERY_CHUNK]
+        recent = db.session.query(
+            BackupTask.device_id, BackupTask.started_at, BackupTask.completed_at,
+            func.row_number().over(partition_by=BackupTask.device_id,
+                                   order_by=BackupTask.completed_at.desc()).label('position')
+        ).filter(
+            BackupTask.device_id.in_(chunk),
+            BackupTask.status == 'success',
+            BackupTask.started_at.isnot(None),
+            BackupTask.completed_at >= since
+        ).subquery()
+        rows = db.session.query(recent.c.device_id, recent.c.started_at, recent.c.completed_at) \
+            .filter(recent.c.position <= HISTORY_SAMPLES).all()
+        for device_id, started_at, completed_at in rows:
+            samples.setdefault(device_id, []).append(max((completed_at - started_at).total_seconds(), 0.1))
+    return {device_id: sum(values) / len(values) for device_id, values in samples.items()}
+
+class AIMDWindow:
+    """AIMD并发窗口
+
+    按时完成的任务使窗口加一，失败或明显变慢时窗口减半。
+    同一轮拥塞中多个任务先后失败只减半一次：只有在上次减半之后才启动的任务
+    才能再次触发减半。
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.running = 0
+        self.last_decrease = 0.0
+
+    def available(self) -> bool:
+        return self.running < int(self.limit)
+
+    def on_success(self):
+        self.limit = min(self.maximum, self.limit + 1)
+
+    def on_congestion(self, started_at: float):
+        if started_at < self.last_decrease:
+            return
+        self.limit = max(self.minimum, self.limit / 2)
+        self.last_decrease = time.monotonic()
+
+class AdaptiveBatchScheduler:
+    """批量备份的自适应调度器
+
+    耗时长的设备优先启动，避免批次被最后的慢设备拖长；
+    同一站点的设备共享一个较小的并发窗口，避免打满跳板机、站点带宽或
+    设备的VTY线路和AAA认证速率。
+    """
+
+    def __init__(self, submit: Callable[[Any], Any], outcome: Callable[[int], Optional[bool]],
+                 fail: Callable[[int, str], None], max_parallel: int = 10, initial_parallel: int = 4,
+                 site_max_parallel: int = 8, site_initial_parallel: int = 2):
+        self.submit = submit  # 提交作业，返回Future
+        self.outcome = outcome  # 查询任务结果：True成功，False失败，None未完成
+        self.fail = fail  # 提交失败时将任务标记为失败
+        self.window = AIMDWindow(initial_parallel, 1, max_parallel)
+        self.site_max_parallel = site_max_parallel
+        self.site_initial_parallel = site_initial_parallel
+        self.sites: Dict[str, AIMDWindow] = {}
+        self._cond = threading.Condition()
+
+    def run(self, jobs: List[Dict[str, Any]]):
+        """执行一批任务直到全部完成
+
+        每个任务为 {'task_id', 'job', 'site', 'expected'}，expected为估算耗时（秒）。
+        每个站点一个按估算耗时降序的队列，堆中只放有空闲并发的站点，
+        站点窗口已满时移入blocked，直到该站点有任务完成
+        """
+        queues: Dict[str, deque] = {}
+        for job in sorted(jobs, key=lambda job: job['expected'], reverse=True):
+            queues.setdefault(job['site'], deque()).append(job)
+        ready = [(-queue[0]['expected'], key) for key, queue in queues.items()]
+        heapq.heapify(ready)
+        blocked = set()
+        running = 0
+        finished = []
+
+        def on_done(job, started_at):
+            def callback(future):
+                with self._cond:
+                    finished.append((job, started_at, time.monotonic(), None))
+                    self._cond.notify()
+            return callback
+
+        with self._cond:
+            while ready or blocked or running:
+                while ready and self.window.available():
+                    _, key = heapq.heappop(ready)
+                    site = self._site(key)
+                    if not site.available():
+                        blocked.add(key)
+                        continue
+                    queue = queues[key]
+                    job = queue.popleft()
+                    if queue:
+                        heapq.heappush(ready, (-queue[0]['expected'], key))
+                    self.window.running += 1
+                    site.running += 1
+                    running += 1
+                    try:
+                        future = self.submit(job['job'])
+                    except Exception as e:
+                        logger.error(f"提交备份任务 {job['task_id']} 失败: {str(e)}")
+                        finished.append((job, time.monotonic(), time.monotonic(), str(e)))
+                        continue
+                    future.add_done_callback(on_done(job, time.monotonic()))
+
+                while not finished:
+                    self._cond.wait()
+
+                while finished:
+                    job, started_at, ended_at, error = finished.pop()
+                    running -= 1
+                    self.window.running -= 1
+                    site = self._site(job['site'])
+                    site.running -= 1
+                    self._cond.release()
+                    try:
+                        if error is None:
+                            succeeded = self.outcome(job['task_id'])
+                        else:
+                            self.fail(job['task_id'], f'提交备份任务失败: {error}')
+                    finally:
+                        self._cond.acquire()
+                    if error is None:
+                        self._adjust(site, job, started_at, ended_at, succeeded)
+                    if job['site'] in blocked and site.available():
+                        blocked.discard(job['site'])
+                        queue = queues[job['site']]
+                        heapq.heappush(ready, (-queue[0]['expected'], job['site']))
+
+        logger.info(f"批量备份调度完成，共 {len(jobs)} 个任务，最终并发窗口: {int(self.window.limit)}")
+
+    def _site(self, key: str) -> AIMDWindow:
+        site = self.sites.get(key)
+        if site is None:
+            site = AIMDWindow(self.site_initial_parallel, 1, self.site_max_parallel)
+            self.sites[key] = site
+        return site
+
+    def _adjust(self, site: AIMDWindow, job: Dict[str, Any], started_at: float,
+                ended_at: float, succeeded: Optional[bool]):
+        """根据任务结果和耗时调整全局与站点窗口"""
+        if succeeded is None:
+            return
+        slow = ended_at - started_at > job['expected'] * SLOW_FACTOR
+        if succeeded and not slow:
+            self.window.on_success()
+            site.on_success()
+        else:
+            self.window.on_congestion(started_at)
+            site.on_congestion(started_at)
+            logger.info(f"任务 {job['task_id']} {'变慢' if succeeded else '失败'}，"
+                        f"并发窗口调整为 {int(self.window.limit)}，站点 {job['site']} 为 {int(site.limit)}")
+
+def build_jobs(backup_jobs: List[BackupJob]) -> List[Dict[str, Any]]:
+    """根据设备历史耗时为作业生成调度信息，没有历史的设备使用同站点的中位数"""
+    durations = load_device_durations([job.device_id for job in backup_jobs])
+
+    site_durations: Dict[str, List[float]] = {}
+    jobs = []
+    for backup_job in backup_jobs:
+        site = site_key(backup_job.ip_address)
+        jobs.append({'task_id': backup_job.task_id, 'job': backup_job, 'site': site,
+                     'expected': durations.get(backup_job.device_id)})
+        if backup_job.device_id in durations:
+            site_durations.setdefault(site, []).append(durations[backup_job.device_id])
+
+    fallback = statistics.median(durations.values()) if durations else DEFAULT_DURATION
+    for job in jobs:
+        if job['expected'] is None:
+            site_samples = site_durations.get(job['site'])
+            job['expected'] = statistics.median(site_samples) if site_samples else fallback
+    return jobs
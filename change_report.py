@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+全网配置变更报告
+比较每台设备在时间窗口起点和终点的配置（各自之前最近一次成功备份）：
+内容哈希相同即未变化，不读取任何配置文件；有变化时优先使用备份时记录的配置变更，
+没有对应记录（窗口内变化多次）时才比较两份备份：主进程读取内容，比较在进程池中并行执行，
+结果逐台设备产出
+"""
+
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from typing import Dict, Any, Iterator, List, Optional
+
+from sqlalchemy import func
+
+from config import Config
+from models import db, Device, BackupTask, ConfigChange
+from config_sections import diff_sections
+
+logger = logging.getLogger(__name__)
+
+IN_QUERY_CHUNK = 500  # 批量IN查询每次的ID数量
+LINE_FIELDS = ('device_id', 'device_alias', 'device_ip', 'base_task_id', 'target_task_id', 'change_count')
+
+def state_subquery(at: datetime):
+    """设备在某一时间点的配置：该时间之前最近一次成功备份的任务ID（每台设备一次索引查找）
+
+    只取设备当前备份命令的备份，show version等其他命令的输出不是设备配置
+    """
+    return db.session.query(BackupTask.id).filter(
+        BackupTask.device_id == Device.id,
+        BackupTask.status == 'success',
+        BackupTask.backup_command.is_not_distinct_from(Device.backup_command),
+        BackupTask.completed_at <= at
+    ).order_by(BackupTask.completed_at.desc(), BackupTask.id.desc()).limit(1) \
+        .correlate(Device).scalar_subquery()
+
+def _in_chunks(column, ids: List[int], *columns):
+    """按ID分批查询"""
+    rows = []
+    for start in range(0, len(ids), IN_QUERY_CHUNK):
+        chunk = ids[start:start + IN_QUERY_CHUNK]
+        rows.extend(db.session.query(*columns).filter(column.in_(chunk)).all())
+    return rows
+
+def collect_states(since: datetime, until: datetime, device_ids: Optional[List[int]] = None) -> List[Dict[str, Any]]:
+    """查询各设备在窗口两端的备份任务、内容哈希、窗口内的变更次数和对应的变更记录"""
+    query = db.session.query(
+        Device.id, Device.alias, Device.ip_address,
+        state_subquery(since).label('base_task_id'),
+        state_subquery(until).label('target_task_id')
+    )
+    if device_ids:
+        query = query.filter(Device.id.in_(device_ids))
+    devices = query.order_by(Device.id).all()
+
+    task_ids = sorted({task_id for row in devices for task_id in (row.base_task_id, row.target_task_id) if task_id})
+    hashes = {row.id: row.file_hash for row in _in_chunks(BackupTask.id, task_ids, BackupTask.id, BackupTask.file_hash)}
+
+    counts_query = db.session.query(ConfigChange.device_id, func.count(ConfigChange.id)).filter(
+        ConfigChange.detected_at > since, ConfigChange.detected_at <= until)
+    if device_ids:
+        counts_query = counts_query.filter(ConfigChange.device_id.in_(device_ids))
+    counts = dict(counts_query.group_by(ConfigChange.device_id).all())
+
+    target_ids = sorted({row.target_task_id for row in devices if row.target_task_id})
+    records = {change.task_id: change for change in _in_chunks(ConfigChange.task_id, target_ids, ConfigChange)}
+
+    states = []
+    for row in devices:
+        states.append({
+            'device_id': row.id,
+            'device_alias': row.alias,
+            'device_ip': row.ip_address,
+            'base_task_id': row.base_task_id,
+            'target_task_id': row.target_task_id,
+            'base_hash': hashes.get(row.base_task_id),
+            'target_hash': hashes.get(row.target_task_id),
+            'change_count': counts.get(row.id, 0),
+            'record': records.get(row.target_task_id)
+        })
+    return states
+
+def _section_names(sections: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [{'section': section['section'], 'status': section['status']} for section in sections]
+
+def _report_line(state: Dict[str, Any], **fields) -> Dict[str, Any]:
+    line = {'type': 'device'}
+    line.update((key, state[key]) for key in LINE_FIELDS)
+    line.update(fields)
+    return line
+
+def _classify(state: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """不需要读取配置文件就能得出结果的设备，返回报告行；需要比较备份时返回None"""
+    if not state['target_task_id']:
+        return _report_line(state, status='no_backup', source='hash', summary=None)
+    if not state['base_task_id']:
+        return _report_line(state, status='new', source='hash', summary=None)
+    if state['base_task_id'] == state['target_task_id'] or \
+            (state['base_hash'] and state['base_hash'] == state['target_hash']):
+        return _report_line(state, status='unchanged', source='hash', summary=None)
+
+    # 窗口内只变化了一次：备份时记录的变更正好对应窗口两端的备份
+    record = state['record']
+    if record is not None and record.previous_task_id == state['base_task_id']:
+        return _report_line(state, status='changed', source='record', summary=record.summary(),
+                            sections=_section_names(record.to_dict()['sections']))
+    return None
+
+def _diff_line(state: Dict[str, Any], result: Dict[str, Any]) -> Dict[str, Any]:
+    summary = result['summary']
+    return _report_line(state, status='changed' if summary['has_changes'] else 'unchanged', source='diff',
+                        summary=summary, sections=_section_names(result['sections']))
+
+def _compare(service, states: List[Dict[str, Any]], workers: int) -> Iterator[Dict[str, Any]]:
+    """比较各设备窗口两端的备份，按完成顺序产出报告行
+
+    差异缓存命中时直接使用；否则在主进程读取内容，在进程池中执行比较，
+    结果由主进程写入差异缓存。同时提交的比较不超过工作进程数的两倍，读入内存的内容数量有上限
+    """
+    def failed(state, error):
+        logger.error(f"比较设备 {state['device_id']} 的备份失败: {error}")
+        return _report_line(state, status='changed', source='diff', summary=None, error=error)
+
+    def load(state):
+        """返回 (报告行, None)，需要比较时返回 (None, (缓存键, 旧内容, 新内容))"""
+        try:
+            base = db.session.get(BackupTask, state['base_task_id'])
+            target = db.session.get(BackupTask, state['target_task_id'])
+            key = service.diff_cache_key(base, target)
+            cached = service.cached_diff(key)
+            if cached is not None:
+                return _diff_line(state, cached), None
+            old_content = service.read_backup_content(base)
+            new_content = service.read_backup_content(target)
+        except Exception as e:
+            return failed(state, str(e)), None
+        if old_content is None or new_content is None:
+            return _report_line(state, status='changed', source='diff', summary=None, error='备份文件不存在'), None
+        return None, (key, old_content, new_content)
+
+    if workers <= 1 or len(states) < 2:
+        for state in states:
+            line, loaded = load(state)
+            if line is None:
+                key, old_content, new_content = loaded
+                result = diff_sections(old_content, new_content)
+                service.store_diff(key, result)
+                line = _diff_line(state, result)
+            yield line
+        return
+
+    remaining = iter(states)
+    executor = ProcessPoolExecutor(max_workers=min(workers, len(states)))
+    futures = {}
+    try:
+        while True:
+            for state in remaining:
+                line, loaded = load(state)
+                if line is not None:
+                    yield line
+                    continue
+                key, old_content, new_content = loaded
+                futures[executor.submit(diff_sections, old_content, new_content)] = (state, key)
+                if len(futures) >= workers * 2:
+                    break
+            if not futures:
+                return
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                state, key = futures.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    yield failed(state, str(e))
+                    continue
+                service.store_diff(key, result)
+                yield _diff_line(state, result)
+    finally:
+        # 客户端断开时不再执行尚未开始的比较
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+def generate_report(service, since: datetime, until: datetime, device_ids: Optional[List[int]] = None,
+                    compare: bool = True, workers: int = Config.REPORT_WORKERS) -> Iterator[Dict[str, Any]]:
+    """逐台设备产出变更报告行，最后产出一行汇总
+
+    compare为False时只按内容哈希判断，窗口内变化多次的设备不比较备份、不给出统计
+    """
+    started = time.time()
+    totals = {'changed': 0, 'unchanged': 0, 'new': 0, 'no_backup': 0, 'failed': 0}
+
+    def count(line):
+        totals['failed' if line.get('error') else line['status']] += 1
+        return line
+
+    pending = []
+    for state in collect_states(since, until, device_ids):
+        line = _classify(state)
+        if line is None and not compare:
+            line = _report_line(state, status='changed', source='hash', summary=None)
+        if line is not None:
+            yield count(line)
+        else:
+            pending.append(state)
+
+    if pending:
+        for line in _compare(service, pending, workers):
+            yield count(line)
+
+    yield {
+        'type': 'summary',
+        'since': since.isoformat(),
+        'until': until.isoformat(),
+        'devices': sum(totals.values()),
+        **totals,
+        'compared': len(pending),
+        'elapsed': round(time.time() - started, 3)
+    }
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+合规检查
+对每台设备最近一次成功备份求值所有启用的合规规则。检查是增量的：
+设备状态记录上次检查的备份内容和各规则的版本，只有备份内容变化的设备重新检查全部规则，
+规则新增或修改时只重新检查这些规则；内容相同的设备只求值一次，求值在进程池中并行执行
+"""
+
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+from sqlalchemy import delete, insert, update
+
+from config import Config
+from models import db, Device, BackupTask, ComplianceRule, ComplianceResult, DeviceCompliance
+from change_report import state_subquery
+from compliance_engine import evaluate_config, sections_cache_key
+
+logger = logging.getLogger(__name__)
+
+IN_QUERY_CHUNK = 500  # 批量IN查询每次的ID数量
+WRITE_BATCH = 200  # 每次提交的设备数
+
+# 同一时间只运行一次检查（计划任务和手动触发）
+_run_lock = threading.Lock()
+last_run: Optional[Dict[str, Any]] = None
+
+def _chunks(values: List, size: int = IN_QUERY_CHUNK):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def _latest_backups(device_ids: Optional[List[int]]):
+    """启用的设备和各自最近一次成功备份"""
+    query = db.session.query(
+        Device.id.label('device_id'), Device.device_type, BackupTask.id.label('task_id'),
+        BackupTask.file_hash, BackupTask.file_path
+    ).join(BackupTask, BackupTask.id == state_subquery(datetime.utcnow())).filter(Device.is_active == True)
+    if device_ids:
+        query = query.filter(Device.id.in_(device_ids))
+    return query.order_by(Device.id).all()
+
+def _device_states(device_ids: List[int]) -> Dict[int, Any]:
+    states = {}
+    for chunk in _chunks(device_ids):
+        states.update((row.device_id, row) for row in db.session.query(
+            DeviceCompliance.device_id, DeviceCompliance.file_hash, DeviceCompliance.rule_states
+        ).filter(DeviceCompliance.device_id.in_(chunk)).all())
+    return states
+
+def _stale_devices(device_ids: Optional[List[int]], current: set) -> List[int]:
+    """有检查状态但已停用或没有成功备份的设备，它们的检查结果不再有效"""
+    query = db.session.query(DeviceCompliance.device_id)
+    if not device_ids:
+        return [device_id for (device_id,) in query.all() if device_id not in current]
+    stale = []
+    for chunk in _chunks(sorted(set(device_ids))):
+        stale.extend(device_id for (device_id,) in query.filter(DeviceCompliance.device_id.in_(chunk)).all()
+                     if device_id not in current)
+    return stale
+
+def _remove_devices(device_ids: List[int]):
+    for chunk in _chunks(device_ids):
+        db.session.execute(delete(ComplianceResult).where(ComplianceResult.device_id.in_(chunk)))
+        db.session.execute(delete(DeviceCompliance).where(DeviceCompliance.device_id.in_(chunk)))
+
+def plan_devices(service, rules: List[ComplianceRule], device_ids: Optional[List[int]] = None,
+                 full: bool = False) -> Dict[str, Any]:
+    """找出需要检查的设备和规则
+
+    返回plans（每台设备的任务、内容键、需要求值和需要删除的规则）、设备总数、跳过的设备数，
+    以及需要清除检查结果的设备（已停用或没有成功备份）
+    """
+    rows = _latest_backups(device_ids)
+    states = _device_states([row.device_id for row in rows])
+    plans = []
+    for row in rows:
+        applicable = {rule.id: rule.revision for rule in rules
+                      if not rule.device_type or rule.device_type == row.device_type}
+        key = service.content_key(row)
+        state = states.get(row.device_id)
+        previous = {int(rule_id): value for rule_id, value in json.loads(state.rule_states or '{}').items()} \
+            if state else {}
+
+        if full or state is None or state.file_hash != key:
+            needed = list(applicable)  # 备份内容变化，重新检查全部规则
+        else:
+            needed = [rule_id for rule_id, revision in applicable.items()
+                      if rule_id not in previous or previous[rule_id][0] != revision]
+        removed = [rule_id for rule_id in previous if rule_id not in applicable]
+        if state is not None and not needed and not removed and state.file_hash == key:
+            continue
+        plans.append({
+            'device_id': row.device_id,
+            'task_id': row.task_id,
+            'key': key,
+            'new': state is None,
+            'needed': needed,
+            'removed': removed,
+            'revisions': applicable,
+            'previous': previous
+        })
+    return {
+        'plans': plans,
+        'devices': len(rows),
+        'skipped': len(rows) - len(plans),
+        'stale': _stale_devices(device_ids, {row.device_id for row in rows})
+    }
+
+def _build_jobs(plans: List[Dict[str, Any]], specs: Dict[int, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """按内容键合并需要求值的设备，每份内容一个求值作业（包含这些设备需要的全部规则）"""
+    jobs: Dict[str, Dict[str, Any]] = {}
+    for plan in plans:
+        if plan['needed']:
+            job = jobs.setdefault(plan['key'], {'key': plan['key'], 'task_id': plan['task_id'], 'rule_ids': set()})
+            job['rule_ids'].update(plan['needed'])
+    return [{
+        'key': job['key'],
+        'task_id': job['task_id'],
+        'rules': [specs[rule_id] for rule_id in sorted(job['rule_ids'])]
+    } for job in jobs.values()]
+
+def _load_job(service, job: Dict[str, Any]) -> Dict[str, Any]:
+    """在主进程中读取作业的备份内容和缓存的配置段，备份文件不存在时抛出OSError
+
+    内容在提交作业前才读取，不会在求值前就被缓存清理掉；工作进程不访问磁盘缓存
+    """
+    content = service.read_backup_content(db.session.get(BackupTask, job['task_id']))
+    if content is None:
+        raise OSError('备份文件不存在')
+    cached = service.content_cache.read(sections_cache_key(job['key']))
+    sections = None
+    if cached is not None:
+        try:
+            sections = json.loads(cached)
+        except ValueError:
+            pass
+    return {'key': job['key'], 'content': content, 'sections': sections, 'rules': job['rules']}
+
+def _evaluate(service, jobs: List[Dict[str, Any]], workers: int):
+    """求值作业，按完成顺序产出结果；作业少于两个或只有一个工作进程时在当前进程中执行
+
+    同时提交的作业不超过工作进程数的两倍，读入内存的备份内容数量有上限；
+    新解析的配置段由主进程写入缓存
+    """
+    def finish(outcome):
+        if outcome.get('sections') is not None:
+            service.content_cache.put(sections_cache_key(outcome['key']),
+                                      json.dumps(outcome['sections']).encode('utf-8'))
+        return outcome
+
+    def load(job):
+        try:
+            return _load_job(service, job), None
+        except Exception as e:
+            return None, {'key': job['key'], 'error': f'读取备份内容失败: {str(e)}', 'results': {}}
+
+    if workers <= 1 or len(jobs) < 2:
+        for job in jobs:
+            loaded, failed = load(job)
+            yield failed or finish(evaluate_config(loaded))
+        return
+    remaining = iter(jobs)
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+        futures = {}
+        while True:
+            for job in remaining:
+                loaded, failed = load(job)
+                if failed:
+                    yield failed
+                    continue
+                futures[executor.submit(evaluate_config, loaded)] = job
+                if len(futures) >= workers * 2:
+                    break
+            if not futures:
+                return
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = futures.pop(future)
+                try:
+                    yield finish(future.result())
+                except Exception as e:
+                    yield {'key': job['key'], 'error': str(e), 'results': {}}
+
+class _ResultWriter:
+    """把求值结果写入数据库：替换设备对应规则的结果并更新设备状态，按批提交"""
+
+    def __init__(self):
+        self.results = []
+        self.new_states = []
+        self.updated_states = []
+        self.devices = 0
+        self.failed_devices = 0
+
+    def add(self, plan: Dict[str, Any], evaluated: Dict[int, Dict[str, Any]], now: datetime):
+        rule_states = {rule_id: value for rule_id, value in plan['previous'].items() if rule_id in plan['revisions']}
+        replaced = list(plan['needed']) + list(plan['removed'])
+        if replaced:
+            db.session.execute(delete(ComplianceResult).where(
+                ComplianceResult.device_id == plan['device_id'], ComplianceResult.rule_id.in_(replaced)))
+        for rule_id in plan['needed']:
+            result = evaluated[rule_id]
+            rule_states[rule_id] = [plan['revisions'][rule_id], result['status']]
+            self.results.append({
+                'device_id': plan['device_id'],
+                'rule_id': rule_id,
+                'task_id': plan['task_id'],
+                'file_hash': plan['key'],
+                'rule_revision': plan['revisions'][rule_id],
+                'status': result['status'],
+                'violation_count': result['violation_count'],
+                'violations': json.dumps(result['violations'], ensure_ascii=False) if result['violations'] else None,
+                'evaluated_at': now
+            })
+
+        failed = sum(1 for _, status in rule_states.values() if status == 'fail')
+        state = {
+            'device_id': plan['device_id'],
+            'task_id': plan['task_id'],
+            'file_hash': plan['key'],
+            'rule_states': json.dumps({str(rule_id): value for rule_id, value in sorted(rule_states.items())}),
+            'failed_rules': failed,
+            'passed_rules': sum(1 for _, status in rule_states.values() if status == 'pass'),
+            'evaluated_at': now
+        }
+        (self.new_states if plan['new'] else self.updated_states).append(state)
+        self.devices += 1
+        if failed:
+            self.failed_devices += 1
+        if len(self.new_states) + len(self.updated_states) >= WRITE_BATCH:
+            self.flush()
+
+    def flush(self):
+        if self.results:
+            db.session.execute(insert(ComplianceResult), self.results)
+        if self.new_states:
+            db.session.execute(insert(DeviceCompliance), self.new_states)
+        if self.updated_states:
+            db.session.execute(update(DeviceCompliance), self.updated_states)
+        db.session.commit()
+        self.results, self.new_states, self.updated_states = [], [], []
+
+def run_compliance(service, device_ids: Optional[List[int]] = None, full: bool = False,
+                   workers: int = Config.COMPLIANCE_WORKERS) -> Optional[Dict[str, Any]]:
+    """增量检查设备的合规状态，返回本次检查的统计；已有检查在运行时返回None
+
+    full为True时忽略上次的检查结果，重新检查全部设备和规则
+    """
+    global last_run
+    if not _run_lock.acquire(blocking=False):
+        return None
+    try:
+        started = time.time()
+        rules = ComplianceRule.query.filter_by(is_active=True).order_by(ComplianceRule.id).all()
+        specs = {rule.id: rule.to_spec() for rule in rules}
+        planned = plan_devices(service, rules, device_ids, full)
+        plans = planned['plans']
+        jobs = _build_jobs(plans, specs)
+        _remove_devices(planned['stale'])
+        db.session.commit()  # 结束事务，求值期间不占用数据库
+
+        writer = _ResultWriter()
+        now = datetime.utcnow()
+        errors = 0
+        by_key: Dict[str, List[Dict[str, Any]]] = {}
+        for plan in plans:
+            if plan['needed']:
+                by_key.setdefault(plan['key'], []).append(plan)
+            else:
+                writer.add(plan, {}, now)  # 只有规则被删除或停用
+
+        evaluated_configs = 0
+        try:
+            for outcome in _evaluate(service, jobs, workers):
+                if outcome.get('error'):
+                    errors += len(by_key[outcome['key']])
+                    logger.error(f"合规检查备份内容 {outcome['key'][:12]} 失败: {outcome['error']}")
+                    continue
+                evaluated_configs += 1
+                for plan in by_key[outcome['key']]:
+                    writer.add(plan, outcome['results'], now)
+            writer.flush()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        last_run = {
+            'finished_at': datetime.utcnow().isoformat(),
+            'full': full,
+            'rules': len(rules),
+            'devices': planned['devices'],
+            'evaluated_devices': writer.devices,
+            'skipped_devices': planned['skipped'],
+            'removed_devices': len(planned['stale']),
+            'evaluated_configs': evaluated_configs,
+            'failed_devices': writer.failed_devices,
+            'errors': errors,
+            'elapsed': round(time.time() - started, 3)
+        }
+        logger.info(f"合规检查完成: 检查 {writer.devices} 台设备（{evaluated_configs} 份备份内容），"
+                    f"跳过 {planned['skipped']} 台未变化的设备，耗时 {last_run['elapsed']} 秒")
+        return last_run
+    finally:
+        _run_lock.release()
+
+def is_running() -> bool:
+    return _run_lock.locked()
+
+def compliance_job():
+    """计划任务入口：增量合规检查"""
+    from app import app
+    from backup_service import BackupService
+
+    with app.app_context():
+        try:
+            run_compliance(BackupService())
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"合规检查失败: {str(e)}")
+
+def rule_summary() -> List[Dict[str, Any]]:
+    """各规则的检查结果统计"""
+    counts: Dict[int, Dict[str, int]] = {}
+    rows = db.session.query(ComplianceResult.rule_id, ComplianceResult.status, db.func.count(ComplianceResult.id)) \
+        .group_by(ComplianceResult.rule_id, ComplianceResult.status).all()
+    for rule_id, status, count in rows:
+        counts.setdefault(rule_id, {})[status] = count
+    summary = []
+    for rule in ComplianceRule.query.order_by(ComplianceRule.id).all():
+        rule_counts = counts.get(rule.id, {})
+        summary.append({
+            'rule_id': rule.id,
+            'name': rule.name,
+            'severity': rule.severity,
+            'is_active': rule.is_active,
+            'pass': rule_counts.get('pass', 0),
+            'fail': rule_counts.get('fail', 0),
+            'not_applicable': rule_counts.get('not_applicable', 0)
+        })
+    return summary
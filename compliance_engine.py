@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+合规规则求值
+规则要求配置必须包含（required）或不得包含（forbidden）某一行，可限定在首行匹配给定正则的
+配置段内检查。本模块不访问数据库和磁盘缓存，在合规检查的工作进程中运行：
+备份内容由主进程读取后传入，配置段解析结果返回主进程按内容哈希缓存，之后的检查直接复用
+"""
+
+import re
+from typing import Dict, Any, List, Optional, Tuple
+
+from config_sections import parse_sections
+
+RULE_TYPES = ('required', 'forbidden')
+MATCH_TYPES = ('literal', 'regex')
+MAX_VIOLATIONS = 50  # 每条规则记录的违规行数
+PARSE_CACHE_VERSION = 1  # 解析结果的格式变化时递增
+
+def validate_rule(rule_type: str, match_type: str, pattern: str, section: Optional[str] = None):
+    """检查规则定义，无效时抛出ValueError"""
+    if rule_type not in RULE_TYPES:
+        raise ValueError(f'rule_type 只能是 {" 或 ".join(RULE_TYPES)}')
+    if match_type not in MATCH_TYPES:
+        raise ValueError(f'match_type 只能是 {" 或 ".join(MATCH_TYPES)}')
+    if not pattern or not pattern.strip():
+        raise ValueError('pattern 不能为空')
+    for name, value in (('pattern', pattern if match_type == 'regex' else None), ('section', section)):
+        if value:
+            try:
+                re.compile(value)
+            except re.error as e:
+                raise ValueError(f'{name} 不是有效的正则表达式: {str(e)}')
+
+def _normalize(line: str) -> str:
+    return ' '.join(line.split())
+
+class CompiledRule:
+    """编译后的规则：literal与去掉多余空白后的整行比较，regex在行内查找"""
+
+    def __init__(self, spec: Dict[str, Any]):
+        self.id = spec['id']
+        self.required = spec['rule_type'] == 'required'
+        self.literal = _normalize(spec['pattern']) if spec['match_type'] == 'literal' else None
+        self.regex = re.compile(spec['pattern']) if spec['match_type'] == 'regex' else None
+        self.section = re.compile(spec['section']) if spec.get('section') else None
+
+    def matches(self, line: str) -> bool:
+        if self.literal is not None:
+            return _normalize(line) == self.literal
+        return self.regex.search(line) is not None
+
+class ParsedConfig:
+    """一份配置的行和配置段（首行序号, 开始, 结束）"""
+
+    def __init__(self, lines: List[str], sections: List[Tuple[int, int, int]]):
+        self.lines = lines
+        self.sections = sections
+        self._normalized = None
+
+    @property
+    def normalized(self) -> set:
+        """整个配置中所有行去掉多余空白后的集合（整行比较的规则直接查找）"""
+        if self._normalized is None:
+            self._normalized = {_normalize(line) for line in self.lines}
+        return self._normalized
+
+def parse_config(lines: List[str]) -> List[Tuple[int, int, int]]:
+    """把配置解析为配置段列表（包括嵌套的段），按首行顺序排列"""
+    sections = []
+    pending = list(reversed(parse_sections(lines).sections))
+    while pending:
+        node = pending.pop()
+        sections.append((node.line, node.start, node.end))
+        pending.extend(reversed(node.sections))
+    return sections
+
+def _scopes(rule: CompiledRule, config: ParsedConfig) -> List[Tuple[Optional[int], int, int]]:
+    """规则检查的范围：(段首行序号, 开始, 结束)，没有限定配置段时为整个配置"""
+    if rule.section is None:
+        return [(None, 0, len(config.lines))]
+    return [(line, line + 1, end) for line, start, end in config.sections
+            if rule.section.search(config.lines[line].strip())]
+
+def _may_match(rule: CompiledRule, config: ParsedConfig) -> bool:
+    """整个配置中是否可能有匹配的行，没有时不必逐行查找
+
+    只对整行比较的规则预先判断；正则在整段文本和单行上的匹配结果不一定相同
+    （如\\A、\\Z和后行断言），只能逐行查找
+    """
+    if rule.literal is not None:
+        return rule.literal in config.normalized
+    return True
+
+def evaluate_rule(rule: CompiledRule, config: ParsedConfig) -> Dict[str, Any]:
+    """对一份配置求值一条规则，返回状态（pass/fail/not_applicable）和违规项"""
+    scopes = _scopes(rule, config)
+    if not scopes:
+        return {'status': 'not_applicable', 'violation_count': 0, 'violations': []}
+
+    violations = []
+    possible = _may_match(rule, config)
+    if rule.required:
+        for header, start, end in scopes:
+            if not possible:
+                found = False
+            elif rule.section is None and rule.literal is not None:
+                found = True
+            else:
+                found = any(rule.matches(config.lines[index]) for index in range(start, end))
+            if not found:
+                violations.append({
+                    'section': config.lines[header].strip() if header is not None else None,
+                    'line': header + 1 if header is not None else None,
+                    'content': None
+                })
+    elif possible:
+        seen = set()  # 嵌套的段都匹配时同一行只记录一次
+        for header, start, end in scopes:
+            for index in range(start, end):
+                if index not in seen and rule.matches(config.lines[index]):
+                    seen.add(index)
+                    violations.append({
+                        'section': config.lines[header].strip() if header is not None else None,
+                        'line': index + 1,
+                        'content': config.lines[index]
+                    })
+
+    return {
+        'status': 'fail' if violations else 'pass',
+        'violation_count': len(violations),
+        'violations': violations[:MAX_VIOLATIONS]
+    }
+
+def _split_lines(content: str) -> List[str]:
+    lines = [line.rstrip('\r') for line in content.split('\n')]
+    if lines and lines[-1] == '':
+        lines.pop()
+    return lines
+
+def sections_cache_key(key: str) -> str:
+    """配置段解析结果的缓存键"""
+    return f'sections-{key}-v{PARSE_CACHE_VERSION}'
+
+def evaluate_config(job: Dict[str, Any]) -> Dict[str, Any]:
+    """工作进程入口：对一份备份内容求值给定的规则
+
+    job包含key（内容哈希）、content（备份文本）、sections（缓存的配置段，没有时为None）
+    和rules（规则定义列表），返回 {'key': ..., 'results': {规则ID: 求值结果}, 'sections': ...}；
+    sections只在本次重新解析时返回，由主进程写入缓存
+    """
+    lines = _split_lines(job['content'])
+    sections = job.get('sections')
+    parsed = sections is None
+    if parsed:
+        sections = parse_config(lines)
+    config = ParsedConfig(lines, [tuple(section) for section in sections])
+    results = {}
+    for spec in job['rules']:
+        results[spec['id']] = evaluate_rule(CompiledRule(spec), config)
+    return {'key': job['key'], 'results': results, 'sections': sections if parsed else None}
@@ -15,6 +15,15 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///backup_system.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
+    # 数据库连接设置
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', int(os.environ.get('MAX_CONCURRENT_BACKUPS', 10)) + 20))  # 连接池大小，默认为备份工作线程数加20
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))  # 连接池允许超出的连接数
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))  # 等待空闲连接的超时时间（秒）
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')  # WAL模式下读写互不阻塞
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')  # WAL模式下NORMAL不会损坏数据库
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 30000))  # 等待写锁的超时时间（毫秒）
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))  # 内存映射读取的大小（字节）
+    
     # 文件上传设置
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB
     UPLOAD_FOLDER = 'uploads'
@@ -24,7 +33,34 @@ class Config:
     MAX_CONCURRENT_BACKUPS = int(os.environ.get('MAX_CONCURRENT_BACKUPS', 10))
     BACKUP_TIMEOUT = int(os.environ.get('BACKUP_TIMEOUT', 300))  # 5分钟
     COMPRESS_BACKUPS = os.environ.get('COMPRESS_BACKUPS', 'false').lower() == 'true'
+    BACKUP_KEYFRAME_INTERVAL = int(os.environ.get('BACKUP_KEYFRAME_INTERVAL', 10))  # 每隔多少个版本保存完整快照，其余版本保存行级差异
+    BACKUP_SKIP_UNCHANGED = os.environ.get('BACKUP_SKIP_UNCHANGED', 'true').lower() == 'true'  # 配置变更标记未变化时跳过完整备份
     ENABLE_DIFF = os.environ.get('ENABLE_DIFF', 'true').lower() == 'true'
+    BACKUP_ENGINE = os.environ.get('BACKUP_ENGINE', 'thread').lower()  # thread 或 asyncio（需要asyncssh）
+    ASYNC_BACKUP_MAX_SESSIONS = int(os.environ.get('ASYNC_BACKUP_MAX_SESSIONS', 200))  # 异步引擎最大并发会话数
+    SSH_KNOWN_HOSTS = os.environ.get('SSH_KNOWN_HOSTS', '~/.ssh/known_hosts')  # 异步引擎校验设备主机密钥的known_hosts文件，none表示不校验
+    BATCH_MAX_PARALLEL = int(os.environ.get('BATCH_MAX_PARALLEL', 0)) or None  # 批量备份最大并发数，默认与备份引擎容量一致
+    BATCH_INITIAL_PARALLEL = int(os.environ.get('BATCH_INITIAL_PARALLEL', 4))  # 批量备份初始并发数
+    BATCH_SITE_MAX_PARALLEL = int(os.environ.get('BATCH_SITE_MAX_PARALLEL', 8))  # 同一站点（IPv4 /24）的最大并发数
+    TASK_LOG_BATCH_SIZE = int(os.environ.get('TASK_LOG_BATCH_SIZE', 200))  # 任务日志批量写入的条数
+    TASK_LOG_FLUSH_INTERVAL = float(os.environ.get('TASK_LOG_FLUSH_INTERVAL', 0.5))  # 任务日志最长写入间隔（秒）
+    STATISTICS_RECONCILE_INTERVAL = int(os.environ.get('STATISTICS_RECONCILE_INTERVAL', 3600))  # 统计计数器与任务表核对的间隔（秒）
+    OBJECT_GC_INTERVAL = int(os.environ.get('OBJECT_GC_INTERVAL', 3600))  # 清理无引用备份对象和暂存区残留文件的间隔（秒）
+    CACHE_DIR = os.environ.get('CACHE_DIR', 'cache')  # 还原后的备份内容、行索引、差异结果等缓存目录
+    CACHE_MAX_SIZE_MB = int(os.environ.get('CACHE_MAX_SIZE_MB', 1024))  # 缓存目录的大小上限（MB）
+    REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', os.cpu_count() or 4))  # 变更报告比较备份的工作进程数
+    SEARCH_INDEX_ENABLED = os.environ.get('SEARCH_INDEX_ENABLED', 'true').lower() == 'true'  # 备份完成时建立配置搜索索引
+    SEARCH_INDEX_INTERVAL = int(os.environ.get('SEARCH_INDEX_INTERVAL', 600))  # 补齐历史备份搜索索引的间隔（秒）
+    SEARCH_INDEX_BATCH = int(os.environ.get('SEARCH_INDEX_BATCH', 200))  # 每次补齐索引的备份内容数
+    SEARCH_MAX_LINES = int(os.environ.get('SEARCH_MAX_LINES', 2000))  # 一次搜索最多匹配的不同配置行数
+    COMPLIANCE_WORKERS = int(os.environ.get('COMPLIANCE_WORKERS', os.cpu_count() or 4))  # 合规检查求值的工作进程数
+    COMPLIANCE_INTERVAL = int(os.environ.get('COMPLIANCE_INTERVAL', 3600))  # 增量合规检查的间隔（秒）
+    
+    # SSH连接池设置
+    SSH_POOL_MAX_CONNECTIONS = int(os.environ.get('SSH_POOL_MAX_CONNECTIONS', 10))  # 全局最大连接数
+    SSH_POOL_MAX_PER_DEVICE = int(os.environ.get('SSH_POOL_MAX_PER_DEVICE', 2))  # 单设备最大连接数
+    SSH_POOL_IDLE_TTL = int(os.environ.get('SSH_POOL_IDLE_TTL', 300))  # 空闲连接存活时间（秒）
+    SSH_POOL_CHECKOUT_TIMEOUT = int(os.environ.get('SSH_POOL_CHECKOUT_TIMEOUT', 60))  # 等待连接超时（秒）
     
     # 安全设置
     ENCRYPTION_KEY = os.environ.get('ENCRYPTION_KEY') or 'default-encryption-key-change-in-production'
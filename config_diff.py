@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+配置差异比较
+使用patience/histogram算法按行比较两份设备配置：以两边都只出现一次（或出现次数最少）
+的行作为锚点递归划分，时间和空间都接近线性，十万行的配置也能快速比较，结果不做截断。
+被替换的行按配置关键字（缩进加命令的前几个词）配对，报告真实的修改行。
+"""
+
+import re
+from bisect import bisect_left
+from typing import Dict, Any, List, Optional, Tuple
+
+WHITESPACE = re.compile(r'\s+')
+
+# 计算量超过 (旧行数 + 新行数) 的该倍数后，剩余无法快速划分的区域按整体替换处理
+WORK_FACTOR = 64
+
+Opcode = Tuple[str, int, int, int, int]
+
+def normalize_line(line: str, ignore_whitespace: bool = False, ignore_case: bool = False) -> str:
+    """按比较选项规范化一行"""
+    if ignore_whitespace:
+        line = WHITESPACE.sub(' ', line).strip()
+    if ignore_case:
+        line = line.lower()
+    return line
+
+def _intern(old_lines: List, new_lines: List, ignore_whitespace: bool = False,
+            ignore_case: bool = False) -> Tuple[List[int], List[int]]:
+    """把每一行映射为整数，相同的行（按比较选项）得到相同的整数"""
+    ids: Dict = {}
+    normalize = ignore_whitespace or ignore_case
+
+    def convert(lines):
+        result = []
+        for line in lines:
+            key = normalize_line(line, ignore_whitespace, ignore_case) if normalize else line
+            result.append(ids.setdefault(key, len(ids)))
+        return result
+
+    return convert(old_lines), convert(new_lines)
+
+def _longest_increasing(pairs: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """pairs按第二项递增排列，取第一项也递增的最长子序列（patience排序）"""
+    tails: List[int] = []  # 各长度子序列末尾元素的第一项
+    tail_index: List[int] = []
+    previous: List[int] = []
+    for index, (i, _) in enumerate(pairs):
+        position = bisect_left(tails, i)
+        if position == len(tails):
+            tails.append(i)
+            tail_index.append(index)
+        else:
+            tails[position] = i
+            tail_index[position] = index
+        previous.append(tail_index[position - 1] if position > 0 else -1)
+
+    result = []
+    index = tail_index[-1] if tail_index else -1
+    while index >= 0:
+        result.append(pairs[index])
+        index = previous[index]
+    result.reverse()
+    return result
+
+def _anchors(a: List[int], alo: int, ahi: int, b: List[int], blo: int, bhi: int) -> List[Tuple[int, int]]:
+    """区域内的锚点：优先使用两边都唯一的行，没有时使用两边都出现且次数最少的行"""
+    count_a: Dict[int, int] = {}
+    first_a: Dict[int, int] = {}
+    for i in range(alo, ahi):
+        value = a[i]
+        count_a[value] = count_a.get(value, 0) + 1
+        first_a.setdefault(value, i)
+    count_b: Dict[int, int] = {}
+    for j in range(blo, bhi):
+        value = b[j]
+        if value in count_a:
+            count_b[value] = count_b.get(value, 0) + 1
+    if not count_b:
+        return []
+
+    unique = [(first_a[b[j]], j) for j in range(blo, bhi)
+              if count_b.get(b[j]) == 1 and count_a[b[j]] == 1]
+    if unique:
+        return _longest_increasing(unique)
+
+    # histogram：出现次数最少的行，两边第k次出现依次配对
+    rarest = min(count_b, key=lambda value: (max(count_a[value], count_b[value]), value))
+    positions_a = [i for i in range(alo, ahi) if a[i] == rarest]
+    positions_b = [j for j in range(blo, bhi) if b[j] == rarest]
+    return list(zip(positions_a, positions_b))
+
+def match_lines(a: List[int], b: List[int]) -> List[Tuple[int, int]]:
+    """两个序列中相等且顺序一致的位置对 (i, j)，按顺序返回"""
+    budget = WORK_FACTOR * (len(a) + len(b)) + 100000
+    matches: List[Tuple[int, int]] = []
+    # 栈中的项：('match', i, j) 或 ('region', alo, ahi, blo, bhi)，逆序压栈以保证输出顺序
+    stack: List[Tuple] = [('region', 0, len(a), 0, len(b))]
+    while stack:
+        item = stack.pop()
+        if item[0] == 'match':
+            matches.append((item[1], item[2]))
+            continue
+        _, alo, ahi, blo, bhi = item
+
+        # 去掉相同的开头和结尾
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matches.append((alo, blo))
+            alo += 1
+            blo += 1
+        suffix = []
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            suffix.append(('match', ahi, bhi))
+        stack.extend(suffix)
+        if alo == ahi or blo == bhi:
+            continue
+
+        budget -= (ahi - alo) + (bhi - blo)
+        anchors = _anchors(a, alo, ahi, b, blo, bhi) if budget > 0 else []
+        if not anchors:
+            continue  # 整个区域为替换
+
+        pending = []
+        i, j = alo, blo
+        for anchor_i, anchor_j in anchors:
+            pending.append(('region', i, anchor_i, j, anchor_j))
+            pending.append(('match', anchor_i, anchor_j))
+            i, j = anchor_i + 1, anchor_j + 1
+        pending.append(('region', i, ahi, j, bhi))
+        stack.extend(reversed(pending))
+    return matches
+
+def opcodes(a: List[int], b: List[int]) -> List[Opcode]:
+    """与difflib.SequenceMatcher.get_opcodes相同格式的编辑操作"""
+    result: List[Opcode] = []
+    i = j = 0
+    for match_i, match_j in match_lines(a, b) + [(len(a), len(b))]:
+        if i < match_i and j < match_j:
+            result.append(('replace', i, match_i, j, match_j))
+        elif i < match_i:
+            result.append(('delete', i, match_i, j, j))
+        elif j < match_j:
+            result.append(('insert', i, i, j, match_j))
+        if match_i < len(a):
+            if result and result[-1][0] == 'equal':
+                tag, i1, _, j1, _ = result[-1]
+                result[-1] = ('equal', i1, match_i + 1, j1, match_j + 1)
+            else:
+                result.append(('equal', match_i, match_i + 1, match_j, match_j + 1))
+        i, j = match_i + 1, match_j + 1
+    return result
+
+def line_opcodes(old_lines: List, new_lines: List) -> List[Opcode]:
+    """两组行（字符串或字节串）之间的编辑操作"""
+    a, b = _intern(old_lines, new_lines)
+    return opcodes(a, b)
+
+def config_key(line: str, words: int = 2) -> str:
+    """配置行的关键字：缩进加命令的前几个词（不含最后一个词，即参数值），no形式与肯定形式相同
+
+    例如 ' ip address 10.0.0.1 255.255.255.0' 和 ' ip address 10.0.0.2 255.255.255.0'
+    的关键字相同，会被配对为修改行
+    """
+    stripped = line.lstrip()
+    indent = line[:len(line) - len(stripped)]
+    parts = stripped.split()
+    if parts and parts[0] == 'no':
+        parts = parts[1:]
+    return indent + ' '.join(parts[:max(1, min(words, len(parts) - 1))])
+
+def pair_modified(old_lines: List[str], new_lines: List[str]) -> List[Tuple[int, int]]:
+    """被替换的两段行中按配置关键字配对的修改行 (旧行序号, 新行序号)
+
+    先按前两个词配对，剩余的行再按第一个词配对
+    """
+    old_keys, new_keys = _intern([config_key(line) for line in old_lines],
+                                 [config_key(line) for line in new_lines])
+    pairs = []
+    i = j = 0
+    for match_i, match_j in match_lines(old_keys, new_keys) + [(len(old_lines), len(new_lines))]:
+        if i < match_i and j < match_j:
+            old_words, new_words = _intern([config_key(line, 1) for line in old_lines[i:match_i]],
+                                           [config_key(line, 1) for line in new_lines[j:match_j]])
+            pairs.extend((i + gap_i, j + gap_j) for gap_i, gap_j in match_lines(old_words, new_words))
+        if match_i < len(old_lines):
+            pairs.append((match_i, match_j))
+        i, j = match_i + 1, match_j + 1
+    return pairs
+
+def _grouped(codes: List[Opcode], context: int) -> List[List[Opcode]]:
+    """按上下文行数把编辑操作分组为差异块（与difflib.get_grouped_opcodes相同的规则）"""
+    if not codes:
+        return []
+    codes = list(codes)
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+
+    groups = []
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > context * 2:
+            group.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            groups.append(group)
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        groups.append(group)
+    return groups
+
+def _format_range(start: int, stop: int, numbers: Optional[List[int]] = None) -> str:
+    """统一差异格式的行范围，numbers为各行在原文件中的行号（从1开始）"""
+    length = stop - start
+    if numbers is None:
+        beginning = start + 1 if length else start
+    elif length:
+        beginning = numbers[start]
+    else:
+        beginning = numbers[start - 1] if start else 0
+    if length == 1:
+        return f'{beginning}'
+    return f'{beginning},{length}'
+
+def diff_lines(old_lines: List[str], new_lines: List[str], context: int = 3,
+               ignore_whitespace: bool = False, ignore_case: bool = False,
+               old_numbers: Optional[List[int]] = None, new_numbers: Optional[List[int]] = None,
+               label: str = '') -> Dict[str, Any]:
+    """比较两组行，返回统计、差异块和差异块文本行（不含文件头）
+
+    old_numbers/new_numbers 为各行在原文件中的行号，用于只比较文件中部分行（如一个配置段）的情况；
+    label 附加在差异块头部 @@ 之后，标明差异所在的配置段
+    """
+    codes = opcodes(*_intern(old_lines, new_lines, ignore_whitespace, ignore_case))
+    old_number = (lambda i: old_numbers[i]) if old_numbers is not None else (lambda i: i + 1)
+    new_number = (lambda j: new_numbers[j]) if new_numbers is not None else (lambda j: j + 1)
+
+    # 替换块中按关键字配对的行记为修改，其余为新增或删除
+    pairs: Dict[int, int] = {}
+    reverse_pairs: Dict[int, int] = {}
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'replace':
+            for old_index, new_index in pair_modified(old_lines[i1:i2], new_lines[j1:j2]):
+                pairs[i1 + old_index] = j1 + new_index
+                reverse_pairs[j1 + new_index] = i1 + old_index
+    removed_total = sum(i2 - i1 for tag, i1, i2, _, _ in codes if tag in ('delete', 'replace'))
+    added_total = sum(j2 - j1 for tag, _, _, j1, j2 in codes if tag in ('insert', 'replace'))
+    modified_lines = len(pairs)
+
+    diff_blocks = []
+    raw_lines = []
+    for group in _grouped(codes, context):
+        first, last = group[0], group[-1]
+        header = (f'@@ -{_format_range(first[1], last[2], old_numbers)} '
+                  f'+{_format_range(first[3], last[4], new_numbers)} @@')
+        if label:
+            header = f'{header} {label}'
+        raw_lines.append(header)
+        changes = []
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for offset in range(i2 - i1):
+                    changes.append({'type': 'context', 'content': old_lines[i1 + offset],
+                                    'old_line': old_number(i1 + offset), 'new_line': new_number(j1 + offset)})
+                    raw_lines.append(' ' + old_lines[i1 + offset])
+                continue
+            for i in range(i1, i2):
+                change = {'type': 'removed', 'content': old_lines[i], 'old_line': old_number(i)}
+                if i in pairs:
+                    change['modified'] = True
+                    change['pair_line'] = new_number(pairs[i])
+                changes.append(change)
+                raw_lines.append('-' + old_lines[i])
+            for j in range(j1, j2):
+                change = {'type': 'added', 'content': new_lines[j], 'new_line': new_number(j)}
+                if j in reverse_pairs:
+                    change['modified'] = True
+                    change['pair_line'] = old_number(reverse_pairs[j])
+                changes.append(change)
+                raw_lines.append('+' + new_lines[j])
+        diff_blocks.append({'header': header, 'changes': changes})
+
+    return {
+        'summary': change_summary(added_total - modified_lines, removed_total - modified_lines, modified_lines),
+        'diff_blocks': diff_blocks,
+        'raw_lines': raw_lines
+    }
+
+def change_summary(added_lines: int, removed_lines: int, modified_lines: int) -> Dict[str, Any]:
+    """差异统计"""
+    total_changes = added_lines + removed_lines + modified_lines
+    return {
+        'total_changes': total_changes,
+        'added_lines': added_lines,
+        'removed_lines': removed_lines,
+        'modified_lines': modified_lines,
+        'has_changes': total_changes > 0
+    }
+
+def unified_text(raw_lines: List[str], fromfile: str, tofile: str) -> str:
+    """加上文件头的统一差异文本，没有差异时为空"""
+    if not raw_lines:
+        return ''
+    return '\n'.join([f'--- {fromfile}', f'+++ {tofile}'] + raw_lines)
+
+def diff_configs(old_content: str, new_content: str, context: int = 3,
+                 ignore_whitespace: bool = False, ignore_case: bool = False,
+                 fromfile: str = '旧配置', tofile: str = '新配置') -> Dict[str, Any]:
+    """逐行比较两份配置，返回统计、差异块和统一差异文本"""
+    old_lines = old_content.splitlines()
+    new_lines = new_content.splitlines()
+    result = diff_lines(old_lines, new_lines, context, ignore_whitespace, ignore_case)
+    summary = result['summary']
+    summary['old_lines'] = len(old_lines)
+    summary['new_lines'] = len(new_lines)
+    return {
+        'summary': summary,
+        'diff_blocks': result['diff_blocks'],
+        'raw_diff': unified_text(result['raw_lines'], fromfile, tofile)
+    }
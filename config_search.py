@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+配置全文搜索
+所有备份（最新和历史版本）中的配置行去重后存入search_lines，SQLite上用FTS5三元组索引
+（trigram）支持任意子串查找；倒排表search_postings记录每一行出现在哪些备份内容和行号。
+备份内容按内容哈希只索引一次，备份完成后由单个后台线程增量建立，计划任务补齐历史备份和清理已删除的内容。
+正则搜索先用正则中必须出现的固定文本经索引筛选候选行，再逐行匹配
+"""
+
+import hashlib
+import logging
+import queue
+import re
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants  # Python 3.11+
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+from sqlalchemy import delete, func, insert, select, text
+
+from config import Config
+from models import db, Device, BackupTask, SearchLine, SearchDocument, SearchPosting
+
+logger = logging.getLogger(__name__)
+
+MAX_MATCHES_PER_RESULT = 20  # 每个结果返回的匹配行数
+SNIPPET_LENGTH = 200  # 匹配行过长时截取的长度
+MIN_LITERAL_LENGTH = 3  # 三元组索引能查找的最短文本
+IN_QUERY_CHUNK = 500  # 批量IN查询每次的ID数量
+FTS_TABLE = 'search_lines_fts'
+REPEAT_OPS = tuple(getattr(sre_constants, name) for name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+                   if hasattr(sre_constants, name))
+ATOMIC_GROUP = getattr(sre_constants, 'ATOMIC_GROUP', None)  # Python 3.11+
+
+# 同一进程内串行写入索引，减少并发备份争用SQLite写锁
+_index_lock = threading.Lock()
+_fts_available = None
+
+def create_fts_table(conn):
+    """创建search_lines的FTS5三元组索引（外部内容表，只存索引不重复存行内容）
+
+    非SQLite数据库或SQLite不支持FTS5三元组分词时不创建，搜索退回LIKE查询
+    """
+    global _fts_available
+    _fts_available = None
+    if conn.dialect.name != 'sqlite':
+        return False
+    exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                          {'name': FTS_TABLE}).first()
+    if exists:
+        return True
+    try:
+        conn.execute(text(
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+            f"text, content='search_lines', content_rowid='id', tokenize='trigram')"
+        ))
+        # 已有的配置行（FTS5不可用时建立的索引）补进全文索引
+        conn.execute(text(f"INSERT INTO {FTS_TABLE}(rowid, text) SELECT id, text FROM search_lines"))
+    except Exception as e:
+        logger.warning(f"SQLite不支持FTS5三元组索引，配置搜索使用LIKE查询: {str(e)}")
+        return False
+    logger.info(f"已创建全文索引表 {FTS_TABLE}")
+    return True
+
+def fts_available() -> bool:
+    """全文索引表是否存在（检查一次后缓存）"""
+    global _fts_available
+    if _fts_available is None:
+        with db.engine.connect() as conn:
+            _fts_available = conn.dialect.name == 'sqlite' and conn.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {'name': FTS_TABLE}).first() is not None
+    return _fts_available
+
+def split_lines(content: str) -> List[str]:
+    """按换行符拆分配置（与按行读取备份内容的行号一致）"""
+    lines = [line.rstrip('\r') for line in content.split('\n')]
+    if lines and lines[-1] == '':
+        lines.pop()
+    return lines
+
+def _digest(line: str) -> str:
+    return hashlib.sha1(line.encode('utf-8', 'surrogateescape')).hexdigest()
+
+def _chunks(values: List, size: int = IN_QUERY_CHUNK):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def is_indexed(file_hash: str) -> bool:
+    return db.session.query(SearchDocument.id).filter(SearchDocument.file_hash == file_hash).first() is not None
+
+def index_backup(service, record) -> bool:
+    """为任务的备份内容建立索引，已建立过、没有内容哈希（对象存储之前的旧备份）或文件不存在时返回False"""
+    if not Config.SEARCH_INDEX_ENABLED or record is None or not record.file_hash:
+        return False
+    if is_indexed(record.file_hash):
+        return False
+    content = service.read_backup_content(record)
+    if content is None:
+        return False
+    return index_content(record.file_hash, content)
+
+def index_content(file_hash: str, content: str) -> bool:
+    """索引一份备份内容：登记新出现的配置行，写入倒排表
+
+    先插入文档记录取得写锁，之后读取已有的行都在同一写事务中，多个进程同时索引也不会重复登记
+    """
+    positions: Dict[str, List[int]] = {}
+    texts: Dict[str, str] = {}
+    lines = split_lines(content)
+    for number, line in enumerate(lines, 1):
+        line = line.rstrip()
+        if line.strip() in ('', '!'):
+            continue
+        digest = _digest(line)
+        if digest not in positions:
+            positions[digest] = []
+            texts[digest] = line
+        positions[digest].append(number)
+
+    with _index_lock:
+        db.session.commit()  # 结束之前的读事务，写事务从插入文档记录开始
+        try:
+            document_id = db.session.execute(insert(SearchDocument).values(
+                file_hash=file_hash, line_count=len(lines), indexed_at=datetime.utcnow()
+            )).inserted_primary_key[0]
+
+            digests = list(positions)
+            line_ids: Dict[str, int] = {}
+            for chunk in _chunks(digests):
+                line_ids.update(db.session.execute(
+                    select(SearchLine.digest, SearchLine.id).where(SearchLine.digest.in_(chunk))).all())
+            new_digests = [digest for digest in digests if digest not in line_ids]
+            for chunk in _chunks(new_digests):
+                db.session.execute(insert(SearchLine), [{'digest': digest, 'text': texts[digest]} for digest in chunk])
+                new_ids = db.session.execute(
+                    select(SearchLine.digest, SearchLine.id).where(SearchLine.digest.in_(chunk))).all()
+                line_ids.update(new_ids)
+                if fts_available():
+                    db.session.execute(text(f"INSERT INTO {FTS_TABLE}(rowid, text) VALUES (:id, :text)"),
+                                       [{'id': line_id, 'text': texts[digest]} for digest, line_id in new_ids])
+
+            if positions:
+                db.session.execute(insert(SearchPosting), [{
+                    'line_id': line_ids[digest],
+                    'document_id': document_id,
+                    'line_numbers': ','.join(map(str, numbers))
+                } for digest, numbers in positions.items()])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            if is_indexed(file_hash):
+                return False  # 其他进程已经索引了同一内容
+            raise
+    logger.info(f"已索引备份内容 {file_hash[:12]}: {len(lines)} 行，新增 {len(new_digests)} 个不同配置行")
+    return True
+
+class BackgroundIndexer:
+    """备份完成后的搜索索引由单个后台线程建立
+
+    备份工作线程只把任务ID放入队列，不在备份过程中持有索引锁和写事务；
+    进程退出时队列中未索引的备份由计划任务index_pending_job补齐
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, service, task_id: int):
+        """将任务的备份内容加入索引队列"""
+        with self._start_lock:
+            if not self._thread or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='config-search-indexer', daemon=True)
+                self._thread.start()
+        self._queue.put((service, task_id))
+
+    def _run(self):
+        from app import app
+
+        while True:
+            service, task_id = self._queue.get()
+            with app.app_context():
+                try:
+                    index_backup(service, db.session.get(BackupTask, task_id))
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"索引任务 {task_id} 的备份失败: {str(e)}")
+
+background_indexer = BackgroundIndexer()
+
+def _unreferenced():
+    """备份内容已没有任何任务引用"""
+    return ~db.session.query(BackupTask.id).filter(BackupTask.file_hash == SearchDocument.file_hash).exists()
+
+def purge_stale(limit: int = Config.SEARCH_INDEX_BATCH) -> int:
+    """删除不再被任何任务引用的备份内容的索引（配置行保留，供其他内容共用）
+
+    删除时在写事务中重新检查引用，期间新备份引用了同一内容时保留索引
+    """
+    document_ids = [row.id for row in db.session.query(SearchDocument.id).filter(_unreferenced()).limit(limit).all()]
+    if not document_ids:
+        return 0
+    with _index_lock:
+        db.session.commit()
+        try:
+            stale = db.session.query(SearchDocument.id).filter(
+                SearchDocument.id.in_(document_ids), _unreferenced()).scalar_subquery()
+            db.session.execute(delete(SearchPosting).where(SearchPosting.document_id.in_(stale)))
+            deleted = db.session.execute(delete(SearchDocument).where(
+                SearchDocument.id.in_(document_ids), _unreferenced())).rowcount
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    return deleted
+
+def index_pending(service, limit: int = Config.SEARCH_INDEX_BATCH) -> int:
+    """补齐尚未索引的成功备份（最近的备份优先），返回新索引的内容数"""
+    pending = db.session.query(func.max(BackupTask.id)).filter(
+        BackupTask.status == 'success',
+        BackupTask.file_hash.isnot(None),
+        ~db.session.query(SearchDocument.id).filter(SearchDocument.file_hash == BackupTask.file_hash).exists()
+    ).group_by(BackupTask.file_hash).order_by(func.max(BackupTask.id).desc()).limit(limit).all()
+
+    indexed = 0
+    for (task_id,) in pending:
+        try:
+            if index_backup(service, db.session.get(BackupTask, task_id)):
+                indexed += 1
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"索引任务 {task_id} 的备份失败: {str(e)}")
+    return indexed
+
+def index_pending_job():
+    """计划任务入口：清理已删除备份的索引并补齐历史备份的索引"""
+    from app import app
+    from backup_service import BackupService
+
+    if not Config.SEARCH_INDEX_ENABLED:
+        return
+    with app.app_context():
+        try:
+            purged = purge_stale()
+            indexed = index_pending(BackupService())
+            if purged or indexed:
+                logger.info(f"配置搜索索引已更新: 新索引 {indexed} 份备份，清理 {purged} 份")
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"更新配置搜索索引失败: {str(e)}")
+
+def required_literal(pattern: str) -> Optional[str]:
+    """正则表达式的每个匹配都必须包含的最长固定文本，无法确定时返回None
+
+    由re模块自己的解析器生成语法树，只取一定会出现的连续普通字符：
+    分组和至少重复一次的部分递归查找，分支、可选部分和字符类中断连续文本
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error:
+        return None
+    literal = max(_required_runs(parsed), key=len)
+    return literal or None
+
+def _required_runs(parsed) -> List[str]:
+    """语法树中一定会出现的各段连续固定文本"""
+    runs = []
+    current = ''
+    for op, value in parsed:
+        if op is sre_constants.LITERAL:
+            current += chr(value)
+            continue
+        if op is sre_constants.AT:
+            continue  # ^ $ \b等只匹配位置，不中断前后的文本
+        runs.append(current)
+        current = ''
+        if op is sre_constants.SUBPATTERN:
+            runs.extend(_required_runs(value[-1]))
+        elif op is sre_constants.ASSERT:
+            runs.extend(_required_runs(value[1]))  # 正向断言的内容也必须出现在行中
+        elif op in REPEAT_OPS and value[0] >= 1:
+            runs.extend(_required_runs(value[2]))
+        elif op is ATOMIC_GROUP:
+            runs.extend(_required_runs(value))
+    runs.append(current)
+    return runs
+
+def _fts_phrase(literal: str) -> str:
+    return '"' + literal.replace('"', '""') + '"'
+
+def _like_pattern(literal: str) -> str:
+    return '%' + literal.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def _candidate_lines(literal: str):
+    """包含给定文本（不区分大小写）的配置行 (id, 内容)"""
+    if fts_available():
+        return db.session.execute(
+            text(f"SELECT rowid, text FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :phrase"),
+            {'phrase': _fts_phrase(literal)})
+    return db.session.execute(
+        select(SearchLine.id, SearchLine.text).where(SearchLine.text.ilike(_like_pattern(literal), escape='\\')))
+
+def _matcher(query: str, regex: bool, ignore_case: bool):
+    """返回 (索引查找用的固定文本, 行 -> 匹配位置或None)"""
+    if regex:
+        try:
+            compiled = re.compile(query, re.IGNORECASE if ignore_case else 0)
+        except re.error as e:
+            raise ValueError(f'正则表达式无效: {str(e)}')
+        literal = required_literal(query)
+        if not literal or len(literal) < MIN_LITERAL_LENGTH:
+            raise ValueError(f'正则表达式中需要包含至少{MIN_LITERAL_LENGTH}个连续的固定字符，才能使用索引查找')
+
+        def match(line):
+            found = compiled.search(line)
+            return found.span() if found else None
+        return literal, match
+
+    if len(query) < MIN_LITERAL_LENGTH:
+        raise ValueError(f'搜索内容至少需要{MIN_LITERAL_LENGTH}个字符')
+    needle = query.lower() if ignore_case else query
+
+    def match(line):
+        position = (line.lower() if ignore_case else line).find(needle)
+        return (position, position + len(needle)) if position >= 0 else None
+    return query, match
+
+def _snippet(line: str, span: Tuple[int, int]) -> Dict[str, Any]:
+    """匹配行的内容和匹配位置，过长的行截取匹配位置附近的部分"""
+    start, end = span
+    offset = 0
+    if len(line) > SNIPPET_LENGTH:
+        offset = max(0, min(start - SNIPPET_LENGTH // 4, len(line) - SNIPPET_LENGTH))
+        line = line[offset:offset + SNIPPET_LENGTH]
+    return {'content': line, 'highlight': [start - offset, min(end, offset + SNIPPET_LENGTH) - offset]}
+
+def _find_documents(line_ids: List[int]) -> Dict[int, List[int]]:
+    """匹配行出现的备份内容：文档ID -> [行ID]"""
+    documents: Dict[int, List[int]] = {}
+    for chunk in _chunks(line_ids):
+        rows = db.session.query(SearchPosting.line_id, SearchPosting.document_id) \
+            .filter(SearchPosting.line_id.in_(chunk)).all()
+        for line_id, document_id in rows:
+            documents.setdefault(document_id, []).append(line_id)
+    return documents
+
+def _occurrences(document_id: int, line_ids: List[int]) -> List[Tuple[int, int]]:
+    """匹配行在一份备份内容中的 (行号, 行ID)，按行号排列（只为返回的结果读取行号）"""
+    occurrences = []
+    for chunk in _chunks(line_ids):
+        rows = db.session.query(SearchPosting.line_id, SearchPosting.line_numbers).filter(
+            SearchPosting.document_id == document_id, SearchPosting.line_id.in_(chunk)).all()
+        for line_id, numbers in rows:
+            occurrences.extend((int(number), line_id) for number in numbers.split(','))
+    return sorted(occurrences)
+
+def _latest_backups(hashes: List[str], device_ids: Optional[List[int]]) -> List[Dict[str, Any]]:
+    """最近一次成功备份的内容在给定哈希中的设备（每台设备一次索引查找）"""
+    from change_report import state_subquery
+
+    query = db.session.query(
+        Device.id, Device.alias, Device.ip_address, BackupTask.id, BackupTask.file_hash, BackupTask.completed_at
+    ).join(BackupTask, BackupTask.id == state_subquery(datetime.utcnow()))
+    if device_ids:
+        query = query.filter(Device.id.in_(device_ids))
+    hashes = set(hashes)
+    return [{
+        'device_id': row[0],
+        'device_alias': row[1],
+        'device_ip': row[2],
+        'task_id': row[3],
+        'file_hash': row[4],
+        'completed_at': row[5].isoformat() if row[5] else None
+    } for row in query.all() if row[4] in hashes]
+
+def _all_backups(hashes: List[str], device_ids: Optional[List[int]]) -> List[Dict[str, Any]]:
+    """内容在给定哈希中的成功备份，按设备和内容合并（内容未变化的多次备份算一个版本）"""
+    grouped = []
+    for chunk in _chunks(hashes):
+        query = db.session.query(
+            BackupTask.device_id, BackupTask.file_hash, func.max(BackupTask.id), func.count(BackupTask.id),
+            func.min(BackupTask.completed_at), func.max(BackupTask.completed_at)
+        ).filter(BackupTask.status == 'success', BackupTask.file_hash.in_(chunk))
+        if device_ids:
+            query = query.filter(BackupTask.device_id.in_(device_ids))
+        grouped.extend(query.group_by(BackupTask.file_hash, BackupTask.device_id).all())
+
+    devices = {}
+    for chunk in _chunks(sorted({row[0] for row in grouped})):
+        devices.update((row.id, row) for row in db.session.query(
+            Device.id, Device.alias, Device.ip_address).filter(Device.id.in_(chunk)).all())
+    rows = []
+    for device_id, file_hash, task_id, task_count, first_seen, last_seen in grouped:
+        device = devices.get(device_id)
+        rows.append({
+            'device_id': device_id,
+            'device_alias': device.alias if device else None,
+            'device_ip': device.ip_address if device else None,
+            'task_id': task_id,
+            'file_hash': file_hash,
+            'completed_at': last_seen.isoformat() if last_seen else None,
+            'task_count': task_count,
+            'first_seen': first_seen.isoformat() if first_seen else None
+        })
+    return rows
+
+def search_configs(query: str, regex: bool = False, ignore_case: bool = True, scope: str = 'latest',
+                   device_ids: Optional[List[int]] = None, limit: int = 100) -> Dict[str, Any]:
+    """在备份配置中搜索
+
+    scope为latest时只搜索每台设备最近一次成功备份，all时包括历史版本（每个不同的内容一个结果）；
+    结果按设备排列，每个结果给出匹配的行号和内容。参数无效时抛出ValueError
+    """
+    started = time.time()
+    if not query:
+        raise ValueError('缺少搜索内容')
+    if scope not in ('latest', 'all'):
+        raise ValueError('scope 只能是 latest 或 all')
+    literal, match = _matcher(query, regex, ignore_case)
+
+    # 1. 匹配的不同配置行
+    lines: Dict[int, Tuple[str, Tuple[int, int]]] = {}
+    truncated = False
+    for line_id, line in _candidate_lines(literal):
+        span = match(line)
+        if span is None:
+            continue
+        if len(lines) >= Config.SEARCH_MAX_LINES:
+            truncated = True
+            break
+        lines[line_id] = (line, span)
+
+    # 2. 包含这些行的备份内容，3. 使用这些内容的设备和备份任务
+    documents = _find_documents(list(lines))
+    hashes = {}
+    for chunk in _chunks(list(documents)):
+        hashes.update(db.session.query(SearchDocument.file_hash, SearchDocument.id)
+                      .filter(SearchDocument.id.in_(chunk)).all())
+    finder = _latest_backups if scope == 'latest' else _all_backups
+    results = finder(sorted(hashes), device_ids)
+    # 按设备排列，同一设备的历史版本新的在前
+    results.sort(key=lambda result: result['completed_at'] or '', reverse=True)
+    results.sort(key=lambda result: result['device_id'])
+    total_results = len(results)
+    results = results[:limit]
+
+    occurrences_by_document = {}
+    for result in results:
+        document_id = hashes[result['file_hash']]
+        if document_id not in occurrences_by_document:
+            occurrences_by_document[document_id] = _occurrences(document_id, documents[document_id])
+        occurrences = occurrences_by_document[document_id]
+        result['match_count'] = len(occurrences)
+        result['matches'] = [dict(line=number, **_snippet(*lines[line_id]))
+                             for number, line_id in occurrences[:MAX_MATCHES_PER_RESULT]]
+
+    return {
+        'query': query,
+        'regex': regex,
+        'scope': scope,
+        'matched_lines': len(lines),
+        'truncated': truncated,
+        'total_results': total_results,
+        'results': results,
+        'elapsed': round(time.time() - started, 3)
+    }
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+配置段解析与按段比较
+Cisco IOS/NX-OS配置按缩进分层（interface、router bgp、line vty等），
+将配置解析为配置段树并计算每个段的哈希，比较时先比较段哈希，
+只对内容变化的段逐行比较，结果按配置段分组
+"""
+
+import hashlib
+from dataclasses import dataclass, field
+from typing import Dict, Any, List, Tuple
+
+from config_diff import diff_lines, line_opcodes, change_summary, unified_text, normalize_line
+
+GLOBAL_SECTION = '全局配置'
+SEPARATORS = ('', '!')
+
+@dataclass
+class Section:
+    """配置段：首行及缩进更深的后续行，start/end为在配置中的行范围（不含end）"""
+    line: int  # 首行序号，根节点为-1
+    indent: int
+    start: int
+    end: int = 0
+    lines: List[int] = field(default_factory=list)  # 不含子段的子行的行序号
+    sections: List['Section'] = field(default_factory=list)  # 子段
+    digest: bytes = b''
+
+def parse_sections(lines: List[str], ignore_whitespace: bool = False, ignore_case: bool = False) -> Section:
+    """把配置行解析为配置段树，返回根节点（其子行和子段为顶层配置）
+
+    一行的缩进比前一行深时，前一行成为一个段的首行；空行只计入所在段的范围
+    """
+    root = Section(line=-1, indent=-1, start=0)
+    stack = [root]
+    previous = None  # 上一个非空行（序号, 缩进），看到下一行后才能确定是否为段首行
+    for index, line in enumerate(lines):
+        stripped = line.lstrip()
+        if not stripped:
+            continue
+        indent = len(line) - len(stripped)
+        if previous is not None:
+            if indent > previous[1]:
+                node = Section(line=previous[0], indent=previous[1], start=previous[0])
+                stack[-1].sections.append(node)
+                stack.append(node)
+            else:
+                stack[-1].lines.append(previous[0])
+        while stack[-1].indent >= indent:
+            stack.pop().end = index
+        previous = (index, indent)
+    if previous is not None:
+        stack[-1].lines.append(previous[0])
+    while stack:
+        stack.pop().end = len(lines)
+
+    # 段哈希：段内全部行（按比较选项规范化后）的SHA-1
+    if ignore_whitespace or ignore_case:
+        lines = [normalize_line(line, ignore_whitespace, ignore_case) for line in lines]
+    pending = [root]
+    while pending:
+        node = pending.pop()
+        text = '\n'.join(lines[node.start:node.end])
+        node.digest = hashlib.sha1(text.encode('utf-8', 'surrogateescape')).digest()
+        pending.extend(node.sections)
+    return root
+
+def _section_keys(lines: List[str], nodes: List[Section], ignore_case: bool) -> List[Tuple[str, int]]:
+    """子段的匹配键：首行去掉首尾空白加上同名段的出现次序"""
+    seen: Dict[str, int] = {}
+    keys = []
+    for node in nodes:
+        header = ' '.join(lines[node.line].split())
+        if ignore_case:
+            header = header.lower()
+        keys.append((header, seen.get(header, 0)))
+        seen[header] = seen.get(header, 0) + 1
+    return keys
+
+class SectionDiff:
+    """两份配置的按段比较"""
+
+    def __init__(self, old_lines: List[str], new_lines: List[str], context: int = 3,
+                 ignore_whitespace: bool = False, ignore_case: bool = False):
+        self.old_lines = old_lines
+        self.new_lines = new_lines
+        self.context = context
+        self.ignore_whitespace = ignore_whitespace
+        self.ignore_case = ignore_case
+        self.entries: List[Dict[str, Any]] = []
+        self.unchanged = 0
+
+    def run(self) -> List[Dict[str, Any]]:
+        old_root = parse_sections(self.old_lines, self.ignore_whitespace, self.ignore_case)
+        new_root = parse_sections(self.new_lines, self.ignore_whitespace, self.ignore_case)
+        if old_root.digest != new_root.digest:
+            self._diff_section(old_root, new_root, [])
+        return self.entries
+
+    def _own_lines(self, node: Section, lines: List[str]) -> List[int]:
+        """段首行和不含子段的子行的行序号（不含只起分隔作用的!）"""
+        numbers = [node.line] if node.line >= 0 else []
+        numbers.extend(index for index in node.lines if lines[index].strip() not in SEPARATORS)
+        return numbers
+
+    def _add_entry(self, path: List[str], status: str, old_numbers: List[int], new_numbers: List[int]):
+        """比较给定的行并记录一个配置段的差异"""
+        label = ' > '.join(path) if path else GLOBAL_SECTION
+        result = diff_lines(
+            [self.old_lines[i] for i in old_numbers], [self.new_lines[j] for j in new_numbers],
+            self.context, self.ignore_whitespace, self.ignore_case,
+            old_numbers=[i + 1 for i in old_numbers], new_numbers=[j + 1 for j in new_numbers],
+            label=label
+        )
+        if status == 'modified' and not result['summary']['has_changes']:
+            return
+        self.entries.append({
+            'section': label,
+            'path': path,
+            'status': status,
+            'old_line': old_numbers[0] + 1 if old_numbers else None,
+            'new_line': new_numbers[0] + 1 if new_numbers else None,
+            'summary': result['summary'],
+            'diff_blocks': result['diff_blocks'],
+            'raw_lines': result['raw_lines']
+        })
+
+    def _diff_section(self, old: Section, new: Section, path: List[str]):
+        """比较一个段：先比较本段自身的行，再按段哈希比较子段"""
+        self._add_entry(path, 'modified', self._own_lines(old, self.old_lines), self._own_lines(new, self.new_lines))
+
+        old_subs = old.sections
+        new_subs = new.sections
+        old_keys = _section_keys(self.old_lines, old_subs, self.ignore_case)
+        new_keys = _section_keys(self.new_lines, new_subs, self.ignore_case)
+        old_by_key = dict(zip(old_keys, old_subs))
+        new_key_set = set(new_keys)
+
+        for tag, i1, i2, j1, j2 in line_opcodes(old_keys, new_keys):
+            if tag == 'equal':
+                for old_sub, new_sub in zip(old_subs[i1:i2], new_subs[j1:j2]):
+                    self._compare(old_sub, new_sub, path)
+                continue
+            for index in range(i1, i2):
+                if old_keys[index] not in new_key_set:
+                    self._add_entry(path + [self.old_lines[old_subs[index].line].strip()], 'removed',
+                                    list(range(old_subs[index].start, old_subs[index].end)), [])
+            for index in range(j1, j2):
+                old_sub = old_by_key.get(new_keys[index])
+                if old_sub is not None:
+                    # 段的位置发生了变化
+                    self._compare(old_sub, new_subs[index], path, moved=True)
+                else:
+                    self._add_entry(path + [self.new_lines[new_subs[index].line].strip()], 'added',
+                                    [], list(range(new_subs[index].start, new_subs[index].end)))
+
+    def _compare(self, old: Section, new: Section, path: List[str], moved: bool = False):
+        """比较同名的段，哈希相同的段不再逐行比较"""
+        if old.digest == new.digest:
+            if moved:
+                header = self.new_lines[new.line].strip()
+                self.entries.append({
+                    'section': ' > '.join(path + [header]),
+                    'path': path + [header],
+                    'status': 'moved',
+                    'old_line': old.line + 1,
+                    'new_line': new.line + 1,
+                    'summary': change_summary(0, 0, 0),
+                    'diff_blocks': [],
+                    'raw_lines': []
+                })
+            else:
+                self.unchanged += 1
+            return
+        self._diff_section(old, new, path + [self.new_lines[new.line].strip()])
+
+def diff_sections(old_content: str, new_content: str, context: int = 3,
+                  ignore_whitespace: bool = False, ignore_case: bool = False,
+                  fromfile: str = '旧配置', tofile: str = '新配置') -> Dict[str, Any]:
+    """按配置段比较两份配置
+
+    返回与逐行比较相同的summary/diff_blocks/raw_diff，差异块按配置段分组，
+    块头部附带段路径；sections为各变化段的状态（added/removed/modified/moved）和统计
+    """
+    old_lines = old_content.splitlines()
+    new_lines = new_content.splitlines()
+    differ = SectionDiff(old_lines, new_lines, context, ignore_whitespace, ignore_case)
+    entries = differ.run()
+
+    added = sum(entry['summary']['added_lines'] for entry in entries)
+    removed = sum(entry['summary']['removed_lines'] for entry in entries)
+    modified = sum(entry['summary']['modified_lines'] for entry in entries)
+    summary = change_summary(added, removed, modified)
+    summary['has_changes'] = bool(entries)
+    summary['old_lines'] = len(old_lines)
+    summary['new_lines'] = len(new_lines)
+    summary['changed_sections'] = len(entries)
+    summary['unchanged_sections'] = differ.unchanged
+
+    diff_blocks = []
+    raw_lines = []
+    sections = []
+    for entry in entries:
+        for block in entry['diff_blocks']:
+            block['section'] = entry['section']
+            diff_blocks.append(block)
+        raw_lines.extend(entry.pop('raw_lines'))
+        sections.append({key: value for key, value in entry.items() if key != 'diff_blocks'})
+
+    return {
+        'summary': summary,
+        'sections': sections,
+        'diff_blocks': diff_blocks,
+        'raw_diff': unified_text(raw_lines, fromfile, tofile)
+    }
@@ -6,13 +6,14 @@
 
 from app import app, db
 from models import ScheduledTask, TaskExecution
+from schema_migrations import upgrade_schema
 
 def create_scheduler_tables():
     """创建计划任务相关表"""
     with app.app_context():
         try:
             # 创建计划任务表
-            db.create_all()
+            upgrade_schema()
             print("OK - 计划任务相关表创建成功！")
             print("已创建的表：")
             print("   - scheduled_tasks (计划任务表)")
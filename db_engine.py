@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+数据库引擎设置
+SQLite在多个工作线程并发写入时启用WAL、设置busy_timeout，并按工作线程数设置连接池大小
+"""
+
+import logging
+from typing import Dict, Any
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+def is_sqlite(database_uri: str) -> bool:
+    return database_uri.startswith('sqlite')
+
+def is_sqlite_memory(database_uri: str) -> bool:
+    return database_uri in ('sqlite://', 'sqlite:///:memory:') or 'mode=memory' in database_uri
+
+def sqlite_settings() -> Dict[str, Any]:
+    """SQLite连接参数"""
+    return {
+        'journal_mode': Config.SQLITE_JOURNAL_MODE,
+        'synchronous': Config.SQLITE_SYNCHRONOUS,
+        'busy_timeout': Config.SQLITE_BUSY_TIMEOUT,  # 毫秒
+        'mmap_size': Config.SQLITE_MMAP_SIZE,  # 字节，0表示不使用
+    }
+
+def sqlite_connect_args(database_uri: str) -> Dict[str, Any]:
+    """SQLite驱动的连接参数：等待写锁的超时时间，允许连接在线程间传递"""
+    if not is_sqlite(database_uri):
+        return {}
+    return {
+        'timeout': sqlite_settings()['busy_timeout'] / 1000,
+        'check_same_thread': False
+    }
+
+def engine_options(database_uri: str) -> Dict[str, Any]:
+    """SQLALCHEMY_ENGINE_OPTIONS
+
+    连接池大小默认等于备份工作线程数加上调度器和请求线程的余量，
+    避免工作线程在获取连接时排队
+    """
+    options = {}
+    if not is_sqlite_memory(database_uri):
+        options.update({
+            'pool_size': Config.DB_POOL_SIZE,
+            'max_overflow': Config.DB_MAX_OVERFLOW,
+            'pool_timeout': Config.DB_POOL_TIMEOUT,
+        })
+    connect_args = sqlite_connect_args(database_uri)
+    if connect_args:
+        options['connect_args'] = connect_args
+    return options
+
+def configure_engine(engine: Engine):
+    """为SQLite引擎注册连接时执行的PRAGMA"""
+    if engine.dialect.name != 'sqlite':
+        return
+
+    settings = sqlite_settings()
+    memory = is_sqlite_memory(str(engine.url))
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            if not memory:
+                cursor.execute(f"PRAGMA journal_mode={settings['journal_mode']}")
+            cursor.execute(f"PRAGMA synchronous={settings['synchronous']}")
+            cursor.execute(f"PRAGMA busy_timeout={settings['busy_timeout']}")
+            cursor.execute(f"PRAGMA mmap_size={settings['mmap_size']}")
+        finally:
+            cursor.close()
+
+    logger.info(f"SQLite引擎已配置: journal_mode={settings['journal_mode']}, "
+                f"synchronous={settings['synchronous']}, busy_timeout={settings['busy_timeout']}ms")
@@ -6,10 +6,11 @@
 """
 
 import logging
+import re
 import time
 import threading
 from datetime import datetime
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Callable
 from netmiko import ConnectHandler, NetMikoTimeoutException, NetMikoAuthenticationException
 try:
     from netmiko.ssh_exception import SSHException
@@ -20,8 +21,94 @@ from cryptography.fernet import Fernet
 import base64
 import os
 
+from config import Config
+
 logger = logging.getLogger(__name__)
 
+# 分页提示（终端未关闭分页时出现）
+MORE_PATTERN = re.compile(r' *-+ *[Mm]ore *-+ *(\x08+ *\x08*)?')
+
+# 读取输出的空闲超时：基础值加上按已接收数据量增长的部分
+READ_IDLE_TIMEOUT = 20  # 秒
+READ_IDLE_PER_MB = 30  # 每MB输出增加的秒数
+READ_IDLE_MAX = 120
+# 看到配置结尾的end后，再等待提示符的宽限时间
+END_TRAILER_GRACE = 0.5
+
+def build_prompt_pattern(base_prompt: str):
+    """根据主机名生成提示符匹配模式（兼容 > # 及配置模式括号）"""
+    return re.compile(r'^' + re.escape(base_prompt) + r'(\([\w.\-]+\))?[>#]\s*$')
+
+def read_idle_timeout(bytes_received: int) -> float:
+    """按已接收的输出量计算空闲超时"""
+    return min(READ_IDLE_TIMEOUT + bytes_received / (1024 * 1024) * READ_IDLE_PER_MB, READ_IDLE_MAX)
+
+class PromptReader:
+    """基于提示符的命令输出读取器
+
+    逐块接收通道输出，先跳过命令回显之前的残留内容，
+    在回显之后出现设备提示符时判定命令结束。
+    指定on_output时，确认的输出会立即交给回调而不在内存中累积。
+    """
+    
+    def __init__(self, command: str, prompt_pattern, on_output: Callable[[str], None] = None):
+        self.command = command
+        self.prompt_pattern = prompt_pattern
+        self.on_output = on_output
+        self.echo_seen = False
+        self.done = False
+        self.more_prompt = False  # 是否需要发送空格翻页
+        self.saw_end_trailer = False  # 最后一行输出是否为配置结尾的end
+        self.bytes_received = 0
+        self._pending = ''  # 尚未确认的内容（回显之前的残留或末尾不完整的行）
+        self._lines = []
+        self._emitted = False
+    
+    def feed(self, data: str) -> bool:
+        """接收一块输出，返回命令是否已结束"""
+        self.bytes_received += len(data)
+        text = self._pending + data.replace('\r', '')
+        
+        if not self.echo_seen:
+            index = text.find(self.command)
+            newline = text.find('\n', index) if index >= 0 else -1
+            if newline < 0:
+                # 保留可能被截断的回显
+                self._pending = text[index:] if index >= 0 else text[-len(self.command):]
+                return False
+            text = text[newline + 1:]
+            self.echo_seen = True
+        
+        self.more_prompt = bool(MORE_PATTERN.search(text))
+        if self.more_prompt:
+            text = MORE_PATTERN.sub('', text)
+        
+        lines = text.split('\n')
+        self._pending = lines.pop()
+        for line in lines:
+            self._emit(line)
+        
+        if self.prompt_pattern.match(self._pending):
+            self.done = True
+        return self.done
+    
+    def _emit(self, line: str):
+        stripped = line.strip()
+        if stripped:
+            self.saw_end_trailer = stripped == 'end'
+        if self.on_output:
+            self.on_output(('\n' if self._emitted else '') + line)
+        else:
+            self._lines.append(line)
+        self._emitted = True
+    
+    def finish(self) -> str:
+        """结束读取，返回命令输出（不含回显和提示符；流式模式下返回空字符串）"""
+        if not self.done and self._pending and not self.prompt_pattern.match(self._pending):
+            self._emit(self._pending)
+        self._pending = ''
+        return '\n'.join(self._lines)
+
 class DeviceConnection:
     """设备连接类"""
     
@@ -30,6 +117,7 @@ class DeviceConnection:
         self.connection = None
         self.is_connected = False
         self.lock = threading.Lock()
+        self.pool_key = None  # 由连接池分配
     
     def connect(self) -> bool:
         """建立设备连接"""
@@ -96,8 +184,20 @@ class DeviceConnection:
         except Exception as e:
             logger.error(f"断开设备连接时出错: {str(e)}")
     
-    def execute_command(self, command: str) -> Dict[str, Any]:
-        """执行设备命令"""
+    def is_alive(self) -> bool:
+        """探测会话是否仍然可用"""
+        try:
+            with self.lock:
+                return bool(self.connection and self.is_connected and self.connection.is_alive())
+        except Exception as e:
+            logger.debug(f"会话保活探测失败: {str(e)}")
+            return False
+    
+    def execute_command(self, command: str, on_output: Callable[[str], None] = None) -> Dict[str, Any]:
+        """执行设备命令
+
+        指定on_output时输出按块流式交给回调，返回结果中的output为空
+        """
         if not self.is_connected:
             if not self.connect():
                 return {
@@ -112,12 +212,14 @@ class DeviceConnection:
                 if command.startswith('show') and self.device_info.get('enable_password_encrypted'):
                     self.connection.enable()
                 
-                # 执行命令，增加超时时间和延迟
-                if command.lower().startswith('show running-config'):
-                    # 对于show running-config命令，使用更长的超时时间
-                    output = self.connection.send_command(command, delay_factor=4, max_loops=2000)
+                # show命令按提示符读取，出现提示符即返回；其他命令沿用netmiko的send_command
+                if command.lower().startswith('show'):
+                    output = self._read_until_prompt(command, on_output=on_output)
                 else:
                     output = self.connection.send_command(command, delay_factor=2)
+                    if on_output:
+                        on_output(output)
+                        output = ''
                 
                 return {
                     'success': True,
@@ -133,62 +235,291 @@ class DeviceConnection:
                 'output': ''
             }
     
-    def _decrypt_password(self, encrypted_password: str) -> str:
-        """解密密码"""
-        try:
-            # 从环境变量获取加密密钥
-            key = os.environ.get('ENCRYPTION_KEY')
-            if not key:
-                # 如果没有设置密钥，使用默认密钥（生产环境应该设置自己的密钥）
-                key = 'default-encryption-key-change-in-production'
+    def _read_until_prompt(self, command: str, max_time: float = None,
+                           on_output: Callable[[str], None] = None) -> str:
+        """发送命令并持续读取通道，检测到提示符或配置结尾时立即返回
+
+        空闲超时随已接收的输出量增长，而不是固定的delay_factor倍数
+        """
+        if max_time is None:
+            max_time = float(Config.BACKUP_TIMEOUT)
+        
+        reader = PromptReader(command, build_prompt_pattern(self.connection.base_prompt), on_output)
+        self.connection.write_channel(command + getattr(self.connection, 'RETURN', '\n'))
+        
+        start = last_data = time.monotonic()
+        delay = 0.01
+        while True:
+            data = self.connection.read_channel()
+            now = time.monotonic()
+            if data:
+                last_data = now
+                delay = 0.01
+                if reader.feed(data):
+                    break
+                if reader.more_prompt:
+                    self.connection.write_channel(' ')
+                continue
             
-            # 将密钥转换为Fernet密钥
-            key_bytes = key.encode()[:32].ljust(32, b'0')
-            fernet = Fernet(base64.urlsafe_b64encode(key_bytes))
+            idle = now - last_data
+            if reader.saw_end_trailer and idle >= END_TRAILER_GRACE:
+                break
+            if idle >= read_idle_timeout(reader.bytes_received):
+                raise TimeoutError(f'命令 {command} 在 {idle:.0f} 秒内没有新的输出')
+            if now - start >= max_time:
+                raise TimeoutError(f'命令 {command} 执行超过 {max_time:.0f} 秒')
             
-            # 解密密码
-            decrypted = fernet.decrypt(encrypted_password.encode())
-            result = decrypted.decode()
-            logger.info(f"密码解密成功，长度: {len(result)}")
-            return result
-        except Exception as e:
-            logger.error(f"密码解密失败: {str(e)}")
-            logger.error(f"加密密码长度: {len(encrypted_password)}")
-            return encrypted_password  # 如果解密失败，返回原密码
+            time.sleep(delay)
+            delay = min(delay * 2, 0.2)
+        
+        return reader.finish()
+    
+    def _decrypt_password(self, encrypted_password: str) -> str:
+        """解密密码"""
+        return decrypt_password(encrypted_password)
 
-class DeviceManager:
-    """设备管理器"""
+def decrypt_password(encrypted_password: str) -> str:
+    """解密设备密码"""
+    try:
+        # 从环境变量获取加密密钥
+        key = os.environ.get('ENCRYPTION_KEY')
+        if not key:
+            # 如果没有设置密钥，使用默认密钥（生产环境应该设置自己的密钥）
+            key = 'default-encryption-key-change-in-production'
+        
+        # 将密钥转换为Fernet密钥
+        key_bytes = key.encode()[:32].ljust(32, b'0')
+        fernet = Fernet(base64.urlsafe_b64encode(key_bytes))
+        
+        # 解密密码
+        decrypted = fernet.decrypt(encrypted_password.encode())
+        result = decrypted.decode()
+        logger.info(f"密码解密成功，长度: {len(result)}")
+        return result
+    except Exception as e:
+        logger.error(f"密码解密失败: {str(e)}")
+        logger.error(f"加密密码长度: {len(encrypted_password)}")
+        return encrypted_password  # 如果解密失败，返回原密码
+
+class ConnectionPool:
+    """设备SSH会话连接池
+
+    按 (ip, port, username, device_type) 复用已认证的会话，支持空闲超时淘汰、
+    复用前保活探测、单设备连接上限和全局连接上限。
+    """
     
-    def __init__(self):
-        self.connections = {}  # 存储活跃连接
-        self.connection_locks = {}  # 连接锁
-        self.max_connections = 10  # 最大并发连接数
+    def __init__(self, max_size: int = 10, max_per_device: int = 2,
+                 idle_ttl: int = 300, checkout_timeout: int = 60):
+        self.max_size = max_size  # 全局最大连接数
+        self.max_per_device = max_per_device  # 单设备最大连接数
+        self.idle_ttl = idle_ttl  # 空闲连接存活时间（秒）
+        self.checkout_timeout = checkout_timeout  # 等待可用连接的超时时间（秒）
+        self._idle = {}  # key -> [(连接, 归还时间)]，末尾为最近归还
+        self._in_use = {}  # key -> 已借出数量
+        self._total = 0
+        self._cond = threading.Condition()
+        self._reaper = None
     
-    def get_connection(self, device_info: Dict[str, Any]) -> DeviceConnection:
-        """获取设备连接"""
-        device_id = device_info.get('id')
-        device_ip = device_info.get('ip_address')
+    @staticmethod
+    def make_key(device_info: Dict[str, Any]) -> tuple:
+        """生成连接池键"""
+        device_type = device_info.get('device_type', 'cisco_ios')
+        if device_info.get('protocol', 'ssh').lower() == 'telnet':
+            device_type = 'cisco_ios_telnet'
+        return (
+            device_info.get('ip_address'),
+            int(device_info.get('port') or 22),
+            device_info.get('username'),
+            device_type
+        )
+    
+    def checkout(self, device_info: Dict[str, Any]) -> Optional[DeviceConnection]:
+        """借出一个可用连接，必要时新建"""
+        key = self.make_key(device_info)
+        deadline = time.monotonic() + self.checkout_timeout
         
-        # 检查是否已有连接
-        if device_id in self.connections:
-            connection = self.connections[device_id]
-            if connection.is_connected:
+        while True:
+            to_close = []
+            connection = None
+            reserved = False
+            
+            with self._cond:
+                while True:
+                    to_close.extend(self._evict_expired_locked())
+                    
+                    idle = self._idle.get(key)
+                    if idle:
+                        connection, _ = idle.pop()
+                        self._in_use[key] = self._in_use.get(key, 0) + 1
+                        break
+                    
+                    if self._device_count_locked(key) < self.max_per_device:
+                        if self._total >= self.max_size:
+                            # 全局已满时，优先淘汰其他设备最久未用的空闲连接
+                            victim = self._pop_lru_idle_locked()
+                            if victim:
+                                to_close.append(victim)
+                        if self._total < self.max_size:
+                            self._total += 1
+                            self._in_use[key] = self._in_use.get(key, 0) + 1
+                            reserved = True
+                            break
+                    
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            
+            for stale in to_close:
+                stale.disconnect()
+            
+            if connection is not None:
+                # 复用前进行保活探测
+                if connection.is_alive():
+                    connection.device_info = device_info
+                    logger.debug(f"复用设备 {key[0]} 的已有会话")
+                    return connection
+                logger.info(f"设备 {key[0]} 的空闲会话已失效，重新建立连接")
+                self._discard(connection, key)
+                continue
+            
+            if not reserved:
+                logger.error(f"等待设备 {key[0]} 的可用连接超时")
+                return None
+            
+            connection = DeviceConnection(device_info)
+            connection.pool_key = key
+            if connection.connect():
                 return connection
-        
-        # 创建新连接
-        connection = DeviceConnection(device_info)
-        if connection.connect():
-            self.connections[device_id] = connection
-            return connection
-        else:
+            
+            self._release_slot(key)
             return None
     
-    def release_connection(self, device_id: int):
-        """释放设备连接"""
-        if device_id in self.connections:
-            connection = self.connections[device_id]
+    def checkin(self, connection: DeviceConnection, discard: bool = False):
+        """归还连接，失效或被标记丢弃的连接直接关闭"""
+        key = connection.pool_key
+        if key is None:
+            connection.disconnect()
+            return
+        
+        if discard or not connection.is_connected:
+            self._discard(connection, key)
+            return
+        
+        with self._cond:
+            self._in_use[key] = max(self._in_use.get(key, 0) - 1, 0)
+            self._idle.setdefault(key, []).append((connection, time.monotonic()))
+            self._cond.notify_all()
+        self._ensure_reaper()
+    
+    def evict_idle(self):
+        """淘汰超过空闲时间的连接"""
+        with self._cond:
+            expired = self._evict_expired_locked()
+        for connection in expired:
+            connection.disconnect()
+    
+    def close_all(self):
+        """关闭所有空闲连接"""
+        with self._cond:
+            idle = [conn for entries in self._idle.values() for conn, _ in entries]
+            self._total -= len(idle)
+            self._idle.clear()
+            self._cond.notify_all()
+        for connection in idle:
             connection.disconnect()
-            del self.connections[device_id]
+    
+    def stats(self) -> Dict[str, int]:
+        """获取连接池状态"""
+        with self._cond:
+            return {
+                'total': self._total,
+                'idle': sum(len(entries) for entries in self._idle.values()),
+                'in_use': sum(self._in_use.values()),
+                'max_size': self.max_size
+            }
+    
+    def _discard(self, connection: DeviceConnection, key: tuple):
+        connection.disconnect()
+        self._release_slot(key)
+    
+    def _release_slot(self, key: tuple):
+        with self._cond:
+            self._in_use[key] = max(self._in_use.get(key, 0) - 1, 0)
+            self._total -= 1
+            self._cond.notify_all()
+    
+    def _device_count_locked(self, key: tuple) -> int:
+        return len(self._idle.get(key, [])) + self._in_use.get(key, 0)
+    
+    def _evict_expired_locked(self) -> List[DeviceConnection]:
+        now = time.monotonic()
+        expired = []
+        for key in list(self._idle):
+            entries = self._idle[key]
+            alive = [(conn, ts) for conn, ts in entries if now - ts < self.idle_ttl]
+            expired.extend(conn for conn, ts in entries if now - ts >= self.idle_ttl)
+            if alive:
+                self._idle[key] = alive
+            else:
+                del self._idle[key]
+        if expired:
+            self._total -= len(expired)
+            self._cond.notify_all()
+        return expired
+    
+    def _pop_lru_idle_locked(self) -> Optional[DeviceConnection]:
+        oldest_key = None
+        oldest_ts = None
+        for key, entries in self._idle.items():
+            if entries and (oldest_ts is None or entries[0][1] < oldest_ts):
+                oldest_key, oldest_ts = key, entries[0][1]
+        if oldest_key is None:
+            return None
+        connection, _ = self._idle[oldest_key].pop(0)
+        if not self._idle[oldest_key]:
+            del self._idle[oldest_key]
+        self._total -= 1
+        return connection
+    
+    def _ensure_reaper(self):
+        """启动后台空闲连接清理线程"""
+        if self._reaper and self._reaper.is_alive():
+            return
+        self._reaper = threading.Thread(target=self._reap_loop, name='ssh-pool-reaper', daemon=True)
+        self._reaper.start()
+    
+    def _reap_loop(self):
+        while True:
+            time.sleep(max(self.idle_ttl / 4, 5))
+            try:
+                self.evict_idle()
+            except Exception as e:
+                logger.error(f"清理空闲连接时出错: {str(e)}")
+
+# 全局连接池，供所有DeviceManager实例共享
+connection_pool = ConnectionPool(
+    max_size=Config.SSH_POOL_MAX_CONNECTIONS,
+    max_per_device=Config.SSH_POOL_MAX_PER_DEVICE,
+    idle_ttl=Config.SSH_POOL_IDLE_TTL,
+    checkout_timeout=Config.SSH_POOL_CHECKOUT_TIMEOUT
+)
+
+class DeviceManager:
+    """设备管理器"""
+    
+    def __init__(self, pool: ConnectionPool = None):
+        self.pool = pool or connection_pool
+        self.max_connections = self.pool.max_size  # 最大并发连接数
+    
+    def get_connection(self, device_info: Dict[str, Any]) -> Optional[DeviceConnection]:
+        """从连接池借出设备连接"""
+        return self.pool.checkout(device_info)
+    
+    def release_connection(self, connection: DeviceConnection, discard: bool = False):
+        """归还设备连接到连接池"""
+        if connection:
+            self.pool.checkin(connection, discard=discard)
     
     def test_connection(self, device_info: Dict[str, Any]) -> Dict[str, Any]:
         """测试设备连接"""
@@ -243,11 +574,5 @@ class DeviceManager:
     
     def cleanup_connections(self):
         """清理所有连接"""
-        for device_id, connection in list(self.connections.items()):
-            try:
-                connection.disconnect()
-            except Exception as e:
-                logger.error(f"清理连接 {device_id} 时出错: {str(e)}")
-        
-        self.connections.clear()
+        self.pool.close_all()
         logger.info("已清理所有设备连接")
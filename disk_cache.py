@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+磁盘缓存
+按键保存还原后的备份内容、行偏移索引等派生文件，总大小超过上限时删除最久未访问的文件
+"""
+
+import logging
+import os
+import re
+import tempfile
+import threading
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+KEY_PATTERN = re.compile(r'^[\w.\-]+$')
+
+class DiskCache:
+    """磁盘LRU缓存
+
+    每个键对应一个文件，读取时更新文件的修改时间作为最近访问时间；
+    写入后总大小超过上限时，按修改时间从旧到新删除，直到低于上限的90%。
+    缓存的都是可以重新生成的内容，文件丢失只会导致重新计算。
+    """
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._size = None  # 缓存总大小，第一次写入时统计
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        if not KEY_PATTERN.match(key):
+            raise ValueError(f'无效的缓存键: {key}')
+        return self.root / key[:2] / key
+
+    def get(self, key: str) -> Optional[Path]:
+        """返回缓存文件路径并标记为最近访问，不存在时返回None
+
+        文件在打开前仍可能被其他线程的清理删除，调用方遇到FileNotFoundError时应重新生成
+        """
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def read(self, key: str) -> Optional[bytes]:
+        """读取缓存内容，不存在时返回None"""
+        path = self.get(key)
+        if path is None:
+            return None
+        try:
+            return path.read_bytes()
+        except OSError:
+            return None
+
+    def put(self, key: str, data: bytes) -> Path:
+        """写入缓存（先写临时文件再改名，读取方不会看到写了一半的文件）"""
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            try:
+                replaced = path.stat().st_size  # 覆盖已有的键时从总大小中减去旧文件
+            except OSError:
+                replaced = 0
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._total_size()
+            else:
+                self._size += len(data) - replaced
+            if self._size > self.max_bytes:
+                self._evict()
+        return path
+
+    def _files(self):
+        for directory in self.root.iterdir():
+            if directory.is_dir():
+                for path in directory.iterdir():
+                    if not path.name.startswith('.tmp_'):
+                        yield path
+
+    def _total_size(self) -> int:
+        total = 0
+        for path in self._files():
+            try:
+                total += path.stat().st_size
+            except OSError:
+                continue
+        return total
+
+    def _evict(self):
+        """删除最久未访问的文件直到总大小低于上限的90%"""
+        entries = []
+        for path in self._files():
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        removed = 0
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        self._size = total
+        logger.info(f"缓存 {self.root} 已清理 {removed} 个文件，当前大小 {total} 字节")
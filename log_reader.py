@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+日志读取
+从文件末尾按块向前读取最近的行；为每个日志文件维护持久化的条目偏移索引（按级别分开、
+记录时间戳），分页和按时间过滤只读取索引中的几条记录和对应的日志条目，
+内存占用和响应时间与日志文件大小无关
+"""
+
+import hashlib
+import heapq
+import json
+import logging
+import os
+import re
+import struct
+import threading
+from bisect import bisect_left
+from datetime import datetime
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+LOG_DIR = Path('logs')
+INDEX_DIR_NAME = '.index'
+BLOCK_SIZE = 1024 * 1024  # 建立索引时每次读取的字节数
+TAIL_BLOCK_SIZE = 64 * 1024  # 向前读取时每块的字节数
+MAX_TAIL_BYTES = 8 * 1024 * 1024  # 向前读取的最大字节数
+MAX_ENTRY_BYTES = 64 * 1024  # 单条日志最多读取的字节数
+MERGE_BLOCK = 1024  # 归并多个文件时每次读取的索引记录数
+INDEX_VERSION = 1
+
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+
+# 日志格式: 2025-10-22 09:57:05,555 - module - LEVEL - message
+ENTRY_PATTERN = re.compile(
+    rb'(?m)^(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d),(\d{3}) - [^\n]*? - (DEBUG|INFO|WARNING|ERROR|CRITICAL) - '
+)
+LOG_FILE_NAME = re.compile(r'^[\w.\-]+\.log(\.\d+)?$')  # 日志文件及其轮转文件（xxx.log.1）
+
+# 索引记录：(条目偏移, 条目长度, 时间戳毫秒)
+RECORD = struct.Struct('<QIq')
+EPOCH = datetime(1970, 1, 1)
+
+def is_log_file_name(name: str) -> bool:
+    """是否为允许访问的日志文件名"""
+    return bool(LOG_FILE_NAME.match(name))
+
+def list_log_files(log_dir: Path = LOG_DIR) -> List[Path]:
+    """日志目录下的日志文件，按修改时间从新到旧"""
+    if not log_dir.exists():
+        return []
+    files = [path for path in log_dir.iterdir() if path.is_file() and is_log_file_name(path.name)]
+    return sorted(files, key=lambda path: path.stat().st_mtime, reverse=True)
+
+def parse_time(value: str) -> Optional[int]:
+    """解析查询参数中的时间（YYYY-MM-DD HH:MM:SS 或 ISO格式）为毫秒时间戳"""
+    if not value:
+        return None
+    try:
+        moment = datetime.fromisoformat(value.replace(',', '.'))
+    except ValueError as e:
+        raise ValueError(f'无效的时间: {value}') from e
+    return int((moment.replace(tzinfo=None) - EPOCH).total_seconds() * 1000)
+
+def read_tail(path: Path, max_lines: int, before: Optional[int] = None) -> Tuple[bytes, int]:
+    """从before（默认文件末尾）位置向前按块读取最多max_lines行
+
+    返回 (内容, 内容在文件中的起始偏移)，起始偏移可作为下一次向前读取的before
+    """
+    with open(path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size if before is None else max(0, min(before, size))
+        pos = end
+        chunks = []
+        newlines = 0
+        while pos > 0 and newlines <= max_lines and end - pos < MAX_TAIL_BYTES:
+            length = min(TAIL_BLOCK_SIZE, pos)
+            pos -= length
+            f.seek(pos)
+            chunk = f.read(length)
+            chunks.append(chunk)
+            newlines += chunk.count(b'\n')
+
+    data = b''.join(reversed(chunks))
+    # 末尾的换行属于最后一行，从它之前开始数行
+    cut = len(data) - 1 if data.endswith(b'\n') else len(data)
+    for _ in range(max_lines):
+        cut = data.rfind(b'\n', 0, cut)
+        if cut < 0:
+            break
+    if cut < 0:
+        # 已读到文件开头时全部返回，否则丢弃开头不完整的一行
+        start = 0 if pos == 0 else (data.find(b'\n') + 1 or len(data))
+    else:
+        start = cut + 1
+    return data[start:], pos + start
+
+def decode_log(data: bytes) -> str:
+    """解码日志内容，优先UTF-8，其次GBK"""
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data.decode('gbk', errors='replace')
+
+def _timestamp_ms(match) -> int:
+    year, month, day, hour, minute, second, millis = (int(group) for group in match.groups()[:7])
+    moment = datetime(year, month, day, hour, minute, second)
+    return int((moment - EPOCH).total_seconds()) * 1000 + millis
+
+def _parse_entry(data: bytes) -> Optional[Dict[str, Any]]:
+    """解析一条日志（可能包含多行，如异常堆栈）"""
+    parts = data.decode('utf-8', errors='replace').rstrip('\r\n').split(' - ', 3)
+    if len(parts) < 4:
+        return None
+    timestamp, module, level, message = parts
+    return {
+        'timestamp': timestamp,
+        'level': level,
+        'module': module,
+        'message': message
+    }
+
+class LogIndex:
+    """单个日志文件的条目偏移索引
+
+    索引目录以文件的inode和第一行的哈希命名，文件被轮转改名后仍使用原索引。
+    每个级别一个记录文件，另有一个包含全部条目的all文件，记录按写入顺序追加。
+    只为后面已经出现下一条日志的条目建立记录，最后一条日志（可能尚未写完）
+    在查询时直接从文件末尾读取。
+    """
+
+    def __init__(self, path: Path, index_root: Path, key: str):
+        self.path = path
+        self.index_dir = index_root / key
+        self.meta: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_for(path: Path) -> Optional[str]:
+        """索引目录名，文件还没有完整的第一行时返回None"""
+        with open(path, 'rb') as f:
+            first_line = f.readline(4096)
+            ino = os.fstat(f.fileno()).st_ino
+        if not first_line.endswith(b'\n'):
+            return None
+        return f'{ino}-{hashlib.sha1(first_line).hexdigest()[:16]}'
+
+    def _records_path(self, level: Optional[str]) -> Path:
+        return self.index_dir / f'{(level or "all").lower()}.idx'
+
+    def refresh(self):
+        """为文件新增的部分建立索引"""
+        with self._lock:
+            self.index_dir.mkdir(parents=True, exist_ok=True)
+            with open(self.index_dir / '.lock', 'a') as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    self._load_meta()
+                    size = self.path.stat().st_size
+                    if size < self.meta['scanned']:
+                        self._reset()
+                    if size > self.meta['scanned']:
+                        self._scan(size)
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_meta(self):
+        meta_path = self.index_dir / 'meta.json'
+        try:
+            meta = json.loads(meta_path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            meta = None
+        if not meta or meta.get('version') != INDEX_VERSION:
+            self._reset()
+            return
+        # 记录文件比元数据中的数量多时为写入中断留下的记录，截掉；少时索引已损坏，重建
+        for name in ('all',) + LEVELS:
+            records_path = self._records_path(None if name == 'all' else name)
+            expected = meta['counts'].get(name, 0) * RECORD.size
+            actual = records_path.stat().st_size if records_path.exists() else 0
+            if actual < expected:
+                self._reset()
+                return
+            if actual > expected:
+                os.truncate(records_path, expected)
+        self.meta = meta
+
+    def _reset(self):
+        for name in ('all',) + LEVELS:
+            records_path = self._records_path(None if name == 'all' else name)
+            if records_path.exists():
+                records_path.unlink()
+        # scanned: 已扫描到的位置（行首）；pending: 最后一条尚未建立记录的日志
+        self.meta = {'version': INDEX_VERSION, 'scanned': 0, 'pending': None, 'counts': {}}
+
+    def _save_meta(self):
+        meta_path = self.index_dir / 'meta.json'
+        tmp_path = meta_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(self.meta), encoding='utf-8')
+        os.replace(tmp_path, meta_path)
+
+    def _scan(self, size: int):
+        """从上次扫描的位置向后按块扫描新的日志条目"""
+        pending = self.meta['pending']  # [偏移, 时间戳, 级别]，尚未确定长度的最后一条日志
+        counts = self.meta['counts']
+        pos = self.meta['scanned']
+        carry = b''
+        with open(self.path, 'rb') as f:
+            f.seek(pos)
+            while pos < size:
+                block = f.read(min(BLOCK_SIZE, size - pos))
+                if not block:
+                    break
+                pos += len(block)
+                buffer = carry + block
+                complete = buffer.rfind(b'\n') + 1
+                # 只处理完整的行，不完整的行留到下一块（或下一次刷新）
+                carry = buffer[complete:]
+                base = pos - len(buffer)
+
+                buffers: Dict[str, bytearray] = {}
+                for match in ENTRY_PATTERN.finditer(buffer, 0, complete):
+                    start = base + match.start()
+                    if pending:
+                        self._append(buffers, counts, pending, start)
+                    pending = [start, _timestamp_ms(match), match.group(8).decode('ascii')]
+                self._flush(buffers)
+
+        self.meta['pending'] = pending
+        self.meta['scanned'] = pos - len(carry)
+        self._save_meta()
+
+    @staticmethod
+    def _append(buffers: Dict[str, bytearray], counts: Dict[str, int], entry: List, end: int):
+        offset, timestamp, level = entry
+        record = RECORD.pack(offset, min(end - offset, 0xFFFFFFFF), timestamp)
+        for name in ('all', level):
+            buffers.setdefault(name, bytearray()).extend(record)
+            counts[name] = counts.get(name, 0) + 1
+
+    def _flush(self, buffers: Dict[str, bytearray]):
+        for name, data in buffers.items():
+            with open(self._records_path(None if name == 'all' else name), 'ab') as f:
+                f.write(data)
+
+    def count(self, level: Optional[str] = None) -> int:
+        return self.meta['counts'].get(level or 'all', 0)
+
+    def records(self, level: Optional[str], start: int, stop: int) -> List[Tuple[int, int, int]]:
+        """读取第start到stop-1条记录"""
+        start = max(0, start)
+        stop = min(stop, self.count(level))
+        if stop <= start:
+            return []
+        with open(self._records_path(level), 'rb') as f:
+            f.seek(start * RECORD.size)
+            data = f.read((stop - start) * RECORD.size)
+        return [RECORD.unpack_from(data, i * RECORD.size) for i in range(stop - start)]
+
+    def bisect_time(self, level: Optional[str], timestamp: int) -> int:
+        """第一条时间戳不早于timestamp的记录序号（日志按时间顺序写入）"""
+        index = self
+
+        class Timestamps:
+            def __len__(self):
+                return index.count(level)
+
+            def __getitem__(self, i):
+                return index.records(level, i, i + 1)[0][2]
+
+        return bisect_left(Timestamps(), timestamp)
+
+    def tail_entry(self) -> Optional[Tuple[int, int, int, str]]:
+        """最后一条尚未建立记录的日志：(偏移, 长度, 时间戳, 级别)"""
+        pending = self.meta.get('pending')
+        if not pending:
+            return None
+        offset, timestamp, level = pending
+        return offset, self.meta['scanned'] - offset, timestamp, level
+
+    def read_entry(self, offset: int, length: int) -> Optional[Dict[str, Any]]:
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return _parse_entry(f.read(min(length, MAX_ENTRY_BYTES)))
+
+class LogReader:
+    """日志目录的分页查询，多个日志文件（包括轮转文件）的条目按时间戳从新到旧返回"""
+
+    def __init__(self, log_dir: Path = LOG_DIR):
+        self.log_dir = log_dir
+        self.index_root = log_dir / INDEX_DIR_NAME
+        self._indexes: Dict[str, LogIndex] = {}
+        self._lock = threading.Lock()
+
+    def _index(self, path: Path) -> Optional[LogIndex]:
+        key = LogIndex.key_for(path)
+        if key is None:
+            return None
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is None:
+                index = LogIndex(path, self.index_root, key)
+                self._indexes[key] = index
+            index.path = path
+        index.refresh()
+        return index
+
+    def entries(self, page: int = 1, per_page: int = 20, level: Optional[str] = None,
+                start_time: Optional[int] = None, end_time: Optional[int] = None) -> Tuple[List[Dict[str, Any]], int]:
+        """查询一页日志条目，返回 (条目列表, 总数)
+
+        start_time/end_time为毫秒时间戳，包含start_time、不包含end_time
+        """
+        level = level.upper() if level else None
+        if level and level not in LEVELS:
+            return [], 0
+
+        # 每个文件中符合条件的条目：(索引, 记录序号范围, 是否包含最后一条日志)
+        ranges = []
+        keys = set()
+        for path in list_log_files(self.log_dir):
+            index = self._index(path)
+            if index is None:
+                continue
+            keys.add(index.index_dir.name)
+            low = index.bisect_time(level, start_time) if start_time is not None else 0
+            high = index.bisect_time(level, end_time) if end_time is not None else index.count(level)
+            tail = index.tail_entry()
+            include_tail = bool(tail and (not level or tail[3] == level)
+                                and (start_time is None or tail[2] >= start_time)
+                                and (end_time is None or tail[2] < end_time))
+            ranges.append((index, low, max(low, high), include_tail))
+        self._remove_stale(keys)
+
+        total = sum(high - low + include_tail for _, low, high, include_tail in ranges)
+        # 各文件的条目都按时间顺序写入，从后往前读取后按时间戳多路归并，跳过前几页只读取索引记录
+        merged = heapq.merge(*(self._newest_first(index, level, low, high, include_tail)
+                               for index, low, high, include_tail in ranges),
+                             key=lambda item: item[0], reverse=True)
+        entries = []
+        for _, index, offset, length in islice(merged, (page - 1) * per_page, page * per_page):
+            entry = index.read_entry(offset, length)
+            if entry:
+                entries.append(entry)
+        return entries, total
+
+    @staticmethod
+    def _newest_first(index: LogIndex, level: Optional[str], low: int, high: int, include_tail: bool):
+        """从新到旧产出文件中符合条件的条目 (时间戳, 索引, 偏移, 长度)，每次读取MERGE_BLOCK条记录"""
+        if include_tail:
+            offset, length, timestamp, _ = index.tail_entry()
+            yield timestamp, index, offset, length
+        stop = high
+        while stop > low:
+            start = max(low, stop - MERGE_BLOCK)
+            for offset, length, timestamp in reversed(index.records(level, start, stop)):
+                yield timestamp, index, offset, length
+            stop = start
+
+    def _remove_stale(self, keys: set):
+        """删除已不存在的日志文件的索引"""
+        if not self.index_root.exists():
+            return
+        for index_dir in self.index_root.iterdir():
+            if index_dir.is_dir() and index_dir.name not in keys:
+                try:
+                    for child in index_dir.iterdir():
+                        child.unlink()
+                    index_dir.rmdir()
+                except OSError:
+                    continue
+                with self._lock:
+                    self._indexes.pop(index_dir.name, None)
+
+log_reader = LogReader()
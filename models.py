@@ -68,6 +68,7 @@ class Device(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     last_backup = db.Column(db.DateTime)
     last_backup_status = db.Column(db.String(20))  # success, failed
+    config_change_marker = db.Column(db.String(255))  # 上次完整备份时的配置变更标记
     
     # 关联关系
     backup_tasks = db.relationship('BackupTask', backref='device', lazy='dynamic')
@@ -116,16 +117,33 @@ class Device(db.Model):
 class BackupTask(db.Model):
     """备份任务模型"""
     __tablename__ = 'backup_tasks'
+    __table_args__ = (
+        # 按设备和状态查找最近的备份（比较、历史、差异基准）
+        db.Index('ix_backup_tasks_device_status_created', 'device_id', 'status', 'created_at'),
+        db.Index('ix_backup_tasks_device_status_completed', 'device_id', 'status', 'completed_at'),
+        # 设备的全部备份任务列表
+        db.Index('ix_backup_tasks_device_created', 'device_id', 'created_at'),
+        # 全部任务的分页历史
+        db.Index('ix_backup_tasks_created', 'created_at'),
+        # 统计进行中的任务（pending/running的行数很少）
+        db.Index('ix_backup_tasks_status', 'status'),
+        # 按内容哈希查找备份（配置搜索结果对应的设备和任务，按内容和设备分组）
+        db.Index('ix_backup_tasks_file_hash', 'file_hash', 'device_id', 'status'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     device_id = db.Column(db.Integer, db.ForeignKey('devices.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     task_type = db.Column(db.String(20), default='manual')  # manual, scheduled, batch
-    status = db.Column(db.String(20), default='pending')  # pending, running, success, failed, cancelled
+    # 状态和大小变化时需要旧值来增量更新统计表，因此修改前总是加载旧值
+    status = db.column_property(db.Column(db.String(20), default='pending'),
+                                active_history=True)  # pending, running, success, failed, cancelled
     backup_command = db.Column(db.String(200))
     file_path = db.Column(db.String(500))
-    file_size = db.Column(db.BigInteger)
+    file_size = db.column_property(db.Column(db.BigInteger), active_history=True)
     file_hash = db.Column(db.String(64))  # SHA256哈希
+    unchanged = db.Column(db.Boolean, default=False)  # 配置未变化，沿用上次备份的文件
+    content_encoding = db.Column(db.String(20))  # 备份内容的编码，第一次读取时检测
     started_at = db.Column(db.DateTime)
     completed_at = db.Column(db.DateTime)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -135,41 +153,350 @@ class BackupTask(db.Model):
     
     # 关联关系
     logs = db.relationship('BackupLog', backref='task', lazy='dynamic', cascade='all, delete-orphan')
+    artifacts = db.relationship('BackupArtifact', backref='task', lazy='dynamic',
+                                cascade='all, delete-orphan', order_by='BackupArtifact.sequence')
+    # 本次备份相对上次备份的配置变更记录，任务删除时一并删除
+    config_change = db.relationship('ConfigChange', foreign_keys='ConfigChange.task_id', backref='task',
+                                    uselist=False, cascade='all, delete-orphan')
+    
+    def to_dict(self):
+        """转换为字典"""
+        return self.serialize(
+            self,
+            device_alias=self.device.alias if self.device else None,
+            device_ip=self.device.ip_address if self.device else None,
+            username=self.user.username if self.user else None
+        )
+    
+    def get_duration(self):
+        """获取任务执行时长（秒）"""
+        if self.started_at and self.completed_at:
+            return (self.completed_at - self.started_at).total_seconds()
+        return None
+    
+    @classmethod
+    def eager_options(cls):
+        """to_dict需要的设备和用户关联，查询多个任务时一次性加载"""
+        return (db.joinedload(cls.device), db.joinedload(cls.user))
+    
+    @classmethod
+    def summary_query(cls):
+        """列表接口使用的查询：连接设备和用户，只取序列化需要的列，不构造ORM对象"""
+        return db.session.query(
+            cls.id, cls.device_id, cls.user_id, cls.task_type, cls.status, cls.backup_command,
+            cls.file_path, cls.file_size, cls.file_hash, cls.unchanged, cls.started_at,
+            cls.completed_at, cls.created_at, cls.error_message, cls.retry_count, cls.max_retries,
+            Device.alias.label('device_alias'),
+            Device.ip_address.label('device_ip'),
+            User.username.label('username')
+        ).outerjoin(Device, cls.device_id == Device.id).outerjoin(User, cls.user_id == User.id)
+    
+    @classmethod
+    def summary_dict(cls, row):
+        """将summary_query的结果行转换为与to_dict相同的字典"""
+        return cls.serialize(row, device_alias=row.device_alias, device_ip=row.device_ip, username=row.username)
+    
+    @staticmethod
+    def serialize(task, device_alias, device_ip, username):
+        """任务字段转换为字典，task可以是模型对象或查询结果行"""
+        duration = None
+        if task.started_at and task.completed_at:
+            duration = (task.completed_at - task.started_at).total_seconds()
+        return {
+            'id': task.id,
+            'device_id': task.device_id,
+            'device_alias': device_alias,
+            'device_ip': device_ip,
+            'device': device_alias,  # 添加device字段
+            'user_id': task.user_id,
+            'username': username,
+            'task_type': task.task_type,
+            'status': task.status,
+            'backup_command': task.backup_command,
+            'file_path': task.file_path,
+            'file_size': task.file_size,
+            'file_hash': task.file_hash,
+            'unchanged': bool(task.unchanged),
+            'started_at': task.started_at.isoformat() if task.started_at else None,
+            'completed_at': task.completed_at.isoformat() if task.completed_at else None,
+            'created_at': task.created_at.isoformat() if task.created_at else None,
+            'error_message': task.error_message,
+            'retry_count': task.retry_count,
+            'max_retries': task.max_retries,
+            'duration': duration
+        }
+
+class BackupArtifact(db.Model):
+    """备份产物模型（命令集备份中每条命令的输出）"""
+    __tablename__ = 'backup_artifacts'
+    __table_args__ = (
+        db.Index('ix_backup_artifacts_task_sequence', 'task_id', 'sequence'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    task_id = db.Column(db.Integer, db.ForeignKey('backup_tasks.id'), nullable=False)
+    sequence = db.Column(db.Integer, nullable=False, default=0)  # 命令执行顺序
+    command = db.Column(db.String(200), nullable=False)
+    status = db.Column(db.String(20), default='pending')  # pending, success, failed
+    file_path = db.Column(db.String(500))
+    file_size = db.Column(db.BigInteger)
+    file_hash = db.Column(db.String(64))  # SHA256哈希
+    error_message = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    completed_at = db.Column(db.DateTime)
     
     def to_dict(self):
         """转换为字典"""
         return {
             'id': self.id,
-            'device_id': self.device_id,
-            'device_alias': self.device.alias if self.device else None,
-            'device_ip': self.device.ip_address if self.device else None,
-            'device': self.device.alias if self.device else None,  # 添加device字段
-            'user_id': self.user_id,
-            'username': self.user.username if self.user else None,
-            'task_type': self.task_type,
+            'task_id': self.task_id,
+            'sequence': self.sequence,
+            'command': self.command,
             'status': self.status,
-            'backup_command': self.backup_command,
             'file_path': self.file_path,
             'file_size': self.file_size,
             'file_hash': self.file_hash,
-            'started_at': self.started_at.isoformat() if self.started_at else None,
-            'completed_at': self.completed_at.isoformat() if self.completed_at else None,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
             'error_message': self.error_message,
-            'retry_count': self.retry_count,
-            'max_retries': self.max_retries,
-            'duration': self.get_duration()
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'completed_at': self.completed_at.isoformat() if self.completed_at else None
         }
+
+class BackupObject(db.Model):
+    """备份内容对象模型（按内容哈希去重存储，多个任务共享同一对象）"""
+    __tablename__ = 'backup_objects'
     
-    def get_duration(self):
-        """获取任务执行时长（秒）"""
-        if self.started_at and self.completed_at:
-            return (self.completed_at - self.started_at).total_seconds()
-        return None
+    file_hash = db.Column(db.String(64), primary_key=True)  # 明文内容的SHA256哈希
+    file_path = db.Column(db.String(500), nullable=False)
+    file_size = db.Column(db.BigInteger)  # 落盘大小
+    content_size = db.Column(db.BigInteger)  # 明文大小
+    compressed = db.Column(db.Boolean, default=False)
+    kind = db.Column(db.String(10), default='full', nullable=False)  # full(完整快照), delta(相对base的行级差异)
+    base_hash = db.Column(db.String(64))  # 差异对象的基准对象哈希
+    chain_depth = db.Column(db.Integer, default=0, nullable=False)  # 距最近完整快照的差异层数
+    ref_count = db.Column(db.Integer, default=0, nullable=False)  # 引用该对象的任务/产物/差异对象数
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def to_dict(self):
+        """转换为字典"""
+        return {
+            'file_hash': self.file_hash,
+            'file_path': self.file_path,
+            'file_size': self.file_size,
+            'content_size': self.content_size,
+            'compressed': self.compressed,
+            'kind': self.kind,
+            'base_hash': self.base_hash,
+            'chain_depth': self.chain_depth,
+            'ref_count': self.ref_count,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+class BackupStatistic(db.Model):
+    """备份统计计数器模型（任务状态变化时增量更新，定期与备份任务表核对）"""
+    __tablename__ = 'backup_statistics'
+    
+    name = db.Column(db.String(50), primary_key=True)  # total_tasks, success_tasks, failed_tasks, total_size
+    value = db.Column(db.BigInteger, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def to_dict(self):
+        """转换为字典"""
+        return {
+            'name': self.name,
+            'value': self.value,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+class ConfigChange(db.Model):
+    """配置变更记录模型（备份完成时与设备上次成功备份比较的结果）"""
+    __tablename__ = 'config_changes'
+    __table_args__ = (
+        # 按时间范围查询发生变更的设备
+        db.Index('ix_config_changes_detected', 'detected_at'),
+        # 设备的变更历史
+        db.Index('ix_config_changes_device_detected', 'device_id', 'detected_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.Integer, db.ForeignKey('devices.id'), nullable=False)
+    task_id = db.Column(db.Integer, db.ForeignKey('backup_tasks.id'), nullable=False, unique=True)
+    previous_task_id = db.Column(db.Integer, db.ForeignKey('backup_tasks.id'))  # 上次备份删除后为空
+    added_lines = db.Column(db.Integer, default=0, nullable=False)
+    removed_lines = db.Column(db.Integer, default=0, nullable=False)
+    modified_lines = db.Column(db.Integer, default=0, nullable=False)
+    changed_sections = db.Column(db.Integer, default=0, nullable=False)
+    old_line_count = db.Column(db.Integer)
+    new_line_count = db.Column(db.Integer)
+    sections = db.Column(db.Text)  # JSON格式存储变化的配置段（段名、状态和行数统计）
+    detected_at = db.Column(db.DateTime, default=datetime.utcnow)  # 本次备份完成时间
+    
+    previous_task = db.relationship('BackupTask', foreign_keys=[previous_task_id],
+                                    backref=db.backref('next_config_changes', lazy='dynamic'))
+    device = db.relationship('Device', backref=db.backref('config_changes', lazy='dynamic'))
+    
+    def summary(self):
+        """与差异比较结果相同格式的统计"""
+        total_changes = self.added_lines + self.removed_lines + self.modified_lines
+        return {
+            'total_changes': total_changes,
+            'added_lines': self.added_lines,
+            'removed_lines': self.removed_lines,
+            'modified_lines': self.modified_lines,
+            'has_changes': total_changes > 0 or self.changed_sections > 0,
+            'old_lines': self.old_line_count,
+            'new_lines': self.new_line_count,
+            'changed_sections': self.changed_sections
+        }
+    
+    def to_dict(self):
+        """转换为字典"""
+        return {
+            'id': self.id,
+            'device_id': self.device_id,
+            'task_id': self.task_id,
+            'previous_task_id': self.previous_task_id,
+            'summary': self.summary(),
+            'sections': json.loads(self.sections) if self.sections else [],
+            'detected_at': self.detected_at.isoformat() if self.detected_at else None
+        }
+
+class SearchLine(db.Model):
+    """配置搜索索引中的配置行（所有备份中内容相同的行只存一份）"""
+    __tablename__ = 'search_lines'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    digest = db.Column(db.String(40), nullable=False, unique=True)  # 行内容的SHA-1
+    text = db.Column(db.Text, nullable=False)
+
+class SearchDocument(db.Model):
+    """已建立搜索索引的备份内容（按内容哈希，内容相同的备份共享）"""
+    __tablename__ = 'search_documents'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    file_hash = db.Column(db.String(64), nullable=False, unique=True)
+    line_count = db.Column(db.Integer, default=0, nullable=False)
+    indexed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class SearchPosting(db.Model):
+    """倒排表：配置行出现在哪些备份内容中，以及所在的行号"""
+    __tablename__ = 'search_postings'
+    __table_args__ = (
+        # 删除不再被任务引用的备份内容的索引
+        db.Index('ix_search_postings_document', 'document_id'),
+        {'sqlite_with_rowid': False}
+    )
+    
+    line_id = db.Column(db.Integer, db.ForeignKey('search_lines.id'), primary_key=True)
+    document_id = db.Column(db.Integer, db.ForeignKey('search_documents.id'), primary_key=True)
+    line_numbers = db.Column(db.Text, nullable=False)  # 逗号分隔的行号（从1开始）
+
+class ComplianceRule(db.Model):
+    """合规规则模型"""
+    __tablename__ = 'compliance_rules'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), unique=True, nullable=False)
+    description = db.Column(db.Text)
+    rule_type = db.Column(db.String(20), nullable=False, default='required')  # required（必须包含）, forbidden（不得包含）
+    match_type = db.Column(db.String(20), nullable=False, default='literal')  # literal（整行相同）, regex
+    pattern = db.Column(db.String(500), nullable=False)
+    section = db.Column(db.String(500))  # 配置段首行的正则，为空时检查整个配置
+    device_type = db.Column(db.String(50))  # 只检查该类型的设备，为空时检查所有设备
+    severity = db.Column(db.String(20), default='medium')  # low, medium, high
+    is_active = db.Column(db.Boolean, default=True)
+    revision = db.Column(db.Integer, nullable=False, default=1)  # 检查内容修改时递增，之前的检查结果随之失效
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    results = db.relationship('ComplianceResult', backref='rule', lazy='dynamic', cascade='all, delete-orphan')
+    
+    def to_spec(self):
+        """求值需要的规则定义（传给工作进程）"""
+        return {
+            'id': self.id,
+            'rule_type': self.rule_type,
+            'match_type': self.match_type,
+            'pattern': self.pattern,
+            'section': self.section
+        }
+    
+    def to_dict(self):
+        """转换为字典"""
+        return {
+            'id': self.id,
+            'name': self.name,
+            'description': self.description,
+            'rule_type': self.rule_type,
+            'match_type': self.match_type,
+            'pattern': self.pattern,
+            'section': self.section,
+            'device_type': self.device_type,
+            'severity': self.severity,
+            'is_active': self.is_active,
+            'revision': self.revision,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
 
+class ComplianceResult(db.Model):
+    """合规检查结果模型（每台设备每条规则一条，记录检查时的备份内容和规则版本）"""
+    __tablename__ = 'compliance_results'
+    __table_args__ = (
+        db.Index('ix_compliance_results_device_rule', 'device_id', 'rule_id', unique=True),
+        # 按规则和状态列出违规设备
+        db.Index('ix_compliance_results_rule_status_evaluated', 'rule_id', 'status', 'evaluated_at'),
+        db.Index('ix_compliance_results_status_evaluated', 'status', 'evaluated_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.Integer, db.ForeignKey('devices.id'), nullable=False)
+    rule_id = db.Column(db.Integer, db.ForeignKey('compliance_rules.id'), nullable=False)
+    task_id = db.Column(db.Integer, db.ForeignKey('backup_tasks.id'))  # 检查的备份，删除后为空
+    file_hash = db.Column(db.String(64))
+    rule_revision = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False)  # pass, fail, not_applicable
+    violation_count = db.Column(db.Integer, default=0, nullable=False)
+    violations = db.Column(db.Text)  # JSON格式存储违规项（配置段、行号和内容）
+    evaluated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    device = db.relationship('Device', backref=db.backref('compliance_results', lazy='dynamic',
+                                                           cascade='all, delete-orphan'))
+    task = db.relationship('BackupTask', backref=db.backref('compliance_results', lazy='dynamic'))
+    
+    def to_dict(self):
+        """转换为字典"""
+        return {
+            'id': self.id,
+            'device_id': self.device_id,
+            'rule_id': self.rule_id,
+            'task_id': self.task_id,
+            'rule_revision': self.rule_revision,
+            'status': self.status,
+            'violation_count': self.violation_count,
+            'violations': json.loads(self.violations) if self.violations else [],
+            'evaluated_at': self.evaluated_at.isoformat() if self.evaluated_at else None
+        }
+
+class DeviceCompliance(db.Model):
+    """设备的合规检查状态：上次检查的备份内容和各规则的版本、结果，用于增量检查"""
+    __tablename__ = 'device_compliance'
+    
+    device_id = db.Column(db.Integer, db.ForeignKey('devices.id'), primary_key=True)
+    task_id = db.Column(db.Integer)  # 上次检查的备份任务
+    file_hash = db.Column(db.String(64))  # 上次检查的备份内容，旧备份没有哈希时为文件路径的哈希
+    rule_states = db.Column(db.Text)  # JSON格式存储 {规则ID: [规则版本, 状态]}
+    failed_rules = db.Column(db.Integer, default=0, nullable=False)
+    passed_rules = db.Column(db.Integer, default=0, nullable=False)
+    evaluated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    device = db.relationship('Device', backref=db.backref('compliance', uselist=False, cascade='all, delete-orphan'))
+    
 class BackupLog(db.Model):
     """备份日志模型"""
     __tablename__ = 'backup_logs'
+    __table_args__ = (
+        db.Index('ix_backup_logs_task_timestamp', 'task_id', 'timestamp'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     task_id = db.Column(db.Integer, db.ForeignKey('backup_tasks.id'), nullable=False)
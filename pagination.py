@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+游标分页
+按 (created_at, id) 倒序做键集分页，下一页从上一页最后一行之后的索引位置开始读取，
+翻到任意深度的开销都与第一页相同，也不需要 COUNT(*)
+"""
+
+import base64
+from datetime import datetime
+from typing import Any, List, Optional, Tuple
+
+from sqlalchemy import func, tuple_
+
+from models import db
+
+APPROX_TOTAL_CAP = 10000  # 近似总数最多统计的行数
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    """将一行的排序键编码为游标"""
+    raw = f'{created_at.isoformat()}|{row_id}'.encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """解析游标，格式错误时抛出ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        created_at, row_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f'无效的分页游标: {cursor}') from e
+
+def keyset_page(query, created_column, id_column, cursor: Optional[str],
+                limit: int) -> Tuple[List[Any], Optional[str]]:
+    """读取一页数据，返回 (行列表, 下一页游标)，没有更多数据时游标为None
+
+    created_column为排序用的时间列（如创建时间、检测时间），行中需包含该列和id_column
+    """
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        query = query.filter(tuple_(created_column, id_column) < tuple_(created_at, row_id))
+    rows = query.order_by(created_column.desc(), id_column.desc()).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, created_column.key), getattr(last, id_column.key))
+    return rows, next_cursor
+
+def approximate_total(query, id_column, cap: int = APPROX_TOTAL_CAP) -> Tuple[int, bool]:
+    """统计总数，最多数到cap行，返回 (数量, 是否精确)"""
+    limited = query.with_entities(id_column).order_by(None).limit(cap + 1).subquery()
+    count = db.session.query(func.count()).select_from(limited).scalar()
+    if count > cap:
+        return cap, False
+    return count, True
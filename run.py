@@ -7,6 +7,7 @@ Cisco设备配置备份系统启动脚本
 import os
 import sys
 from app import app, db, scheduler
+from schema_migrations import upgrade_schema
 
 def main():
     """主函数"""
@@ -30,7 +31,7 @@ def main():
     
     # 初始化数据库
     with app.app_context():
-        db.create_all()
+        upgrade_schema()
         
         # 创建默认管理员用户
         from models import User
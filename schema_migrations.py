@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+数据库结构升级
+db.create_all() 只创建缺失的表，不会为已有的表添加新列和索引。
+这里在create_all之后补齐新增的列和模型中声明的索引，以及配置搜索的全文索引表，
+所有操作都可以重复执行。
+"""
+
+import logging
+
+from sqlalchemy import inspect, text
+
+from models import db
+from config_search import create_fts_table
+
+logger = logging.getLogger(__name__)
+
+# 已有表中新增的列：(表名, 列名, 列定义)
+ADDED_COLUMNS = [
+    ('devices', 'config_change_marker', 'VARCHAR(255)'),
+    ('backup_tasks', 'unchanged', 'BOOLEAN DEFAULT 0'),
+    ('backup_tasks', 'content_encoding', 'VARCHAR(20)'),
+]
+
+def upgrade_schema():
+    """创建缺失的表并补齐新增的列和索引（需在应用上下文中调用）"""
+    db.create_all()
+
+    inspector = inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table, column, ddl in ADDED_COLUMNS:
+            if not inspector.has_table(table):
+                continue
+            existing = {col['name'] for col in inspector.get_columns(table)}
+            if column not in existing:
+                conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+                logger.info(f"已为表 {table} 添加列 {column}")
+
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(conn)
+                    logger.info(f"已为表 {table.name} 创建索引 {index.name}")
+
+        create_fts_table(conn)
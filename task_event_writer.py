@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+任务事件批量写入
+备份工作线程只把任务日志和开始状态放入队列，由单个后台线程按批量或时间间隔
+在一个事务中写入数据库，减少SQLite写锁竞争和fsync次数
+"""
+
+import atexit
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import List, Tuple
+
+from sqlalchemy import bindparam, case, func, insert, update
+
+from config import Config
+from models import db, BackupTask, BackupLog
+
+logger = logging.getLogger(__name__)
+
+class TaskEventWriter:
+    """任务日志和状态的后台批量写入器
+
+    任务的开始状态只会从pending更新为running，开始时间只在为空时写入，
+    不会覆盖工作线程同步写入的最终状态（success/failed），
+    因此批量写入的延迟不影响任务结果。
+    """
+
+    def __init__(self, batch_size: int = 200, flush_interval: float = 0.5):
+        self.batch_size = batch_size  # 积累到多少条事件时立即写入
+        self.flush_interval = flush_interval  # 最长等待多少秒写入一次
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """启动写入线程"""
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='task-event-writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def log(self, task_id: int, level: str, message: str):
+        """记录任务日志"""
+        self._put(('log', task_id, level, message, datetime.utcnow()))
+
+    def task_started(self, task_id: int):
+        """将任务标记为运行中"""
+        self._put(('start', task_id, datetime.utcnow()))
+
+    def flush(self, timeout: float = 10):
+        """等待队列中已有的事件全部写入"""
+        if not self._thread or not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put(('flush', done))
+        done.wait(timeout)
+
+    def _put(self, event: Tuple):
+        self.start()
+        self._queue.put(event)
+
+    def _run(self):
+        from app import app
+
+        while True:
+            events = [self._queue.get()]
+            # 从一批的第一条事件开始计时，事件持续到达时也最多等待flush_interval秒
+            deadline = time.monotonic() + self.flush_interval
+            try:
+                while len(events) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    events.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                pass
+
+            waiters = [event[1] for event in events if event[0] == 'flush']
+            with app.app_context():
+                self._write([event for event in events if event[0] != 'flush'])
+            for done in waiters:
+                done.set()
+
+    def _write(self, events: List[Tuple]):
+        """在一个事务中写入一批事件"""
+        if not events:
+            return
+        logs = []
+        starts = []
+        for event in events:
+            if event[0] == 'log':
+                _, task_id, level, message, timestamp = event
+                logs.append({'task_id': task_id, 'level': level, 'message': message, 'timestamp': timestamp})
+            else:
+                starts.append({'task_id': event[1], 'start_time': event[2]})
+        try:
+            if starts:
+                table = BackupTask.__table__
+                db.session.execute(
+                    update(table)
+                    .where(table.c.id == bindparam('task_id'))
+                    .values(
+                        status=case((table.c.status == 'pending', 'running'), else_=table.c.status),
+                        started_at=func.coalesce(table.c.started_at, bindparam('start_time'))
+                    ),
+                    starts
+                )
+            if logs:
+                db.session.execute(insert(BackupLog), logs)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"批量写入任务事件失败（{len(events)} 条）: {str(e)}")
+
+task_event_writer = TaskEventWriter(
+    batch_size=Config.TASK_LOG_BATCH_SIZE,
+    flush_interval=Config.TASK_LOG_FLUSH_INTERVAL
+)
@@ -9,13 +9,20 @@ import logging
 from datetime import datetime
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR
 import atexit
 
+from config import Config
 from models import db, ScheduledTask, TaskExecution, Device
+import backup_service
 from backup_service import BackupService
+from db_engine import sqlite_connect_args
+import backup_statistics
+import config_search
+import compliance
 from scheduler_utils import CronValidator
 
 # 配置日志
@@ -36,7 +43,10 @@ class TaskScheduler:
         
         # 配置调度器
         jobstores = {
-            'default': SQLAlchemyJobStore(url=app.config['SQLALCHEMY_DATABASE_URI'])
+            'default': SQLAlchemyJobStore(
+                url=app.config['SQLALCHEMY_DATABASE_URI'],
+                engine_options={'connect_args': sqlite_connect_args(app.config['SQLALCHEMY_DATABASE_URI'])}
+            )
         }
         
         executors = {
@@ -74,6 +84,42 @@ class TaskScheduler:
             # 加载现有任务
             self.load_scheduled_tasks()
             
+            # 定期核对备份统计计数器
+            self.scheduler.add_job(
+                func=backup_statistics.reconcile_job,
+                trigger=IntervalTrigger(seconds=Config.STATISTICS_RECONCILE_INTERVAL),
+                id='reconcile_backup_statistics',
+                name='核对备份统计',
+                replace_existing=True
+            )
+            
+            # 定期清理无引用的备份对象和暂存区残留文件
+            self.scheduler.add_job(
+                func=backup_service.collect_garbage_job,
+                trigger=IntervalTrigger(seconds=Config.OBJECT_GC_INTERVAL),
+                id='collect_backup_objects',
+                name='清理备份对象',
+                replace_existing=True
+            )
+            
+            # 补齐历史备份的搜索索引，清理已删除备份的索引
+            self.scheduler.add_job(
+                func=config_search.index_pending_job,
+                trigger=IntervalTrigger(seconds=Config.SEARCH_INDEX_INTERVAL),
+                id='index_config_search',
+                name='更新配置搜索索引',
+                replace_existing=True
+            )
+            
+            # 增量合规检查（只检查备份内容或规则有变化的设备）
+            self.scheduler.add_job(
+                func=compliance.compliance_job,
+                trigger=IntervalTrigger(seconds=Config.COMPLIANCE_INTERVAL),
+                id='compliance_check',
+                name='合规检查',
+                replace_existing=True
+            )
+            
     def shutdown(self):
         """关闭调度器"""
         if self.scheduler and self.scheduler.running:
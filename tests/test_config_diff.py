@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+配置差异比较测试
+检查差异结果能还原出新配置、修改行配对正确、按配置段分组，以及大配置的比较耗时
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config_diff import diff_configs, opcodes, _intern
+from config_sections import diff_sections, parse_sections
+
+def apply_opcodes(old_lines, new_lines, codes):
+    """按编辑操作由旧行生成新行，同时检查相等块确实相等"""
+    result = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal':
+            assert old_lines[i1:i2] == new_lines[j1:j2]
+            result.extend(old_lines[i1:i2])
+        else:
+            result.extend(new_lines[j1:j2])
+    return result
+
+def generate_config(interfaces):
+    """生成类似show running-config的配置"""
+    lines = ['hostname test-switch', '!']
+    for i in range(interfaces):
+        lines += [f'interface GigabitEthernet1/0/{i}',
+                  f' description port {i}',
+                  f' switchport access vlan {i % 50 + 1}',
+                  ' no shutdown',
+                  '!']
+    return lines
+
+def test_random_edits_reproduce_new_content():
+    """随机编辑后的差异操作能由旧内容还原出新内容"""
+    rng = random.Random(19)
+    for _ in range(300):
+        old_lines = [rng.choice('abcdefg') for _ in range(rng.randint(0, 60))]
+        new_lines = list(old_lines)
+        for _ in range(rng.randint(0, 10)):
+            position = rng.randint(0, len(new_lines))
+            action = rng.random()
+            if action < 0.4:
+                new_lines.insert(position, rng.choice('abcxyz'))
+            elif new_lines:
+                position = min(position, len(new_lines) - 1)
+                if action < 0.8:
+                    del new_lines[position]
+                else:
+                    new_lines[position] = 'z'
+        a, b = _intern(old_lines, new_lines)
+        assert apply_opcodes(old_lines, new_lines, opcodes(a, b)) == new_lines
+
+def test_modified_lines_are_paired():
+    """同一配置项的参数变化计为修改，新增的配置项计为新增"""
+    old = 'interface Gi0/1\n ip address 10.0.0.1 255.255.255.0\n no shutdown\n!'
+    new = 'interface Gi0/1\n ip address 10.0.0.2 255.255.255.0\n shutdown\n description uplink\n!'
+    result = diff_configs(old, new)
+    summary = result['summary']
+    assert summary['modified_lines'] == 2
+    assert summary['added_lines'] == 1
+    assert summary['removed_lines'] == 0
+    assert summary['has_changes']
+
+    changes = result['diff_blocks'][0]['changes']
+    removed = [c for c in changes if c['type'] == 'removed']
+    assert all(c.get('modified') for c in removed)
+    assert removed[0]['pair_line'] == 2
+    assert result['raw_diff'].startswith('--- 旧配置\n+++ 新配置\n@@ -1,4 +1,5 @@')
+
+def test_identical_content_has_no_changes():
+    """内容相同时没有差异"""
+    content = '\n'.join(generate_config(10))
+    result = diff_configs(content, content)
+    assert not result['summary']['has_changes']
+    assert result['diff_blocks'] == []
+    assert result['raw_diff'] == ''
+
+def test_large_config_within_budget():
+    """十万行配置的比较在时间预算内完成且不截断"""
+    old_lines = generate_config(20000)
+    new_lines = list(old_lines)
+    changed = 0
+    for index in range(2, len(new_lines), 1000):
+        if new_lines[index].startswith(' switchport'):
+            new_lines[index] = ' switchport access vlan 999'
+            changed += 1
+    new_lines += [f'ip route 10.{i // 256}.{i % 256}.0 255.255.255.0 192.168.0.1' for i in range(5000)]
+
+    started = time.time()
+    result = diff_configs('\n'.join(old_lines), '\n'.join(new_lines))
+    elapsed = time.time() - started
+
+    summary = result['summary']
+    assert summary['modified_lines'] == changed
+    assert summary['added_lines'] == 5000
+    assert summary['removed_lines'] == 0
+    assert result['raw_diff'].count('\n+ip route') == 5000
+    assert elapsed < 5, f'比较耗时 {elapsed:.2f} 秒'
+    print(f"✓ {len(old_lines)} 行配置比较耗时 {elapsed:.2f} 秒")
+
+BGP_CONFIG = """hostname sw1
+!
+interface Gi0/1
+ ip address 10.0.0.1 255.255.255.0
+ no shutdown
+!
+interface Gi0/2
+ shutdown
+!
+router bgp 65000
+ neighbor 10.0.0.2 remote-as 65001
+ address-family ipv4 vrf A
+  redistribute connected
+ exit-address-family
+!
+end"""
+
+def test_parse_sections():
+    """按缩进解析出嵌套的配置段"""
+    root = parse_sections(BGP_CONFIG.splitlines())
+    headers = [section.line for section in root.sections]
+    assert headers == [2, 6, 9]
+    bgp = root.sections[2]
+    assert (bgp.start, bgp.end) == (9, 14)
+    assert [section.line for section in bgp.sections] == [11]
+    assert bgp.lines == [10, 13]
+    assert root.lines == [0, 1, 5, 8, 14, 15]
+
+def test_section_diff_groups_changes():
+    """差异按配置段分组，未变化的段不逐行比较"""
+    new = (BGP_CONFIG.replace('hostname sw1', 'hostname sw2')
+           .replace('  redistribute connected', '  redistribute connected\n  maximum-paths 4')
+           .replace('interface Gi0/2\n shutdown\n!\n', ''))
+    result = diff_sections(BGP_CONFIG, new)
+    sections = {section['section']: section['status'] for section in result['sections']}
+    assert sections == {
+        '全局配置': 'modified',
+        'interface Gi0/2': 'removed',
+        'router bgp 65000 > address-family ipv4 vrf A': 'modified'
+    }
+    assert result['summary']['unchanged_sections'] == 1
+    assert result['summary']['modified_lines'] == 1
+    assert result['summary']['added_lines'] == 1
+    assert result['summary']['removed_lines'] == 2
+    assert '@@ -12,2 +9,3 @@ router bgp 65000 > address-family ipv4 vrf A' in result['raw_diff']
+    assert all(block['section'] for block in result['diff_blocks'])
+
+    assert not diff_sections(BGP_CONFIG, BGP_CONFIG)['summary']['has_changes']
+
+def main():
+    """运行配置差异比较测试"""
+    print("检查配置差异比较...")
+    try:
+        test_random_edits_reproduce_new_content()
+        print("✓ 差异操作能还原出新内容")
+        test_modified_lines_are_paired()
+        print("✓ 修改行配对正确")
+        test_identical_content_has_no_changes()
+        test_parse_sections()
+        test_section_diff_groups_changes()
+        print("✓ 按配置段比较正确")
+        test_large_config_within_budget()
+    except AssertionError as e:
+        print(f"✗ {e}")
+        return 1
+    print("✓ 配置差异比较测试通过")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+配置搜索测试
+检查正则表达式必需文本的提取、行匹配，以及建立索引后按子串和正则搜索备份内容
+"""
+
+import hashlib
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+
+from models import db, Device, BackupTask, SearchDocument
+from config_search import (required_literal, split_lines, _matcher, create_fts_table,
+                           index_content, is_indexed, purge_stale, search_configs)
+
+CONFIG_A = """hostname core-1
+!
+interface GigabitEthernet0/1
+ ip address 10.0.0.1 255.255.255.0
+!
+snmp-server community public RO
+!
+end
+"""
+
+CONFIG_B = """hostname core-1
+!
+interface GigabitEthernet0/1
+ ip address 10.0.0.2 255.255.255.0
+!
+end
+"""
+
+def create_test_app(database_path):
+    """只初始化数据库的最小应用"""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{database_path}'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
+
+def add_backup(device, content, completed_at):
+    """为设备添加一次成功备份并索引其内容"""
+    file_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    task = BackupTask(device_id=device.id, user_id=1, status='success', backup_command=device.backup_command,
+                      file_path=f'backups/{file_hash}', file_hash=file_hash, completed_at=completed_at)
+    db.session.add(task)
+    db.session.commit()
+    if not is_indexed(file_hash):
+        assert index_content(file_hash, content)
+    return task
+
+def test_required_literal():
+    """必需文本只取一定会出现的连续普通字符"""
+    cases = [
+        ('interface Gi.*', 'interface Gi'),
+        (r'ip address 10\.0\.0\.\d+', 'ip address 10.0.0.'),
+        ('[^]]xyz', 'xyz'),  # 字符类开头的]是普通字符
+        (r'[\]]abc', ']abc'),  # 只含一个字符的字符类等同于该字符
+        ('[a-z]]abcd', ']abcd'),
+        (r'\bhostname\s+core', 'hostname'),
+        ('logg(ing)? host', ' host'),
+        ('(?:abcd)?xy', 'xy'),
+        ('(snmp-server)+ community', 'snmp-server'),
+        ('ab*cde', 'cde'),
+        ('x{0,3}yz', 'yz'),
+        ('(?=.*snmp)community', 'community'),
+        (r'\\ab', '\\ab'),
+        ('vlan (10|20)', 'vlan '),  # 分支之外的文本仍然必需
+    ]
+    for pattern, expected in cases:
+        assert required_literal(pattern) == expected, pattern
+    for pattern in ['a|bcd', '.*', '[abc]+', '[']:
+        assert required_literal(pattern) is None, pattern
+
+def test_split_lines():
+    """行号与按行读取备份内容一致"""
+    assert split_lines('a\r\nb\n\nc\n') == ['a', 'b', '', 'c']
+    assert split_lines('a\nb') == ['a', 'b']
+    assert split_lines('') == []
+
+def test_matcher():
+    """子串匹配和正则匹配返回匹配位置，过短或无效的搜索内容抛出ValueError"""
+    literal, match = _matcher('Community', False, True)
+    assert literal == 'Community'
+    assert match('snmp-server community public RO') == (12, 21)
+    assert match('hostname core-1') is None
+
+    literal, match = _matcher('Community', False, False)
+    assert match('snmp-server community public RO') is None
+
+    literal, match = _matcher(r'ip address 10\.0\.0\.\d+', True, True)
+    assert literal == 'ip address 10.0.0.'
+    assert match(' ip address 10.0.0.1 255.255.255.0') == (1, 20)
+    assert match(' ip address 10.0.1.1 255.255.255.0') is None
+
+    for query, regex in [('ab', False), ('.*', True), ('(abc', True)]:
+        with pytest.raises(ValueError):
+            _matcher(query, regex, True)
+
+def test_index_and_search():
+    """建立索引后按子串和正则搜索，结果给出匹配行号；删除备份后清理索引"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        app = create_test_app(os.path.join(tmpdir, 'search.db'))
+        with app.app_context():
+            db.create_all()
+            with db.engine.begin() as conn:
+                create_fts_table(conn)
+            device = Device(alias='core-1', hostname='core-1', ip_address='10.0.0.1', username='u',
+                            password_encrypted='p', backup_command='show running-config')
+            db.session.add(device)
+            db.session.commit()
+
+            now = datetime.utcnow()
+            old_task = add_backup(device, CONFIG_A, now - timedelta(days=1))
+            new_task = add_backup(device, CONFIG_B, now)
+            assert not index_content(old_task.file_hash, CONFIG_A)  # 同一内容只索引一次
+
+            result = search_configs('community public', scope='latest')
+            assert result['total_results'] == 0
+            result = search_configs('community public', scope='all')
+            assert [r['task_id'] for r in result['results']] == [old_task.id]
+            assert result['results'][0]['matches'][0]['line'] == 6
+
+            result = search_configs(r'ip address 10\.0\.0\.\d+', regex=True, scope='all')
+            assert result['matched_lines'] == 2
+            assert [r['task_id'] for r in result['results']] == [new_task.id, old_task.id]
+            match = result['results'][0]['matches'][0]
+            assert match['line'] == 4
+            assert match['content'][slice(*match['highlight'])] == 'ip address 10.0.0.2'
+
+            db.session.delete(old_task)
+            db.session.commit()
+            assert purge_stale() == 1
+            assert SearchDocument.query.count() == 1
+            assert search_configs('community public', scope='all')['total_results'] == 0
+
+            db.session.remove()
+            db.engine.dispose()
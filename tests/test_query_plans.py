@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+查询计划回归测试
+检查备份历史、比较和日志等高频查询在SQLite中使用复合索引，
+不会退化为全表扫描或临时排序
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from datetime import datetime
+
+from sqlalchemy import text, tuple_
+
+from models import db, BackupTask, BackupLog, ConfigChange, SearchPosting, ComplianceResult
+
+def create_test_app(database_path):
+    """只初始化数据库的最小应用"""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{database_path}'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
+
+def query_plan(query):
+    """返回查询的EXPLAIN QUERY PLAN明细"""
+    compiled = query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True})
+    rows = db.session.execute(text(f'EXPLAIN QUERY PLAN {compiled}')).all()
+    return [row[-1] for row in rows]
+
+def assert_uses_index(plan, index_name):
+    """查询计划必须使用指定索引，且不能全表扫描或临时排序"""
+    details = '\n'.join(plan)
+    assert index_name in details, f'未使用索引 {index_name}:\n{details}'
+    assert 'USE TEMP B-TREE' not in details, f'查询需要临时排序:\n{details}'
+    assert not any(line.startswith('SCAN') and 'INDEX' not in line for line in plan), f'查询存在全表扫描:\n{details}'
+
+def hot_queries():
+    """高频查询及其应使用的索引"""
+    device_id, task_id = 1, 2
+    after = tuple_(BackupTask.created_at, BackupTask.id) < tuple_(datetime(2024, 1, 1), 100)
+    return [
+        ('比较最新两个备份',
+         BackupTask.query.filter_by(device_id=device_id, status='success')
+         .order_by(BackupTask.created_at.desc()).limit(2),
+         'ix_backup_tasks_device_status_created'),
+        ('上次成功备份',
+         BackupTask.query.filter(
+             BackupTask.device_id == device_id,
+             BackupTask.status == 'success',
+             BackupTask.id != task_id
+         ).order_by(BackupTask.completed_at.desc()).limit(1),
+         'ix_backup_tasks_device_status_completed'),
+        ('设备备份列表',
+         BackupTask.query.filter_by(device_id=device_id).order_by(BackupTask.created_at.desc()),
+         'ix_backup_tasks_device_created'),
+        ('备份历史分页',
+         BackupTask.query.order_by(BackupTask.created_at.desc()).limit(20).offset(40),
+         'ix_backup_tasks_created'),
+        ('备份历史游标翻页',
+         BackupTask.query.filter(after)
+         .order_by(BackupTask.created_at.desc(), BackupTask.id.desc()).limit(21),
+         'ix_backup_tasks_created'),
+        ('设备备份游标翻页',
+         BackupTask.query.filter(BackupTask.device_id == device_id, after)
+         .order_by(BackupTask.created_at.desc(), BackupTask.id.desc()).limit(101),
+         'ix_backup_tasks_device_created'),
+        ('运行中任务数',
+         db.session.query(db.func.count(BackupTask.id)).filter(BackupTask.status == 'running'),
+         'ix_backup_tasks_status'),
+        ('任务日志',
+         BackupLog.query.filter_by(task_id=task_id).order_by(BackupLog.timestamp.desc()).limit(10),
+         'ix_backup_logs_task_timestamp'),
+        ('时间范围内的配置变更',
+         ConfigChange.query.filter(ConfigChange.detected_at >= datetime(2024, 1, 1))
+         .order_by(ConfigChange.detected_at.desc(), ConfigChange.id.desc()).limit(51),
+         'ix_config_changes_detected'),
+        ('设备配置变更历史',
+         ConfigChange.query.filter(ConfigChange.device_id == device_id)
+         .order_by(ConfigChange.detected_at.desc(), ConfigChange.id.desc()).limit(51),
+         'ix_config_changes_device_detected'),
+        ('搜索结果对应的备份',
+         db.session.query(BackupTask.device_id, BackupTask.file_hash, db.func.max(BackupTask.id))
+         .filter(BackupTask.status == 'success', BackupTask.file_hash.in_(['a' * 64, 'b' * 64]))
+         .group_by(BackupTask.file_hash, BackupTask.device_id),
+         'ix_backup_tasks_file_hash'),
+        ('清理已删除备份的搜索索引',
+         SearchPosting.query.filter(SearchPosting.document_id.in_([1, 2])),
+         'ix_search_postings_document'),
+        ('规则的不合规设备',
+         ComplianceResult.query.filter_by(rule_id=1, status='fail')
+         .order_by(ComplianceResult.evaluated_at.desc(), ComplianceResult.id.desc()).limit(51),
+         'ix_compliance_results_rule_status_evaluated'),
+        ('所有不合规结果',
+         ComplianceResult.query.filter_by(status='fail')
+         .order_by(ComplianceResult.evaluated_at.desc(), ComplianceResult.id.desc()).limit(51),
+         'ix_compliance_results_status_evaluated'),
+    ]
+
+def test_hot_query_plans():
+    """高频查询使用复合索引"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        app = create_test_app(os.path.join(tmpdir, 'plans.db'))
+        with app.app_context():
+            db.create_all()
+            for name, query, index_name in hot_queries():
+                assert_uses_index(query_plan(query), index_name)
+                print(f"✓ {name} 使用索引 {index_name}")
+            db.session.remove()
+            db.engine.dispose()
+
+def main():
+    """运行查询计划检查"""
+    print("检查高频查询的执行计划...")
+    try:
+        test_hot_query_plans()
+    except AssertionError as e:
+        print(f"✗ {e}")
+        return 1
+    print("✓ 所有高频查询均使用索引")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())